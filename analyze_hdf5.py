@@ -0,0 +1,240 @@
+import argparse
+import collections
+import json
+import multiprocessing
+import time
+
+import h5py
+import numpy as np
+
+# packet types and directions as written by larpix HDF5Logger / readout.py
+DATA_PACKET=0
+CONFIG_WRITE_PACKET=2
+CONFIG_READ_PACKET=3
+TX=0
+RX=1
+
+# per-chip counters, in summary column order
+COUNTERS=['rx_packets', 'data', 'config_write_tx', 'config_read_tx', \
+          'config_read_rx', 'parity_errors', 'unanswered_reads', \
+          'unexpected_replies']
+_fields=['io_group', 'io_channel', 'chip_id', 'packet_type', 'valid_parity', \
+         'register_address', 'direction', 'receipt_timestamp']
+
+_file=None
+
+
+
+def _open(filename):
+    global _file
+    _file = h5py.File(filename, 'r')
+
+
+
+def chip_key(rows):
+    return (rows['io_group'].astype(np.uint32)<<16) | \
+        (rows['io_channel'].astype(np.uint32)<<8) | rows['chip_id']
+
+
+
+def _count(counts, name, keys):
+    uniq, n = np.unique(keys, return_counts=True)
+    for k, v in zip(uniq.tolist(), n.tolist()): counts[(k, name)] += v
+
+
+
+def reply_bounds(rows, first, last):
+    # Pair each config read reply with the latest earlier read request for
+    # the same chip and register. TX rows carry no time, so a request is
+    # timed by the receipt timestamp of the last packet received before it:
+    # the bound [PACMAN clock ticks] is an upper bound on the reply time
+    # that includes host idle time between reads, not a latency. Only
+    # requests and replies in rows[first:last] are counted, the rows around
+    # them are lookback/lookahead shared with the neighbouring chunks. A
+    # request is unanswered if the next read row for its chip and register
+    # is another request; a verify pass retried after a rewrite counts.
+    # Returns the chip keys and bounds of matched replies and the chip keys
+    # of unanswered requests and unexpected replies
+    is_rx = rows['direction']==RX
+    last_rx = np.maximum.accumulate(np.where(is_rx, np.arange(len(rows)), -1))
+    is_read = rows['packet_type']==CONFIG_READ_PACKET
+    index = np.flatnonzero(is_read)
+    reads = rows[index]
+    key = (chip_key(reads).astype(np.int64)<<8) | reads['register_address']
+    order = np.lexsort((index, key))
+    index, key, is_tx = index[order], key[order], ~is_rx[index[order]]
+    last_tx = np.maximum.accumulate(np.where(is_tx, np.arange(len(index)), -1))
+    own = (index>=first) & (index<last)
+    reply = ~is_tx & own
+    matched = reply & (last_tx>=0)
+    matched[matched] = key[last_tx[matched]]==key[matched]
+    tx = index[last_tx[matched]]
+    ok = last_rx[tx]>=0
+    bound = (rows['receipt_timestamp'][index[matched]][ok].astype(np.int64) - \
+             rows['receipt_timestamp'][last_rx[tx[ok]]].astype(np.int64)) \
+             % 2**32
+    # a request is answered if the next read row with its key is a reply
+    requests = is_tx & own
+    answered = np.zeros(len(index), dtype=bool)
+    answered[:-1] = requests[:-1] & ~is_tx[1:] & (key[1:]==key[:-1])
+    return key[matched][ok]>>8, bound, key[requests & ~answered]>>8, \
+        key[reply & ~matched]>>8
+
+
+
+def analyze_chunk(args):
+    start, stop, lookback = args
+    dset = _file['packets']
+    first = min(start, lookback)
+    rows = dset.fields(_fields)[start-first:min(stop+lookback, len(dset))]
+    t0 = time.time()
+    counts = collections.Counter()
+    own = rows[first:first+stop-start]
+    rx = own[own['direction']==RX]
+    _count(counts, 'rx_packets', chip_key(rx))
+    _count(counts, 'data', chip_key(rx[rx['packet_type']==DATA_PACKET]))
+    tx = own[own['direction']==TX]
+    _count(counts, 'config_write_tx', \
+           chip_key(tx[tx['packet_type']==CONFIG_WRITE_PACKET]))
+    _count(counts, 'config_read_tx', \
+           chip_key(tx[tx['packet_type']==CONFIG_READ_PACKET]))
+    _count(counts, 'config_read_rx', \
+           chip_key(rx[rx['packet_type']==CONFIG_READ_PACKET]))
+    _count(counts, 'parity_errors', chip_key(rx[(rx['packet_type']<4) & \
+                                                (rx['valid_parity']==0)]))
+    keys, bound, unanswered, unexpected = reply_bounds(rows, first, \
+                                                       first+stop-start)
+    _count(counts, 'unanswered_reads', unanswered)
+    _count(counts, 'unexpected_replies', unexpected)
+    return counts, keys.astype(np.uint32), bound.astype(np.uint32), \
+        len(own), time.time()-t0
+
+
+
+def _percentiles(bound, clock_hz):
+    if len(bound)==0: return None
+    ms = bound*1e3/clock_hz
+    return dict(n=int(len(ms)), p50_ms=float(np.percentile(ms, 50)), \
+                p90_ms=float(np.percentile(ms, 90)), \
+                p99_ms=float(np.percentile(ms, 99)), max_ms=float(ms.max()))
+
+
+
+def _split_key(k):
+    return (k>>16)&0xff, (k>>8)&0xff, k&0xff
+
+
+
+def _group_percentiles(keys, bound, clock_hz):
+    # {key: reply bound percentiles}, one sort instead of a mask per key
+    order = np.argsort(keys, kind='stable')
+    keys, bound = keys[order], bound[order]
+    uniq, start = np.unique(keys, return_index=True)
+    return dict([(k, _percentiles(l, clock_hz)) for k, l \
+                 in zip(uniq.tolist(), np.split(bound, start[1:]))])
+
+
+
+def summarize(counts, keys, bound, clock_hz=10e6):
+    chips = sorted(set([k for k, name in counts]) | set(np.unique(keys).tolist()))
+    per_chip, per_channel = [], collections.defaultdict(collections.Counter)
+    chip_bound = _group_percentiles(keys, bound, clock_hz)
+    channel_bound = _group_percentiles(keys>>8, bound, clock_hz)
+    for k in chips:
+        io_group, io_channel, chip_id = _split_key(k)
+        row = dict(io_group=io_group, io_channel=io_channel, chip_id=chip_id)
+        for name in COUNTERS:
+            row[name] = counts[(k, name)]
+            per_channel[(io_group, io_channel)][name] += counts[(k, name)]
+        row['reply_bound'] = chip_bound.get(k)
+        per_chip.append(row)
+    channels = []
+    for (io_group, io_channel), c in sorted(per_channel.items()):
+        row = dict(io_group=io_group, io_channel=io_channel, **c)
+        row['chips'] = len([r for r in per_chip if r['io_group']==io_group \
+                            and r['io_channel']==io_channel and r['rx_packets']>0])
+        row['reply_bound'] = channel_bound.get((io_group<<8)|io_channel)
+        channels.append(row)
+    totals = dict([(name, sum([r[name] for r in per_chip])) for name in COUNTERS])
+    totals['reply_bound'] = _percentiles(bound, clock_hz)
+    return dict(totals=totals, io_channels=channels, chips=per_chip)
+
+
+
+def analyze(filename, output=None, workers=4, chunk_rows=2**20, lookback=2**14, \
+            clock_hz=10e6):
+    # per-chip and per-io_channel packet counts, config read reply time
+    # upper bounds (reply_bound, see reply_bounds) and error counts of the
+    # 'packets' dataset, chunk by chunk across a process pool; writes the
+    # summary to output (JSON)
+    start = time.time()
+    with h5py.File(filename, 'r') as f: n_rows = len(f['packets'])
+    chunks = [(i, min(i+chunk_rows, n_rows), lookback) \
+              for i in range(0, n_rows, chunk_rows)]
+    counts = collections.Counter()
+    keys, bound = [np.zeros(0, dtype=np.uint32)], [np.zeros(0, dtype=np.uint32)]
+    cpu = 0.
+    with multiprocessing.Pool(workers, initializer=_open, \
+                              initargs=(filename,)) as pool:
+        for c, k, l, n, t in pool.imap_unordered(analyze_chunk, chunks):
+            counts.update(c)
+            keys.append(k); bound.append(l)
+            cpu += t
+    summary = summarize(counts, np.concatenate(keys), np.concatenate(bound), \
+                        clock_hz)
+    summary['file'] = filename
+    summary['reply_bound_note'] = 'upper bound on config read reply time: '\
+        'reply receipt minus the last receipt before the request, includes '\
+        'host idle time between reads'
+    summary['rows'] = n_rows
+    summary['chunks'] = len(chunks)
+    summary['seconds'] = round(time.time()-start, 3)
+    summary['worker_seconds'] = round(cpu, 3)
+    if output is None: output = filename.rsplit('.', 1)[0]+'-summary.json'
+    with open(output, 'w') as f: json.dump(summary, f, indent=1)
+    report(summary)
+    print('summary written to ',output)
+    return summary
+
+
+
+def report(summary):
+    print(summary['file'],': ',summary['rows'],' rows in ',summary['chunks'], \
+          ' chunks, ',summary['seconds'],' s')
+    print('bound50: median upper bound on config read reply time, includes '\
+          'host idle time between reads')
+    print('unanswered_reads: requests with no reply before the next request '\
+          'for the same register, including verify passes a rewrite fixed')
+    head = '{:>9}{:>11}'+'{:>12}'*len(COUNTERS)+'{:>12}'
+    print(head.format('io_group', 'io_channel', *[n[:11] for n in COUNTERS], \
+                      'bound50[ms]'))
+    for r in summary['io_channels']:
+        p50 = r['reply_bound']['p50_ms'] if r['reply_bound'] is not None else float('nan')
+        print(('{:>9}{:>11}'+'{:>12}'*len(COUNTERS)+'{:>12.3f}').format(\
+              r['io_group'], r['io_channel'], *[r[n] for n in COUNTERS], p50))
+    for r in summary['chips']:
+        if r['config_read_tx']>0 and r['config_read_rx']==0:
+            print('SILENT\t',r['io_group'],'-',r['io_channel'],'-',r['chip_id'], \
+                  '\t',r['config_read_tx'],' config reads unanswered')
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str, \
+                        help='''LArPix+HDF5 file (HDF5Logger or readout.py)''')
+    parser.add_argument('--output', default=None, type=str, \
+                        help='''Summary JSON (default: <filename>-summary.json)''')
+    parser.add_argument('--workers', default=4, type=int, \
+                        help='''Analysis processes''')
+    parser.add_argument('--chunkRows', default=2**20, type=int, \
+                        help='''Packet rows per chunk''')
+    parser.add_argument('--lookback', default=2**14, type=int, \
+                        help='''Rows before and after each chunk searched for \
+                        read requests and replies''')
+    parser.add_argument('--clockHz', default=10e6, type=float, \
+                        help='''PACMAN receipt timestamp clock [Hz]''')
+    args = parser.parse_args()
+    analyze(args.filename, output=args.output, workers=args.workers, \
+            chunk_rows=args.chunkRows, lookback=args.lookback, \
+            clock_hz=args.clockHz)
@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import time
+
+import larpix
+import larpix.bitarrayhelper as bah
+
+# Append-only JSON-lines journal of a bring-up. Every record is flushed and
+# fsynced before the build moves on, so a crash loses at most the hop in
+# progress. Records:
+#   start: io_group, pacman_tile, io_channels
+#   root:  chip, ok, registers
+#   hop:   parent, daughter, piso, ok, parent_registers, daughter_registers
+# where registers are the full chip configuration as a hex string of
+# register values (daughter_registers only for committed hops).
+
+
+
+def registers(c, chip_key):
+    return bytes([bah.touint(data, endian='little') \
+                  for data in c[chip_key].config.all_data()]).hex()
+
+
+
+class Journal:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'a')
+
+    def write(self, record):
+        record['time'] = round(time.time(), 3)
+        self.file.write(json.dumps(record)+'\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+
+_journal=None
+
+
+
+def open_journal(filename, io_group, pacman_tile, io_channels):
+    global _journal
+    if _journal is not None: _journal.close()
+    _journal = Journal(filename)
+    _journal.write({'kind':'start', 'io_group':io_group, \
+                    'pacman_tile':pacman_tile, 'io_channels':io_channels})
+    return _journal
+
+
+
+def close_journal():
+    global _journal
+    if _journal is not None: _journal.close()
+    _journal = None
+
+
+
+def record_root(c, chip_key, ok):
+    if _journal is None: return
+    _journal.write({'kind':'root', 'chip':str(chip_key), 'ok':bool(ok), \
+                    'registers':registers(c, chip_key) if ok else None})
+
+
+
+def record_hop(c, parent, daughter, piso, ok):
+    if _journal is None: return
+    _journal.write({'kind':'hop', 'parent':str(parent), 'daughter':str(daughter), \
+                    'piso':piso, 'ok':bool(ok), \
+                    'parent_registers':registers(c, parent) \
+                                       if parent in c.chips else None, \
+                    'daughter_registers':registers(c, daughter) if ok else None})
+
+
+
+def load(filename):
+    # records of a journal; a torn last line from a crash is ignored
+    records = []
+    with open(filename, 'r') as f:
+        for line in f:
+            try: records.append(json.loads(line))
+            except ValueError: break
+    return records
+
+
+
+def network(records):
+    # committed chips in build order: [(chip key, parent key, registers)],
+    # each with the last registers journaled for it
+    chips, order = {}, []
+    for r in records:
+        if r['kind']=='root' and r['ok']:
+            if r['chip'] not in chips: order.append(r['chip'])
+            chips[r['chip']] = [None, r['registers']]
+        if r['kind']!='hop': continue
+        if r['parent'] in chips and r['parent_registers'] is not None:
+            chips[r['parent']][1] = r['parent_registers']
+        if r['ok']:
+            if r['daughter'] not in chips: order.append(r['daughter'])
+            chips[r['daughter']] = [r['parent'], r['daughter_registers']]
+    return [(larpix.key.Key(k), \
+             None if chips[k][0] is None else larpix.key.Key(chips[k][0]), \
+             chips[k][1]) for k in order]
+
+
+
+def restore(c, records):
+    # load the journaled configuration of every committed chip into c;
+    # returns [(chip key, parent key)] in build order
+    restored = []
+    for chip_key, parent, regs in network(records):
+        if chip_key not in c.chips: c.add_chip(chip_key, version='2b')
+        c[chip_key].config.from_dict_registers(dict(enumerate(bytes.fromhex(regs))))
+        restored.append((chip_key, parent))
+    return restored
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str, help='''Bring-up journal''')
+    args = parser.parse_args()
+    records = load(args.filename)
+    n_hops = len([r for r in records if r['kind']=='hop'])
+    print(len(records),' records\t',n_hops,' hops')
+    for chip_key, parent, regs in network(records):
+        print(chip_key,'\t parent: ',parent)
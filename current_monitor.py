@@ -0,0 +1,124 @@
+import math
+
+import network_state
+
+RAILS=['idda', 'iddd']
+
+
+
+class RunningStats:
+    # Welford running mean / variance
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self, x):
+        self.n += 1
+        delta = x-self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(x-self.mean)
+
+    def std(self):
+        if self.n<2: return 0.
+        return math.sqrt(self.m2/(self.n-1))
+
+
+
+class CurrentMonitor:
+    # Per-hop IDDA/IDDD fingerprinting. read(pacman_tile) returns the tile
+    # (IDDA, IDDD) [mA]. before() samples the tile ahead of a hop, after()
+    # samples it once the hop is over, whether or not the daughter verified.
+    # Every hop is checked against limit_ma [IDDA, IDDD]; the step of a
+    # verified hop is also compared with the running model of committed
+    # hops on that tile and is anomalous once min_hops are in and it is
+    # further than max(n_sigma*std, floor_ma) from the mean step.
+    # Anomalous steps are returned for the caller to flag or, with abort,
+    # undo; only normal steps enter the model and the per-chip fingerprints.
+    def __init__(self, read, n_sigma=5., floor_ma=5., limit_ma=None, \
+                 min_hops=5, abort=False):
+        self.read = read
+        self.n_sigma = n_sigma
+        self.floor_ma = floor_ma
+        self.limit_ma = limit_ma
+        self.min_hops = min_hops
+        self.abort = abort
+        self.steps = {}        # pacman tile -> [RunningStats per rail]
+        self.baseline = {}     # pacman tile -> (IDDA, IDDD) before the hop
+        self.fingerprints = {} # chip key -> (dIDDA, dIDDD) [mA]
+        self.anomalies = []
+
+    def tile(self, chip_key):
+        return network_state.tile_index(chip_key.io_channel)+1
+
+    def before(self, chip_key):
+        tile = self.tile(chip_key)
+        self.baseline[tile] = self.read(tile)
+
+    def expected(self, chip_key):
+        # (mean, allowed deviation) of the next step per rail, None while
+        # the model has too few hops
+        stats = self.steps.get(self.tile(chip_key))
+        if stats is None or stats[0].n<self.min_hops: return None
+        return [(s.mean, max(self.n_sigma*s.std(), self.floor_ma)) for s in stats]
+
+    def after(self, chip_key, verified=True):
+        tile = self.tile(chip_key)
+        current = self.read(tile)
+        if tile not in self.baseline: self.baseline[tile] = current
+        step = [c-b for c, b in zip(current, self.baseline[tile])]
+        reasons = []
+        if self.limit_ma is not None:
+            for rail, c, limit in zip(RAILS, current, self.limit_ma):
+                if limit is not None and c>limit:
+                    reasons.append('{} {:.1f} mA above limit {:.1f} mA'.format(\
+                                   rail, c, limit))
+        expected = self.expected(chip_key) if verified else None
+        if expected is not None:
+            for rail, s, (mean, allowed) in zip(RAILS, step, expected):
+                if abs(s-mean)>allowed:
+                    reasons.append('{} step {:+.1f} mA, expected {:+.1f}+-{:.1f} mA'\
+                                   .format(rail, s, mean, allowed))
+        self.baseline[tile] = current
+        if len(reasons)>0:
+            anomaly = dict(chip=str(chip_key), current=current, step=step, \
+                           reasons=reasons)
+            self.anomalies.append(anomaly)
+            return anomaly
+        if not verified: return None
+        stats = self.steps.setdefault(tile, [RunningStats() for r in RAILS])
+        for st, s in zip(stats, step): st.add(s)
+        self.fingerprints[chip_key] = tuple(step)
+        return None
+
+    def over_limit(self, anomaly):
+        return any(['above limit' in r for r in anomaly['reasons']])
+
+    def report(self):
+        return {'steps':dict([(tile, [(s.n, s.mean, s.std()) for s in stats]) \
+                              for tile, stats in self.steps.items()]), \
+                'fingerprints':dict([(str(k), v) for k, v \
+                                     in self.fingerprints.items()]), \
+                'anomalies':self.anomalies}
+
+
+
+_monitor=None
+
+
+
+def active():
+    return _monitor
+
+
+
+def configure(read, **kwargs):
+    global _monitor
+    _monitor = CurrentMonitor(read, **kwargs)
+    return _monitor
+
+
+
+def stop():
+    global _monitor
+    _monitor = None
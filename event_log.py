@@ -0,0 +1,154 @@
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+
+DEBUG=10
+INFO=20
+WARNING=30
+ERROR=40
+_names = {DEBUG:'DEBUG', INFO:'INFO', WARNING:'WARNING', ERROR:'ERROR'}
+
+_log=None
+
+
+
+def _format(name, fields):
+    return name+'\t'+'  '.join(['{}={}'.format(k, v) for k, v in fields.items()])
+
+
+
+class EventLog:
+    # Structured events with levels. event() only timestamps the record and
+    # puts it on a queue; a writer thread serializes every record as one
+    # JSON line to filename (if any) and prints those at or above
+    # console_level as a one-line summary. Field values are serialized
+    # later on the writer thread, so pass copies of anything mutable.
+    def __init__(self, filename=None, console_level=INFO):
+        self.filename = filename
+        self.console_level = console_level
+        self.file = open(filename, 'a') if filename is not None else None
+        self.queue = queue.Queue()
+        self.counts = collections.Counter()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def event(self, level, name, fields):
+        self.queue.put((time.time(), level, name, fields))
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                self.queue.task_done()
+                break
+            t, level, name, fields = record
+            self.counts[(level, name)] += 1
+            if self.file is not None:
+                self.file.write(json.dumps(dict(t=round(t, 6), \
+                                                level=_names.get(level, level), \
+                                                event=name, **fields), \
+                                           default=str)+'\n')
+            if level>=self.console_level: print(_format(name, fields))
+            if self.queue.empty() and self.file is not None: self.file.flush()
+            self.queue.task_done()
+
+    def flush(self):
+        # wait until everything queued so far is written
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.file is not None: self.file.close()
+
+    def summary(self):
+        counts = collections.Counter()
+        for (level, name), n in self.counts.items():
+            if level>=INFO: counts[name] += n
+        return counts
+
+
+
+def open_log(filename=None, console_level=INFO):
+    global _log
+    if _log is not None: _log.close()
+    _log = EventLog(filename, console_level)
+    return _log
+
+
+
+def close_log():
+    # print a count of every INFO-and-above event, then stop the writer
+    global _log
+    if _log is None: return
+    _log.flush()
+    counts = _log.summary()
+    _log.close()
+    if len(counts)>0:
+        print('EVENTS\t'+'  '.join(['{}={}'.format(k, v) for k, v \
+                                    in sorted(counts.items())]))
+    _log = None
+
+
+
+def active():
+    return _log
+
+
+
+def flush():
+    # call before anything printed synchronously, e.g. an input() prompt
+    if _log is not None: _log.flush()
+
+
+
+def event(level, name, **fields):
+    # without an open log, events are printed directly (DEBUG events are
+    # only raised by verbose callers)
+    if _log is not None: _log.event(level, name, fields)
+    else: print(_format(name, fields))
+
+
+
+def debug(name, **fields):
+    event(DEBUG, name, **fields)
+
+
+
+def info(name, **fields):
+    event(INFO, name, **fields)
+
+
+
+def warning(name, **fields):
+    event(WARNING, name, **fields)
+
+
+
+def error(name, **fields):
+    event(ERROR, name, **fields)
+
+
+
+def load(filename):
+    with open(filename, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str, \
+                        help='''Event log written with networking.py --eventLog''')
+    parser.add_argument('--event', default=None, type=str, \
+                        help='''Only print events of this name''')
+    args = parser.parse_args()
+    records = load(args.filename)
+    counts = collections.Counter([r['event'] for r in records])
+    for name, n in sorted(counts.items()): print(name,'\t',n)
+    if args.event is not None:
+        for r in records:
+            if r['event']==args.event: print(json.dumps(r))
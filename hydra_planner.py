@@ -0,0 +1,121 @@
+import argparse
+import json
+
+import network_state
+
+# chip id offset of the neighbour reached through each PISO
+_piso_offset={0:-1, 1:10, 2:1, 3:-10}
+
+
+
+def load_link_map(filename):
+    # known-good chips and known-bad parent->daughter links per
+    # (io_group, tile) from a network JSON written by write_network_to_file
+    with open(filename,'r') as f: d = json.load(f)
+    good, bad = {}, {}
+    for io_group, io_channels in d["network"].items():
+        if not isinstance(io_channels, dict): continue
+        for ioc, spec in io_channels.items():
+            tile = (int(io_group), network_state.tile_index(int(ioc)))
+            chips = good.setdefault(tile, set())
+            for node in spec["nodes"]:
+                if isinstance(node["chip_id"], int): chips.add(node["chip_id"])
+    for io_group, io_channels in d.get("missing", {}).items():
+        for ioc, daughters in io_channels.items():
+            tile = (int(io_group), network_state.tile_index(int(ioc)))
+            for daughter_id, pisos in daughters.items():
+                for piso in pisos:
+                    parent_id = int(daughter_id)+_piso_offset[piso]
+                    bad.setdefault(tile, set()).add((parent_id, int(daughter_id)))
+    return good, bad
+
+
+
+def plan_forest(roots, good, bad=set()):
+    # Spanning forest over the known-good chips of one tile.
+    # roots maps io_channel -> root chip id. A multi-source breadth-first
+    # search gives every chip its minimum possible hydra depth, so the
+    # maximum depth is minimal; ties between candidate parents go to the
+    # io_channel with fewer chips so far, then to the parent with fewer
+    # daughters. Returns hops [(io_channel, parent_id, daughter_id)] in an
+    # order where every parent precedes its daughters, and the assignment
+    # {chip_id: (io_channel, depth)}.
+    assigned = {}
+    count = dict([(ioc, 1) for ioc in roots])
+    children = {}
+    layer = []
+    for ioc, chip_id in sorted(roots.items()):
+        assigned[chip_id] = (ioc, 1)
+        layer.append(chip_id)
+    hops = []
+    depth = 1
+    while len(layer)>0:
+        depth += 1
+        candidates = {}
+        for parent_id in layer:
+            for chip_id in network_state.neighbour_chip_ids(parent_id):
+                if chip_id in assigned or chip_id not in good: continue
+                if (parent_id, chip_id) in bad: continue
+                candidates.setdefault(chip_id, []).append(parent_id)
+        layer = []
+        for chip_id in sorted(candidates, key=lambda i: (len(candidates[i]), i)):
+            parent_id = min(candidates[chip_id], \
+                            key=lambda p: (count[assigned[p][0]], \
+                                           children.get(p, 0), p))
+            ioc = assigned[parent_id][0]
+            assigned[chip_id] = (ioc, depth)
+            count[ioc] += 1
+            children[parent_id] = children.get(parent_id, 0)+1
+            hops.append((ioc, parent_id, chip_id))
+            layer.append(chip_id)
+    return hops, assigned
+
+
+
+def summarize(assigned):
+    summary = {}
+    for chip_id, (ioc, depth) in assigned.items():
+        n, max_depth = summary.get(ioc, (0, 0))
+        summary[ioc] = (n+1, max(max_depth, depth))
+    return summary
+
+
+
+def plan_network(filename, io_group, root_keys):
+    # hops [(io_group, io_channel, parent_id, daughter_id)] for every tile
+    # with a configured root, planned tile by tile
+    good, bad = load_link_map(filename)
+    tiles = {}
+    for rk in root_keys:
+        tiles.setdefault(network_state.tile_index(rk.io_channel), {})[rk.io_channel] = rk.chip_id
+    plan = []
+    for tile, roots in sorted(tiles.items()):
+        chips = good.get((io_group, tile), set()) | set(roots.values())
+        hops, assigned = plan_forest(roots, chips, bad.get((io_group, tile), set()))
+        for ioc, (n, max_depth) in sorted(summarize(assigned).items()):
+            print('PLAN io_channel ',ioc,'\t chips: ',n,'\t max depth: ',max_depth)
+        plan += [(io_group, ioc, parent_id, chip_id) \
+                 for ioc, parent_id, chip_id in hops]
+    return plan
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str, \
+                        help='''Network JSON written by networking.py''')
+    parser.add_argument('--roots', default='21,41,71,91', type=str, \
+                        help='''Comma separated root chip IDs, one per \
+                        io_channel of the tile''')
+    parser.add_argument('--firstIoChannel', default=1, type=int, \
+                        help='''io_channel of the first root''')
+    args = parser.parse_args()
+    good, bad = load_link_map(args.filename)
+    roots = dict([(args.firstIoChannel+i, int(r)) \
+                  for i, r in enumerate(args.roots.split(','))])
+    tile = (list(good)[0][0], network_state.tile_index(args.firstIoChannel))
+    hops, assigned = plan_forest(roots, good.get(tile, set()) | set(roots.values()), \
+                                 bad.get(tile, set()))
+    for ioc, (n, max_depth) in sorted(summarize(assigned).items()):
+        print('io_channel ',ioc,'\t chips: ',n,'\t max depth: ',max_depth)
+    for hop in hops: print(hop)
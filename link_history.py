@@ -0,0 +1,191 @@
+import argparse
+import sqlite3
+import time
+
+import network_state
+
+# parent chip id recorded for a root chip configured straight from PACMAN
+ROOT=0
+
+_schema='''
+CREATE TABLE IF NOT EXISTS runs (
+    run INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL, finished REAL, serials TEXT,
+    n_configured INTEGER, n_missing INTEGER);
+CREATE TABLE IF NOT EXISTS hops (
+    run INTEGER, serial TEXT, io_channel INTEGER,
+    parent INTEGER, daughter INTEGER, ok INTEGER, t REAL);
+CREATE INDEX IF NOT EXISTS hops_link ON hops (serial, parent, daughter);
+'''
+
+
+
+class LinkHistory:
+    # SQLite history of every root and parent -> daughter hop outcome, per
+    # tile serial. serials maps (io_group, tile index) -> serial so the
+    # same physical tile is recognised whichever PACMAN it is plugged into.
+    # A link is known dead once it failed in dead_after different runs
+    # without ever succeeding; parents are ranked by their Laplace-smoothed
+    # success rate so links never tried sit between good and bad ones.
+    def __init__(self, filename, serials, dead_after=3):
+        self.filename = filename
+        self.serials = dict(serials)
+        self.dead_after = dead_after
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(_schema)
+        cursor = self.db.execute('INSERT INTO runs (started, serials) VALUES (?,?)', \
+                                 (time.time(), ','.join(sorted(set(self.serials.values())))))
+        self.run = cursor.lastrowid
+        self.db.commit()
+        self.stats = dict([(serial, self.link_stats(serial)) \
+                           for serial in set(self.serials.values())])
+
+    def serial(self, chip_key):
+        tile = (chip_key.io_group, network_state.tile_index(chip_key.io_channel))
+        return self.serials.get(tile)
+
+    def record(self, parent, daughter, ok):
+        # committed immediately so a crashed run still leaves its history
+        serial = self.serial(daughter)
+        if serial is None: return
+        parent_id = ROOT if parent is None else parent.chip_id
+        self.db.execute('INSERT INTO hops VALUES (?,?,?,?,?,?,?)', \
+                        (self.run, serial, daughter.io_channel, parent_id, \
+                         daughter.chip_id, int(bool(ok)), time.time()))
+        self.db.commit()
+
+    def finish(self, n_configured, n_missing):
+        self.db.execute('UPDATE runs SET finished=?, n_configured=?, n_missing=? '\
+                        'WHERE run=?', (time.time(), n_configured, n_missing, self.run))
+        self.db.commit()
+        self.db.close()
+
+    def link_stats(self, serial):
+        # {(parent_id, daughter_id): (n_ok, n_fail, runs failed)} over
+        # earlier runs only, so this run's outcomes do not feed back into it
+        rows = self.db.execute('SELECT parent, daughter, SUM(ok), SUM(1-ok), '\
+                               'COUNT(DISTINCT CASE WHEN ok=0 THEN run END) '\
+                               'FROM hops WHERE serial=? AND run<? '\
+                               'GROUP BY parent, daughter', (serial, self.run))
+        return dict([((p, d), (n_ok, n_fail, n_runs)) \
+                     for p, d, n_ok, n_fail, n_runs in rows])
+
+    def dead_links(self, serial):
+        return sorted([link for link, (n_ok, n_fail, n_runs) \
+                       in self.stats.get(serial, {}).items() \
+                       if n_ok==0 and n_runs>=self.dead_after])
+
+    def link_score(self, serial, parent_id, daughter_id):
+        n_ok, n_fail, n_runs = self.stats.get(serial, {}) \
+                                   .get((parent_id, daughter_id), (0, 0, 0))
+        return (n_ok+1.)/(n_ok+n_fail+2.)
+
+    def score(self, parent, daughter_id):
+        return self.link_score(self.serial(parent), parent.chip_id, daughter_id)
+
+    def order_parents(self, parents, daughter_id):
+        # stable, so parents with equal scores keep the caller's order
+        return sorted(parents, key=lambda p: -self.score(p, daughter_id))
+
+    def order_roots(self, io_group, candidates):
+        # {io_channel: [chip_id, ...]} with root candidates that came up in
+        # earlier runs first
+        ordered = {}
+        for ioc, chip_ids in candidates.items():
+            serial = self.serials.get((io_group, network_state.tile_index(ioc)))
+            ordered[ioc] = sorted(chip_ids, \
+                                  key=lambda i: -self.link_score(serial, ROOT, i))
+        return ordered
+
+    def prime(self, policy):
+        # open the retry policy circuit on every known-dead parent -> daughter
+        # link; roots are only recorded since each io_channel has one
+        n = 0
+        for (io_group, tile), serial in sorted(self.serials.items()):
+            for parent_id, daughter_id in self.dead_links(serial):
+                if parent_id==ROOT: continue
+                target = '{}-tile{}-{}->{}'.format(io_group, tile, parent_id, daughter_id)
+                policy.kill(target, 'history: failed in {} runs on {}'\
+                            .format(self.stats[serial][(parent_id, daughter_id)][2], serial))
+                n += 1
+        return n
+
+
+
+_history=None
+
+
+
+def active():
+    return _history
+
+
+
+def open_history(filename, serials, dead_after=3):
+    global _history
+    _history = LinkHistory(filename, serials, dead_after)
+    return _history
+
+
+
+def close_history(n_configured, n_missing):
+    global _history
+    if _history is None: return
+    _history.finish(n_configured, n_missing)
+    _history = None
+
+
+
+def record(parent, daughter, ok):
+    if _history is None: return
+    _history.record(parent, daughter, ok)
+
+
+
+def order_parents(parents, daughter_id):
+    if _history is None: return parents
+    return _history.order_parents(parents, daughter_id)
+
+
+
+def order_roots(io_group, candidates):
+    if _history is None: return candidates
+    return _history.order_roots(io_group, candidates)
+
+
+
+def tile_serials(io_group, io_channels, serials=None):
+    # {(io_group, tile): serial}; serials is a comma separated list in tile
+    # order, tiles without one are named after their PACMAN position
+    tiles = sorted(set([network_state.tile_index(ioc) for ioc in io_channels]))
+    names = [] if serials is None else serials.split(',')
+    d = {}
+    for i, tile in enumerate(tiles):
+        if i<len(names) and len(names[i])>0: d[(io_group, tile)] = names[i]
+        else: d[(io_group, tile)] = 'pacman{}-tile{}'.format(io_group, tile+1)
+    return d
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str, help='''Link history database''')
+    parser.add_argument('--serial', default=None, type=str, \
+                        help='''Tile serial (default: all)''')
+    parser.add_argument('--deadAfter', default=3, type=int, \
+                        help='''Failed runs before a link is known dead''')
+    args = parser.parse_args()
+    db = sqlite3.connect(args.filename)
+    for run, started, serials, n_configured, n_missing in \
+        db.execute('SELECT run, started, serials, n_configured, n_missing FROM runs'):
+        print('run ',run,'\t',time.strftime('%Y-%m-%d %H:%M', time.localtime(started)), \
+              '\t',serials,'\t configured: ',n_configured,'\t missing: ',n_missing)
+    query = 'SELECT serial, parent, daughter, SUM(ok), SUM(1-ok), '\
+            'COUNT(DISTINCT CASE WHEN ok=0 THEN run END) FROM hops'
+    if args.serial is not None: query += ' WHERE serial=?'
+    query += ' GROUP BY serial, parent, daughter HAVING SUM(1-ok)>0 ORDER BY serial, daughter'
+    for serial, p, d, n_ok, n_fail, n_runs in \
+        db.execute(query, () if args.serial is None else (args.serial,)):
+        status = 'DEAD' if n_ok==0 and n_runs>=args.deadAfter else ''
+        print(serial,'\t',('root' if p==ROOT else p),'->',d,'\t ok: ',n_ok, \
+              '\t failed: ',n_fail,'\t',status)
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+import larpix
+
+# counter index in LiveCounters.counts
+PACKETS=0
+DATA=1
+CONFIG_READ=2
+PARITY_ERRORS=3
+_names=['packets', 'data', 'config_read', 'parity_errors']
+_shape=(len(_names), 16, 64, 256) # counter, io_group, io_channel, chip_id
+
+
+
+class LiveCounters:
+    # Per (io_group, io_channel, chip_id) packet counters in preallocated
+    # arrays, fed from c.read (and so the HDF5Logger path) or from decoded
+    # readout arrays. A daemon thread takes a snapshot every interval
+    # seconds: rates over the last interval for every chip that sent
+    # anything, per io_channel totals, the hottest chips, chips with parity
+    # errors and expected chips that went silent. Snapshots are written
+    # atomically to filename and served to clients of the unix socket.
+    def __init__(self, interval=5., filename=None, path=None, n_hot=5):
+        self.counts = np.zeros(_shape, dtype=np.uint64)
+        self.previous = np.zeros(_shape, dtype=np.uint64)
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.filename = filename
+        self.path = path
+        self.n_hot = n_hot
+        self.expected = set()
+        self.snapshot = {}
+        self.stopping = threading.Event()
+        self.last = time.time()
+        self.thread = None
+        self.server = None
+
+    def expect(self, chip_keys):
+        # chips that should be sending; silent ones are listed in snapshots
+        self.expected = set([(k.io_group, k.io_channel, k.chip_id) \
+                             for k in chip_keys])
+
+    def update_packets(self, packets):
+        rows = [(p.io_group, p.io_channel, p.chip_id, p.packet_type, \
+                 p.has_valid_parity()) for p in packets \
+                if isinstance(p, larpix.Packet_v2) and p.io_group is not None]
+        if len(rows)==0: return
+        rows = np.array(rows, dtype=np.int64)
+        self._update(rows[:,0], rows[:,1], rows[:,2], rows[:,3], rows[:,4])
+
+    def update_array(self, rows):
+        # structured array in the LArPix+HDF5 packets dtype
+        rows = rows[rows['packet_type']<4]
+        if len(rows)==0: return
+        self._update(rows['io_group'], rows['io_channel'], rows['chip_id'], \
+                     rows['packet_type'], rows['valid_parity'])
+
+    def _update(self, io_group, io_channel, chip_id, packet_type, valid_parity):
+        index = (io_group%_shape[1], io_channel%_shape[2], chip_id)
+        with self.lock:
+            np.add.at(self.counts[PACKETS], index, 1)
+            data = packet_type==0
+            np.add.at(self.counts[DATA], tuple(i[data] for i in index), 1)
+            read = packet_type==3
+            np.add.at(self.counts[CONFIG_READ], tuple(i[read] for i in index), 1)
+            bad = valid_parity==0
+            np.add.at(self.counts[PARITY_ERRORS], tuple(i[bad] for i in index), 1)
+
+    def take_snapshot(self):
+        with self.lock: counts = self.counts.copy()
+        now = time.time()
+        dt = max(now-self.last, 1e-9)
+        delta = counts-self.previous
+        self.previous, self.last = counts, now
+        chips = {}
+        for g, ch, chip_id in zip(*np.nonzero(counts[PACKETS])):
+            d = dict([(name, int(counts[i, g, ch, chip_id])) \
+                      for i, name in enumerate(_names)])
+            d['rate'] = round(float(delta[PACKETS, g, ch, chip_id])/dt, 3)
+            d['parity_error_rate'] = \
+                round(float(delta[PARITY_ERRORS, g, ch, chip_id])/dt, 3)
+            chips['{}-{}-{}'.format(g, ch, chip_id)] = d
+        io_channels = {}
+        for g, ch in zip(*np.nonzero(delta[PACKETS].sum(axis=2))):
+            io_channels['{}-{}'.format(g, ch)] = \
+                round(float(delta[PACKETS, g, ch].sum())/dt, 3)
+        hot = sorted(chips, key=lambda k: -chips[k]['rate'])[:self.n_hot]
+        silent = ['{}-{}-{}'.format(*k) for k in sorted(self.expected) \
+                  if delta[PACKETS, k[0]%_shape[1], k[1]%_shape[2], k[2]]==0]
+        snapshot = {'time':round(now, 3), 'interval':round(dt, 3), \
+                    'chips':chips, 'io_channels':io_channels, \
+                    'hot':[k for k in hot if chips[k]['rate']>0], \
+                    'parity_errors':[k for k in chips \
+                                     if chips[k]['parity_error_rate']>0], \
+                    'silent':silent}
+        self.snapshot = snapshot
+        if self.filename is not None:
+            with open(self.filename+'.tmp', 'w') as f: json.dump(snapshot, f)
+            os.replace(self.filename+'.tmp', self.filename)
+        return snapshot
+
+    def _run(self):
+        while not self.stopping.wait(self.interval): self.take_snapshot()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        if self.path is not None:
+            if os.path.exists(self.path): os.remove(self.path)
+            self.server = socketserver.ThreadingUnixStreamServer(self.path, \
+                                                                 _SnapshotHandler)
+            self.server.daemon_threads = True
+            self.server.counters = self
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None: self.thread.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            if os.path.exists(self.path): os.remove(self.path)
+        return self.take_snapshot()
+
+
+
+class _SnapshotHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write((json.dumps(self.server.counters.snapshot)+'\n').encode())
+
+
+
+_counters=None
+
+
+
+def active():
+    return _counters
+
+
+
+def start(interval=5., filename=None, path=None):
+    global _counters
+    if _counters is not None: _counters.stop()
+    _counters = LiveCounters(interval, filename, path).start()
+    return _counters
+
+
+
+def stop():
+    global _counters
+    if _counters is None: return None
+    snapshot = _counters.stop()
+    _counters = None
+    return snapshot
+
+
+
+def attach(c):
+    # no-op unless counters were started; count every packet c.read returns
+    if _counters is None or getattr(c, '_live_counters', False): return c
+    counters = _counters
+    read = c.read
+    def counted_read():
+        packets, bytestream = read()
+        counters.update_packets(packets)
+        return packets, bytestream
+    c.read = counted_read
+    c._live_counters = True
+    return c
+
+
+
+def request(path, timeout=5):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    s.connect(path)
+    reply = s.makefile('r').readline()
+    s.close()
+    return json.loads(reply)
+
+
+
+def summarize(snapshot):
+    print('interval: ',snapshot.get('interval'),' s')
+    for k, rate in sorted(snapshot.get('io_channels', {}).items()):
+        print('io_channel ',k,'\t rate: ',rate,' Hz')
+    for k in snapshot.get('hot', []):
+        print('HOT ',k,'\t',snapshot['chips'][k])
+    for k in snapshot.get('parity_errors', []):
+        print('PARITY ',k,'\t',snapshot['chips'][k])
+    if len(snapshot.get('silent', []))>0:
+        print('SILENT ',snapshot['silent'])
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', type=str, \
+                        help='''Counters socket or snapshot file of a \
+                        running networking.py''')
+    parser.add_argument('--watch', default=None, type=float, \
+                        help='''Repeat every this many seconds''')
+    args = parser.parse_args()
+    while True:
+        if os.path.isfile(args.source):
+            with open(args.source, 'r') as f: summarize(json.load(f))
+        else: summarize(request(args.source))
+        if args.watch is None: break
+        time.sleep(args.watch)
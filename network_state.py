@@ -0,0 +1,161 @@
+import larpix
+
+_chip_ids=range(11,111)
+_parent_offsets=[10,-10,1,-1]
+
+
+
+def tile_index(io_channel):
+    # four io_channels per tile; chip ids repeat on every tile
+    return (io_channel-1)//4
+
+
+
+def neighbour_chip_ids(chip_id, chip_ids=_chip_ids):
+    # grid neighbours in potential-parent order, without wrapping across rows
+    neighbours=[]
+    for i in _parent_offsets:
+        if chip_id%10==0 and (chip_id+i)%10==1: continue
+        if (chip_id+i)%10==0 and chip_id%10==1: continue
+        if chip_id+i in chip_ids: neighbours.append(chip_id+i)
+    return neighbours
+
+
+
+class NetworkState:
+    # Incrementally maintained index of the chips in the hydra network.
+    # Chips are identified per tile as (io_group, tile, chip_id) so several
+    # tiles can share one process (and one io_group).
+    def __init__(self, chip_ids=_chip_ids):
+        self.chip_ids = chip_ids
+        self.neighbours = dict([(i, neighbour_chip_ids(i, chip_ids)) \
+                                for i in chip_ids])
+        self.by_io_channel = {}  # (io_group, io_channel) -> set of chip keys
+        self.keys = {}           # (io_group, tile, chip_id) -> chip key
+        self.parent = {}         # chip key -> parent chip key, None for roots
+        self.children = {}       # chip key -> set of daughter chip keys
+        self.missing = {}        # (io_group, tile) -> set of chip ids
+        self.frontier = {}       # (io_group, tile) -> missing ids next to network
+        self.pending = {}        # (io_group, tile, chip_id) -> untried parents
+
+    def add_tile(self, io_group, io_channels):
+        for ioc in io_channels:
+            self.by_io_channel.setdefault((io_group, ioc), set())
+            tile = (io_group, tile_index(ioc))
+            if tile in self.missing: continue
+            self.missing[tile] = set(self.chip_ids)
+            self.frontier[tile] = set()
+        return
+
+    def lookup(self, io_group, io_channel, chip_id):
+        return self.keys.get((io_group, tile_index(io_channel), chip_id))
+
+    def __contains__(self, chip_key):
+        return self.lookup(chip_key.io_group, chip_key.io_channel, \
+                           chip_key.chip_id) is not None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def io_channel_keys(self, io_group, io_channel):
+        return self.by_io_channel.get((io_group, io_channel), set())
+
+    def add(self, chip_key, parent=None):
+        if chip_key in self:
+            self.parent[chip_key] = parent
+            return
+        self.add_tile(chip_key.io_group, [chip_key.io_channel])
+        tile = (chip_key.io_group, tile_index(chip_key.io_channel))
+        self.keys[tile+(chip_key.chip_id,)] = chip_key
+        self.by_io_channel[(chip_key.io_group, chip_key.io_channel)].add(chip_key)
+        self.parent[chip_key] = parent
+        self.children[chip_key] = set()
+        if parent is not None and parent in self.children:
+            self.children[parent].add(chip_key)
+        self.missing[tile].discard(chip_key.chip_id)
+        self.frontier[tile].discard(chip_key.chip_id)
+        self.pending.pop(tile+(chip_key.chip_id,), None)
+        for chip_id in self.neighbours.get(chip_key.chip_id, []):
+            if chip_id not in self.missing[tile]: continue
+            self.frontier[tile].add(chip_id)
+            self.pending.setdefault(tile+(chip_id,), []).append(chip_key)
+        return
+
+    def remove(self, chip_key):
+        if chip_key not in self: return
+        tile = (chip_key.io_group, tile_index(chip_key.io_channel))
+        chip_key = self.keys.pop(tile+(chip_key.chip_id,))
+        self.by_io_channel[(chip_key.io_group, chip_key.io_channel)].discard(chip_key)
+        parent = self.parent.pop(chip_key)
+        if parent in self.children: self.children[parent].discard(chip_key)
+        for child in self.children.pop(chip_key):
+            if child in self.parent: self.parent[child] = None
+        self.missing[tile].add(chip_key.chip_id)
+        for chip_id in [chip_key.chip_id]+self.neighbours.get(chip_key.chip_id, []):
+            if chip_id not in self.missing[tile]: continue
+            parents = self.potential_parents(chip_key.io_group, \
+                                             chip_key.io_channel, chip_id)
+            if len(parents)==0: self.frontier[tile].discard(chip_id)
+            else: self.frontier[tile].add(chip_id)
+            untried = self.pending.get(tile+(chip_id,))
+            if untried is not None and chip_key in untried:
+                untried.remove(chip_key)
+                if len(untried)==0: del self.pending[tile+(chip_id,)]
+        return
+
+    def potential_parents(self, io_group, io_channel, chip_id):
+        tile = (io_group, tile_index(io_channel))
+        parents=[]
+        for i in self.neighbours.get(chip_id, []):
+            if tile+(i,) in self.keys: parents.append(self.keys[tile+(i,)])
+        return parents
+
+    def waitlist(self):
+        # (io_group, tile, chip_id) of every chip not yet in the network
+        return [tile+(chip_id,) for tile in sorted(self.missing) \
+                for chip_id in sorted(self.missing[tile])]
+
+    def take_pending(self):
+        # frontier chips with the parents added since the last call
+        pending = self.pending
+        self.pending = {}
+        for (io_group, tile, chip_id), parents in pending.items():
+            order = self.neighbours[chip_id]
+            parents.sort(key=lambda parent: order.index(parent.chip_id))
+        return pending
+
+    def requeue(self):
+        # queue every missing chip for another waitlist pass against all of
+        # its potential parents, e.g. to repair a network built earlier
+        for (io_group, tile), missing in self.missing.items():
+            for chip_id in missing:
+                parents = [self.keys[(io_group, tile, i)] for i \
+                           in self.neighbours[chip_id] \
+                           if (io_group, tile, i) in self.keys]
+                if len(parents)>0: self.pending[(io_group, tile, chip_id)] = parents
+        return
+
+    def subtree(self, chip_key):
+        # chip_key and all chips configured through it
+        chips, stack = [], [chip_key]
+        while len(stack)>0:
+            chip_key = stack.pop()
+            chips.append(chip_key)
+            stack += list(self.children.get(chip_key, ()))
+        return chips
+
+    def depth(self, chip_key):
+        depth = 0
+        while chip_key is not None and depth<=len(self.keys):
+            depth += 1
+            chip_key = self.parent.get(chip_key)
+        return depth
+
+
+
+def from_controller(c):
+    # index of an existing controller's chips, without parent relations
+    state = NetworkState()
+    for chip_key in c.chips:
+        state.add(larpix.key.Key(chip_key))
+    return state
@@ -6,6 +6,21 @@ import time
 import json
 import re
 import serial
+import packet_trace
+import network_state
+import retry_policy
+import waitlist_rules
+import hydra_planner
+import readout
+import live_counters
+import link_history
+import read_buffer
+import tile_program
+import checkpoint_journal
+import pacman_connection
+import event_log
+import analyze_hdf5
+import current_monitor
 
 _default_logger=True #False
 _default_pacmanTile=2
@@ -22,6 +37,42 @@ _default_enable_ana_mon=False
 _default_read=False
 _default_broadcastRead=False
 _default_enableSerial=False
+_default_trace=None
+_default_monitorChips=None
+_default_monitorTime=3600
+_default_minInterval=0.5
+_default_maxInterval=30
+_default_driftThreshold=0.01
+_default_stableWindow=300
+_default_retryAttempts=None
+_default_retryBackoff=0.
+_default_chipFailures=None
+_default_linkFailures=None
+_default_waitlistRules=None
+_default_controlSocket=None
+_default_plan=None
+_default_readoutTime=None
+_default_readoutWorkers=4
+_default_countersFile=None
+_default_countersSocket=None
+_default_countersInterval=5.
+_default_history=None
+_default_tileSerial=None
+_default_readBuffer=None
+_default_readRetention=256
+_default_disableSettle=5
+_default_settleThreshold=None
+_default_verifyPower=False
+_default_journal=None
+_default_resume=None
+_default_eventLog=None
+_default_analyze=False
+_default_currentMonitor=None
+_default_currentSigma=5.
+_default_currentFloor=5.
+_default_iddaLimit=None
+_default_idddLimit=None
+_default_rootWiring=None
 
 def reconcile_configuration(c, chip_keys, verbose, \
                             timeout=0.1, connection_delay=0.01, \
@@ -37,33 +88,36 @@ def reconcile_configuration(c, chip_keys, verbose, \
 
 
 
+@packet_trace.traced
 def reconcile_registers(c, chip_key_register_pairs, verbose, timeout=1, \
                         connection_delay=0.02, n=1, n_verify=1):
+    policy = retry_policy.active()
+    n = policy.attempts(n)
     ok, diff = c.verify_registers(chip_key_register_pairs, timeout=timeout, \
                                   connection_delay=connection_delay,
                                   n=n_verify)
-    if diff!={}:
-        flag = True
-        for a in diff.keys():
-            if flag == False: break
-            for b in diff[a].keys():
-                pair = diff[a][b]
-                if verbose: print(a,'\t',n,':\t',b,'\t',pair)
-                if pair[1]==None: flag=False; break
-    if not ok:
+    for attempt in range(n):
+        if diff!={}:
+            flag = True
+            for a in diff.keys():
+                if flag == False: break
+                for b in diff[a].keys():
+                    pair = diff[a][b]
+                    if verbose: event_log.debug('register_diff', chip=a, \
+                                                attempts_left=n-attempt, \
+                                                register=b, diff=pair)
+                    if pair[1]==None: flag=False; break
+        if ok: break
+        if attempt>0: policy.wait(attempt-1)
         chip_key_register_pairs = [(chip_key, register) \
                                    for chip_key in diff \
                                    for register in diff[chip_key]]
         c.multi_write_configuration(chip_key_register_pairs, write_read=0, \
                                     connection_delay=connection_delay)
-        if n!=1: ok,diff = reconcile_registers(c, chip_key_register_pairs, \
-                                               verbose, timeout=timeout,
-                                               connection_delay=connection_delay, \
-                                               n=n-1, n_verify=n_verify)
-        else: ok, diff = c.verify_registers(chip_key_register_pairs, \
-                                            timeout=timeout, \
-                                            connection_delay=connection_delay, \
-                                            n=n_verify)
+        ok, diff = c.verify_registers(chip_key_register_pairs, \
+                                      timeout=timeout, \
+                                      connection_delay=connection_delay, \
+                                      n=n_verify)
     return ok, diff
 
 
@@ -85,107 +139,94 @@ def power_registers(): # find power register addresses
 
 
 
-def report_power(a, ioGroup): # print power to screen                         
+def read_power(a, ioGroup, tile): # VDDA [mV], IDDA [mA], VDDD [mV], IDDD [mA]
     power = power_registers()
     adc_read = 0x00024001
+    val_vdda = a.get_reg(adc_read+power[tile][0], io_group=ioGroup)
+    val_idda = a.get_reg(adc_read+power[tile][1], io_group=ioGroup)
+    val_vddd = a.get_reg(adc_read+power[tile][2], io_group=ioGroup)
+    val_iddd = a.get_reg(adc_read+power[tile][3], io_group=ioGroup)
+    return ((((val_vdda>>16)>>3)*4), \
+            (((val_idda>>16)-(val_idda>>31)*65535)*500*0.001), \
+            (((val_vddd>>16)>>3)*4), \
+            (((val_iddd>>16)-(val_iddd>>31)*65535)*500*0.001))
+
+
+
+@packet_trace.traced
+def report_power(a, ioGroup): # print power to screen                         
+    power = power_registers()
     for i in power.keys():
         if i>2: continue
-        val_vdda = a.get_reg(adc_read+power[i][0], io_group=ioGroup)
-        val_idda = a.get_reg(adc_read+power[i][1], io_group=ioGroup)
-        val_vddd = a.get_reg(adc_read+power[i][2], io_group=ioGroup)
-        val_iddd = a.get_reg(adc_read+power[i][3], io_group=ioGroup)
+        vdda, idda, vddd, iddd = read_power(a, ioGroup, i)
         print('Tile ',i,
-              ' VDDA:',(((val_vdda>>16)>>3)*4),
-              'mV\tIDDA:',(((val_idda>>16)-(val_idda>>31)*65535)*500*0.001),
-              'mA\tVDDD:',(((val_vddd>>16)>>3)*4),
-              'mV\tIDDD:',(((val_iddd>>16)-(val_iddd>>31)*65535)*500*0.001),
+              ' VDDA:',vdda,
+              'mV\tIDDA:',idda,
+              'mA\tVDDD:',vddd,
+              'mV\tIDDD:',iddd,
               'mA')
     return
 
 
 
-def enable_tile(pacmanTile, resetLength, ioGroup):
-    c = larpix.Controller()
-    c.io = larpix.io.PACMAN_IO(relaxed=True)
+def connect_tile(io=None, c=None):
+    # controller on the shared, health-checked PACMAN connection (see
+    # pacman_connection.py) without touching tile power or reset; io: use
+    # this io instead, c: set up an existing controller, keeping its io
+    if c is None: c = larpix.Controller()
+    if io is not None: c.io = io
+    if c.io is None: c.io = pacman_connection.get_io()
+    else: pacman_connection.check(c.io)
+    packet_trace.attach(c)
+    live_counters.attach(c)
+    read_buffer.attach(c)
+    return c, c.io
+
+
 
-    # invert POSI/PISO polarity (specific to LArPix-v2b preproduction tile)
-    inversion_registers=[0x0301c, 0x0401c, 0x0501c, 0x0601c]
-    if pacmanTile==2: inversion_registers=[0x0701c, 0x0801c, 0x0901c, 0x0a01c]
-    if pacmanTile==0: inversion_registers+=[0x0701c, 0x0801c, 0x0901c, 0x0a01c]
-    for ir in inversion_registers:
-        c.io.set_reg(ir, 0b11, io_group=ioGroup)
+@packet_trace.traced
+def enable_tile(pacmanTile, resetLength, ioGroup, io=None, verify=False):
+    # io: reuse an open PACMAN_IO instead of connecting again
+    c, io = connect_tile(io)
 
-    # disable PACMAN UART POSI
-    c.io.set_reg(0x18, 0b0, io_group=ioGroup)
+    # invert POSI/PISO polarity, disable PACMAN UART POSI, set MCLK to
+    # 10 MHz, enable global LArPix power, set VDDA/VDDD and enable power to
+    # tile as one register program (see tile_program.py)
+    tile_ids = tile_program.tiles(pacmanTile)
+    tile_program.enable(tile_ids).run(c.io, ioGroup, verify=verify)
 
     # uncomment for reset during power on
     #c.io.reset_larpix(length=20000000, io_group=ioGroup)
-    
-    # set MCLK to 10 MHz (and clock phase shift)
-    c.io.set_reg(0x101c, 4, io_group=ioGroup)
     #c.io.set_reg(0x101c, 9, io_group=ioGroup) #setting mclk speed to 5 MHz
     #for ioc in range(5,9,1): # setting uart clock speed to 2.5 MHz
     #    c.io.set_uart_clock_ratio(ioc, 20, io_group=ioGroup)
 
-    # enable global LArPix power
-    c.io.set_reg(0x00000014, 1, io_group=ioGroup)
-    
-    vdda_dac=44500;
-    vddd_dac=28500 #41000
-    vdda_reg=0x00024130; vddd_reg=0x00024131
-    if pacmanTile==2: vdda_reg=0x00024132; vddd_reg=0x00024133
-    c.io.set_reg(vdda_reg, vdda_dac, io_group=ioGroup)
-    c.io.set_reg(vddd_reg, vddd_dac, io_group=ioGroup)
-    if pacmanTile==0:
-        vdda_reg=0x00024132; vddd_reg=0x00024133
-        c.io.set_reg(vdda_reg, vdda_dac, io_group=ioGroup)
-        c.io.set_reg(vddd_reg, vddd_dac, io_group=ioGroup)
-    
-    # enable power to tile
-    if pacmanTile==1: c.io.set_reg(0x00000010, 0b1000000001, io_group=ioGroup)
-    if pacmanTile==2: c.io.set_reg(0x00000010, 0b1000000010, io_group=ioGroup)
-    if pacmanTile==0: c.io.set_reg(0x00000010, 0b1000000011, io_group=ioGroup)
-
     time.sleep(1)
     c.io.reset_larpix(length=resetLength, io_group=ioGroup)
     report_power(c.io, ioGroup)
     return c, c.io
 
 
+@packet_trace.traced
 def enable_tile_ramping(pacmanTile, resetLength, ioGroup, \
-                        powerOnReset, ramp='vdda'):
-    c = larpix.Controller()
-    c.io = larpix.io.PACMAN_IO(relaxed=True)
+                        powerOnReset, ramp='vdda', verify=False):
+    c, io = connect_tile()
 
-    # invert POSI/PISO polarity (specific to LArPix-v2b preproduction tile)
-    inversion_registers=[0x0301c, 0x0401c, 0x0501c, 0x0601c]
-    if pacmanTile==2: inversion_registers=[0x0701c, 0x0801c, 0x0901c, 0x0a01c]
-    for ir in inversion_registers:
-        c.io.set_reg(ir, 0b11, io_group=ioGroup)
-
-    # disable PACMAN UART POSI
-    c.io.set_reg(0x18, 0b0, io_group=ioGroup)
+    # invert POSI/PISO polarity and disable PACMAN UART POSI
+    tile_ids = tile_program.tiles(pacmanTile)
+    tile_program.uart_setup(tile_ids).run(c.io, ioGroup, verify=verify)
 
     # uncomment for reset during power on
     if powerOnReset==True:
         c.io.reset_larpix(length=resetLength, io_group=ioGroup) # resetLength 2x10^7
     
-    # set MCLK to 10 MHz (and clock phase shift)
-    c.io.set_reg(0x101c, 4, io_group=ioGroup)
-
-    # enable global LArPix power
-    c.io.set_reg(0x00000014, 1, io_group=ioGroup)
-    
-    vdda_dac=44500;
-    vddd_dac=28500 #41000
-    vdda_reg=0x00024130; vddd_reg=0x00024131
-    if pacmanTile==2: vdda_reg=0x00024132; vddd_reg=0x00024133
-    c.io.set_reg(vdda_reg, 0, io_group=ioGroup)
-    c.io.set_reg(vddd_reg, 0, io_group=ioGroup)
-
-    # enable power to tile
-    if pacmanTile==1: c.io.set_reg(0x00000010, 0b1000000001, io_group=ioGroup)
-    if pacmanTile==2: c.io.set_reg(0x00000010, 0b1000000010, io_group=ioGroup)
+    # set MCLK to 10 MHz, enable global LArPix power and tile power with
+    # VDDA/VDDD at 0
+    tile_program.power_on(tile_ids, 0, 0).run(c.io, ioGroup, verify=verify)
+    vdda_dac=tile_program.VDDA_DAC
+    vddd_dac=tile_program.VDDD_DAC
+    vdda_regs=[tile_program.TILES[t]['vdda'] for t in tile_ids]
+    vddd_regs=[tile_program.TILES[t]['vddd'] for t in tile_ids]
 
     if ramp=='vdda':
         step=100 # DAC
@@ -194,7 +235,7 @@ def enable_tile_ramping(pacmanTile, resetLength, ioGroup, \
             if ctr==0: start=time.time()
             ctr+=1
             vdda+=step
-            c.io.set_reg(vdda_reg, vdda, io_group=ioGroup)
+            for r in vdda_regs: c.io.set_reg(r, vdda, io_group=ioGroup)
             time.sleep(0.01)
             if vdda>=vdda_dac: print(time.time()-start,' seconds to ramp VDDA')
         time.sleep(30)
@@ -203,7 +244,7 @@ def enable_tile_ramping(pacmanTile, resetLength, ioGroup, \
             if ctr==0: start=time.time()
             ctr+=1
             vddd+=step
-            c.io.set_reg(vddd_reg, vddd, io_group=ioGroup)
+            for r in vddd_regs: c.io.set_reg(r, vddd, io_group=ioGroup)
             time.sleep(0.02)
             if vddd>=vddd_dac: print(time.time()-start,' seconds to ramp VDDD')
 
@@ -214,7 +255,7 @@ def enable_tile_ramping(pacmanTile, resetLength, ioGroup, \
             if ctr==0: start=time.time()
             ctr+=1
             vddd+=step
-            c.io.set_reg(vddd_reg, vddd, io_group=ioGroup)
+            for r in vddd_regs: c.io.set_reg(r, vddd, io_group=ioGroup)
             time.sleep(0.02)
             if vddd>=vddd_dac: print(time.time()-start,' seconds to ramp VDDD')
         time.sleep(30)
@@ -223,7 +264,7 @@ def enable_tile_ramping(pacmanTile, resetLength, ioGroup, \
             if ctr==0: start=time.time()
             ctr+=1
             vdda+=step
-            c.io.set_reg(vdda_reg, vdda, io_group=ioGroup)
+            for r in vdda_regs: c.io.set_reg(r, vdda, io_group=ioGroup)
             time.sleep(0.01)
             if vdda>=vdda_dac: print(time.time()-start,' seconds to ramp VDDA')
 
@@ -234,9 +275,11 @@ def enable_tile_ramping(pacmanTile, resetLength, ioGroup, \
             if ctr==0: start=time.time()
             ctr+=1
             vddd+=step_vddd; vdda+=step_vdda
-            if vddd<=vddd_dac: c.io.set_reg(vddd_reg, vddd, io_group=ioGroup)
+            if vddd<=vddd_dac:
+                for r in vddd_regs: c.io.set_reg(r, vddd, io_group=ioGroup)
             else: print(time.time()-start,' seconds to ramp VDDD')
-            if vdda<=vdda_dac: c.io.set_reg(vdda_reg, vdda, io_group=ioGroup)
+            if vdda<=vdda_dac:
+                for r in vdda_regs: c.io.set_reg(r, vdda, io_group=ioGroup)
             else: print(time.time()-start,' seconds to ramp VDDA')
             time.sleep(0.01)
             
@@ -248,21 +291,27 @@ def enable_tile_ramping(pacmanTile, resetLength, ioGroup, \
 
 
 
-def disable_tile(io, pacmanTile, ioGroup):
-    # VDDD set to 0 explicitly needed on rev4
-    vdda_reg=0x00024130; vddd_reg=0x00024131
-    if pacmanTile==2: vdda_reg=0x00024132; vddd_reg=0x00024133
-    io.set_reg(vdda_reg, 0, io_group=ioGroup) 
-    io.set_reg(vddd_reg, 0, io_group=ioGroup)
-
-    # disable power to tile
-    io.set_reg(0x00000010, 0b1100000000, io_group=ioGroup)
-
-    # disable global LArPix power
-    io.set_reg(0x00000014, 0, io_group=ioGroup)
+@packet_trace.traced
+def disable_tile(io, pacmanTile, ioGroup, settle=5, threshold=None, \
+                 verify=False):
+    # with threshold [mV], return as soon as VDDA and VDDD of the tile read
+    # below it instead of always sleeping settle seconds
+    # VDDD set to 0 explicitly needed on rev4, then disable power to tile
+    # and global LArPix power
+    tile_program.power_off(tile_program.tiles(pacmanTile)).run(io, ioGroup, \
+                                                              verify=verify)
     
-    print('Tile disabled. Sleeping for 5 seconds.')
-    time.sleep(5)
+    if threshold is None:
+        print('Tile disabled. Sleeping for {} seconds.'.format(settle))
+        time.sleep(settle)
+    else:
+        tiles = [1,2] if pacmanTile==0 else [pacmanTile]
+        start = time.time()
+        while time.time()-start<settle:
+            power = [read_power(io, ioGroup, i) for i in tiles]
+            if all([p[0]<threshold and p[2]<threshold for p in power]): break
+            time.sleep(0.1)
+        print('Tile disabled. Settled in {:.2f} seconds.'.format(time.time()-start))
 
     report_power(io, ioGroup)
 
@@ -271,6 +320,17 @@ def disable_tile(io, pacmanTile, ioGroup):
 def network_ext_node(c, ioGroup, io_channels, io_channel_root_chip_id_map):
     for ioc in io_channels:
         c.add_network_node(ioGroup, ioc, c.network_names, 'ext', root=True)
+        # a re-rooted io_channel drops the links to its previous root, and
+        # the previous root itself unless it is a configured chip
+        for name in c.network_names:
+            graph = c.network[ioGroup][ioc][name]
+            for tail, head in list(graph.edges()):
+                if 'ext' not in (tail, head): continue
+                graph.remove_edge(tail, head)
+                old = head if tail=='ext' else tail
+                if graph.degree(old)==0 and \
+                   larpix.key.Key(ioGroup, ioc, old) not in c.chips:
+                    graph.remove_node(old)
         c.add_network_link(ioGroup, ioc, 'miso_us', \
                            ('ext', io_channel_root_chip_id_map[ioc]), 0)
         c.add_network_link(ioGroup, ioc, 'miso_ds', \
@@ -281,6 +341,7 @@ def network_ext_node(c, ioGroup, io_channels, io_channel_root_chip_id_map):
 
 
 
+@packet_trace.traced
 def configure_chip_id(c, ioGroup, ioChannel, chipId):
     setup_key = larpix.key.Key(ioGroup, ioChannel, 1)
     if setup_key not in c.chips: c.add_chip(setup_key, version='2b')
@@ -296,6 +357,7 @@ def configure_chip_id(c, ioGroup, ioChannel, chipId):
 
 
 
+@packet_trace.traced
 def disable_csa_trigger(c, chip_key, \
                         ref_current_trim=16):
     # non-physical 'empty' register
@@ -316,64 +378,154 @@ def disable_csa_trigger(c, chip_key, \
 
 
 
+# default root chip of each io_channel within a tile (1-4)
+_default_roots={1:21, 2:41, 3:71, 4:91}
+
+
+
+def load_root_wiring(filename):
+    # {io_channel: [chip_id, ...]}: the edge chips each PACMAN io_channel
+    # physically reaches on the tile(s) being brought up, from a JSON
+    # object keyed by io_channel; {} without a file
+    if filename==None: return {}
+    with open(filename,'r') as f: d = json.load(f)
+    wiring = {}
+    for ioc, chip_ids in d.items():
+        if isinstance(chip_ids, int): chip_ids = [chip_ids]
+        if not isinstance(chip_ids, list) or \
+           not all([isinstance(i, int) and i in network_state._chip_ids \
+                    for i in chip_ids]):
+            raise ValueError('root wiring: io_channel {}: {!r} is not a list '\
+                             'of chip ids'.format(ioc, chip_ids))
+        wiring[int(ioc)] = chip_ids
+    return wiring
+
+
+
+def root_candidates(io_channel_root_chip_id_map, wiring=None):
+    # {io_channel: [chip_id, ...]}: the configured root only, or with a
+    # root wiring map the chips wired to the io_channel, configured root
+    # first. Chip ids are written to chip 1 on the io_channel, so only a
+    # chip the UART actually reaches can be given a candidate id without
+    # renaming the default root to the wrong grid position
+    if wiring==None: wiring = {}
+    candidates = {}
+    for ioc, chip_id in io_channel_root_chip_id_map.items():
+        wired = wiring.get(ioc, [chip_id])
+        candidates[ioc] = [chip_id]*(chip_id in wired) + \
+            [i for i in wired if i!=chip_id]
+    return candidates
+
+
+
+@packet_trace.traced
+def setup_root_chip(c, chip_key, tx_diff=0, tx_slice=15, \
+                    ref_current_trim=16, r_term=2):
+    disable_csa_trigger(c, chip_key, \
+                        ref_current_trim=ref_current_trim)
+    
+    # configure receivers
+    c[chip_key].config.r_term1=r_term
+    c.write_configuration(chip_key, 'r_term1')
+    c[chip_key].config.r_term0=r_term
+    c.write_configuration(chip_key, 'r_term0')
+    c[chip_key].config.enable_posi=[0]*4
+    c[chip_key].config.enable_posi[1]=1
+    c.write_configuration(chip_key, 'enable_posi')
+    
+    # configure transmitters
+    c[chip_key].config.enable_piso_downstream=[0]*4
+    c[chip_key].config.enable_piso_downstream[0]=1
+    c.write_configuration(chip_key, 'enable_piso_downstream')
+    c[chip_key].config.enable_piso_upstream=[0]*4
+    c.write_configuration(chip_key, 'enable_piso_upstream')
+    c[chip_key].config.i_tx_diff0=tx_diff
+    c.write_configuration(chip_key, 'i_tx_diff0')
+    c[chip_key].config.tx_slices0=tx_slice
+    c.write_configuration(chip_key, 'tx_slices0')
+    return
+
+
+
+@packet_trace.traced
 def setup_root_chips(c, io, ioGroup, io_channel_root_chip_id_map, \
                      verbose, logger, read, \
                      tx_diff=0, tx_slice=15, \
                      ref_current_trim=16, \
-                     r_term=2, i_rx=8):
+                     r_term=2, i_rx=8, state=None):
+    # io_channel_root_chip_id_map values are a root chip id or a list of
+    # candidate root chip ids (see root_candidates). Every candidate of
+    # every io_channel is configured in one pass, the PACMAN POSI of all of
+    # them enabled at once and all verified in one batch; each io_channel
+    # is rooted at its first responding candidate and any other responder
+    # is released (PISO DS off, chip id back to 1) for the daughter search
+    policy = retry_policy.active()
+    candidates = dict([(ioc, ids if isinstance(ids, list) else [ids]) \
+                       for ioc, ids in io_channel_root_chip_id_map.items()])
     root_keys=[]
-    for ioc in io_channel_root_chip_id_map.keys():
-        chip_key = configure_chip_id(c, ioGroup, ioc, \
-                                     io_channel_root_chip_id_map[ioc])
-        
-        disable_csa_trigger(c, chip_key, \
-                            ref_current_trim=ref_current_trim)
-        
-        # configure receivers
-        c[chip_key].config.r_term1=r_term
-        c.write_configuration(chip_key, 'r_term1')
-        c[chip_key].config.r_term0=r_term
-        c.write_configuration(chip_key, 'r_term0')
-        c[chip_key].config.enable_posi=[0]*4
-        c[chip_key].config.enable_posi[1]=1
-        c.write_configuration(chip_key, 'enable_posi')
-        
-        # configure transmitters
-        c[chip_key].config.enable_piso_downstream=[0]*4
-        c[chip_key].config.enable_piso_downstream[0]=1
-        c.write_configuration(chip_key, 'enable_piso_downstream')
-        c[chip_key].config.enable_piso_upstream=[0]*4
-        c.write_configuration(chip_key, 'enable_piso_upstream')
-        c[chip_key].config.i_tx_diff0=tx_diff
-        c.write_configuration(chip_key, 'i_tx_diff0')
-        c[chip_key].config.tx_slices0=tx_slice
-        c.write_configuration(chip_key, 'tx_slices0')
-
-        # enable PACMAN POSI
-        io.set_reg(0x18, 2**(ioc-1), io_group=ioGroup)
-        
-        c.read_configuration(chip_key,0,timeout=0.01)
-        total = len(c.reads[-1])
-        chip = len(c.reads[-1].extract('chip_id', chip_key=chip_key))
-        if verbose:
-            print(chip_key,': \t total packets {}\t', \
-                  'chip packets {}'.format(total,chip))
-        
-        ok, diff = reconcile_configuration(c, chip_key, verbose)
-        if logger==True and read==True: c.run(2, ' logger DAQ running')
-        
-        if ok:
-            if chip_key not in c.chips: c.add_chip(chip_key, version='2b')
-            root_keys.append(chip_key)
-            print(chip_key,' configured')
-        if not ok:
-            print(chip_key,' NOT configured')
-            reset_daughter_uarts(c, chip_key, verbose)
-            ok, diff = reconcile_configuration(c, chip_key, verbose)
-            c.remove_chip(chip_key)
-            
-        # disable PACMAN POSI
-        io.set_reg(0x18, 0, io_group=ioGroup)
+    probe = []
+    for ioc, ids in candidates.items():
+        for chip_id in ids:
+            if not policy.allow(larpix.key.Key(ioGroup, ioc, chip_id)):
+                event_log.info('root_skipped', io_channel=ioc, chip_id=chip_id)
+                continue
+            chip_key = configure_chip_id(c, ioGroup, ioc, chip_id)
+            packet_trace.record_hop(None, chip_key)
+            setup_root_chip(c, chip_key, tx_diff=tx_diff, tx_slice=tx_slice, \
+                            ref_current_trim=ref_current_trim, r_term=r_term)
+            probe.append(chip_key)
+    if len(probe)==0: return root_keys
+
+    # enable PACMAN POSI
+    io.set_reg(0x18, sum([2**(ioc-1) for ioc in \
+                          set([chip_key.io_channel for chip_key in probe])]), \
+               io_group=ioGroup)
+
+    if verbose:
+        for chip_key in probe:
+            c.read_configuration(chip_key,0,timeout=0.01)
+            total = len(c.reads[-1])
+            chip = len(c.reads[-1].extract('chip_id', chip_key=chip_key))
+            event_log.debug('root_read', chip=chip_key, \
+                            total_packets=total, chip_packets=chip)
+
+    ok, diff = reconcile_configuration(c, probe, verbose)
+    if logger==True and read==True: c.run(2, ' logger DAQ running')
+
+    failed = [chip_key for chip_key in probe if chip_key in diff]
+    released = []
+    for chip_key in probe:
+        if chip_key in failed: continue
+        n = candidates[chip_key.io_channel].index(chip_key.chip_id)
+        policy.success(chip_key)
+        link_history.record(None, chip_key, True)
+        if chip_key.io_channel in [k.io_channel for k in root_keys]:
+            event_log.info('root_released', chip=chip_key, candidate=n)
+            released.append(chip_key)
+            continue
+        root_keys.append(chip_key)
+        checkpoint_journal.record_root(c, chip_key, True)
+        if state is not None: state.add(chip_key)
+        event_log.info('root_configured', chip=chip_key, candidate=n)
+    for chip_key in failed:
+        n = candidates[chip_key.io_channel].index(chip_key.chip_id)
+        event_log.warning('root_failed', chip=chip_key, candidate=n)
+        policy.failure(chip_key)
+        link_history.record(None, chip_key, False)
+        checkpoint_journal.record_root(c, chip_key, False)
+        reset_daughter_uarts(c, chip_key, verbose)
+    if len(failed)>0:
+        ok, diff = reconcile_configuration(c, failed, verbose)
+        for chip_key in failed: c.remove_chip(chip_key)
+    for chip_key in released:
+        reset_daughter_uarts(c, chip_key, verbose)
+        c[chip_key].config.chip_id = 1
+        c.write_configuration(chip_key, 'chip_id')
+        c.remove_chip(chip_key)
+
+    # disable PACMAN POSI
+    io.set_reg(0x18, 0, io_group=ioGroup)
+    root_keys.sort(key=lambda chip_key: chip_key.io_channel)
     return root_keys#, waitlist
 
 
@@ -387,13 +539,14 @@ def find_daughter_id(parent_piso, parent_chip_id, parent_io_channel):
 
 
 
+@packet_trace.traced
 def setup_parent_piso_us(c, parent, daughter, verbose, tx_diff, tx_slice):
     if parent.chip_id - daughter.chip_id == 10: piso=3
     if parent.chip_id - daughter.chip_id == -10: piso=1
     if parent.chip_id - daughter.chip_id == -1: piso=2
     if parent.chip_id - daughter.chip_id == 1: piso=0
-    if verbose: print('PARENT ',parent,'\tdaughter ',\
-                      daughter,'==>\t enable PISO US ', piso)
+    if verbose: event_log.debug('enable_parent_piso_us', parent=parent, \
+                                daughter=daughter, piso=piso)
     registers_to_write=[]
     setattr(c[parent].config,f'i_tx_diff{piso}', tx_diff)
     registers_to_write.append(c[parent].config.register_map[f'i_tx_diff{piso}'])
@@ -403,21 +556,24 @@ def setup_parent_piso_us(c, parent, daughter, verbose, tx_diff, tx_slice):
 
     c[parent].config.enable_piso_upstream[piso]=1
     c.write_configuration(parent, 'enable_piso_upstream')
-    if verbose: print(c[parent].config.enable_piso_upstream)
+    if verbose: event_log.debug('parent_piso_us', chip=parent, \
+                                enable=list(c[parent].config.enable_piso_upstream))
     return 
 
 
 
+@packet_trace.traced
 def disable_parent_piso_us(c, parent, daughter, verbose, tx_diff=15, tx_slice=0):
     if parent.chip_id - daughter.chip_id == 10: piso=3
     if parent.chip_id - daughter.chip_id == -10: piso=1
     if parent.chip_id - daughter.chip_id == -1: piso=2
     if parent.chip_id - daughter.chip_id == 1: piso=0
-    if verbose: print('PARENT ',parent,'\tdaughter ',\
-                      daughter,'==>\t disable PISO US ', piso)
+    if verbose: event_log.debug('disable_parent_piso_us', parent=parent, \
+                                daughter=daughter, piso=piso)
     c[parent].config.enable_piso_upstream[piso]=0
     c.write_configuration(parent, 'enable_piso_upstream')
-    if verbose: print(c[parent].config.enable_piso_upstream)
+    if verbose: event_log.debug('parent_piso_us', chip=parent, \
+                                enable=list(c[parent].config.enable_piso_upstream))
     registers_to_write=[]
     setattr(c[parent].config,f'i_tx_diff{piso}', tx_diff)
     registers_to_write.append(c[parent].config.register_map[f'i_tx_diff{piso}'])
@@ -428,14 +584,15 @@ def disable_parent_piso_us(c, parent, daughter, verbose, tx_diff=15, tx_slice=0)
 
 
 
+@packet_trace.traced
 def setup_parent_posi(c, parent, daughter, verbose, r_term, i_rx):
     if parent.chip_id - daughter.chip_id == 10: posi=0
     if parent.chip_id - daughter.chip_id == -10: posi=2
     if parent.chip_id - daughter.chip_id == -1: posi=3
     if parent.chip_id - daughter.chip_id == 1: posi=1
-    if verbose: print('PARENT ',parent,'\tdaughter ',\
-                      daughter,'==>\t enable POSI ', posi)
-    if verbose: print(c[parent].config.enable_posi)
+    if verbose: event_log.debug('enable_parent_posi', parent=parent, \
+                                daughter=daughter, posi=posi, \
+                                enable=list(c[parent].config.enable_posi))
     registers_to_write=[]
     setattr(c[parent].config,f'r_term{posi}', r_term)
     registers_to_write.append(c[parent].config.register_map[f'r_term{posi}'])
@@ -448,13 +605,14 @@ def setup_parent_posi(c, parent, daughter, verbose, r_term, i_rx):
 
 
 
+@packet_trace.traced
 def disable_parent_posi(c, parent, daughter, verbose):
     if parent.chip_id - daughter.chip_id == 10: posi=0
     if parent.chip_id - daughter.chip_id == -10: posi=2
     if parent.chip_id - daughter.chip_id == -1: posi=3
     if parent.chip_id - daughter.chip_id == 1: posi=1
-    if verbose: print('PARENT ',parent,'\tdaughter ',\
-                      daughter,'==>\t disable POSI ', posi)
+    if verbose: event_log.debug('disable_parent_posi', parent=parent, \
+                                daughter=daughter, posi=posi)
     posi_list = c[parent].config.enable_posi # !!!! 
     if posi_list.count(1)==1: # !!!!
         c[parent].config.enable_posi=[1]*4 # !!!!
@@ -462,19 +620,21 @@ def disable_parent_posi(c, parent, daughter, verbose):
     else:
         c[parent].config.enable_posi[posi]=0
     c.write_configuration(parent, 'enable_posi')
-    if verbose: print(c[parent].config.enable_posi)
+    if verbose: event_log.debug('parent_posi', chip=parent, \
+                                enable=list(c[parent].config.enable_posi))
     return
 
 
 
+@packet_trace.traced
 def setup_daughter_posi(c, parent, daughter, verbose, r_term, i_rx):
     if parent.chip_id - daughter.chip_id == 10: posi=2
     if parent.chip_id - daughter.chip_id == -10: posi=0
     if parent.chip_id - daughter.chip_id == -1: posi=1
     if parent.chip_id - daughter.chip_id == 1: posi=3
-    if verbose: print('parent ',parent,'\tDAUGHTER ',\
-                      daughter,'==>\t enable POSI ', posi)
-    if verbose: print(c[daughter].config.enable_posi)
+    if verbose: event_log.debug('enable_daughter_posi', parent=parent, \
+                                daughter=daughter, posi=posi, \
+                                enable=list(c[daughter].config.enable_posi))
     registers_to_write=[]
     setattr(c[daughter].config,f'r_term{posi}', r_term)
     registers_to_write.append(c[daughter].config.register_map[f'r_term{posi}'])
@@ -488,6 +648,7 @@ def setup_daughter_posi(c, parent, daughter, verbose, r_term, i_rx):
     
     
 
+@packet_trace.traced
 def setup_daughter_piso(c, parent, daughter, verbose, tx_diff, tx_slice):
     c[daughter].config.enable_piso_upstream=[0]*4
     c.write_configuration(daughter, 'enable_piso_upstream')
@@ -495,8 +656,8 @@ def setup_daughter_piso(c, parent, daughter, verbose, tx_diff, tx_slice):
     if parent.chip_id - daughter.chip_id == -10: piso=3
     if parent.chip_id - daughter.chip_id == -1: piso=0
     if parent.chip_id - daughter.chip_id == 1: piso=2
-    if verbose: print('parent ',parent,'\tDAUGHTER ',daughter,\
-                      '==>\t PISO DS ', piso)
+    if verbose: event_log.debug('enable_daughter_piso_ds', parent=parent, \
+                                daughter=daughter, piso=piso)
     
     registers_to_write=[]
     setattr(c[daughter].config,f'i_tx_diff{piso}', tx_diff)
@@ -508,20 +669,22 @@ def setup_daughter_piso(c, parent, daughter, verbose, tx_diff, tx_slice):
     c[daughter].config.enable_piso_downstream=[0]*4
     c[daughter].config.enable_piso_downstream[piso]=1
     c.write_configuration(parent, 'enable_piso_downstream')
-    if verbose: print(c[daughter].config.enable_piso_downstream)
+    if verbose: event_log.debug('daughter_piso_ds', chip=daughter, \
+                                enable=list(c[daughter].config.enable_piso_downstream))
     return piso
 
 
 
+@packet_trace.traced
 def reset_daughter_uarts(c, daughter, verbose):
     c[daughter].config.enable_piso_downstream=[0]*4
     c.write_configuration(daughter, 'enable_piso_downstream')
-    if verbose: print('DAUGHTER ',daughter,' PISO DS ', \
-          c[daughter].config.enable_piso_downstream)
+    if verbose: event_log.debug('daughter_piso_ds', chip=daughter, \
+                                enable=list(c[daughter].config.enable_piso_downstream))
     c[daughter].config.enable_posi=[1]*4
     c.write_configuration(daughter, 'enable_posi')
-    if verbose: print('DAUGHTER ',daughter,' POSI ', \
-                      c[daughter].config.enable_posi)
+    if verbose: event_log.debug('daughter_posi', chip=daughter, \
+                                enable=list(c[daughter].config.enable_posi))
     return
 
 
@@ -544,104 +707,204 @@ def append_upstream_chip_ids(io_channel, chip_id, waitlist):
     return addendum
 
 
-    
+
+@packet_trace.traced
+def configure_hop(c, io, ioGroup, parent, daughter_id, verbose, logger, read, \
+                  tx_diff=0, tx_slice=15, \
+                  ref_current_trim=16, \
+                  r_term=2, i_rx=8, state=None):
+    # configure one parent -> daughter hop; returns 'ok', 'parent' (parent
+    # PISO US failed) or 'daughter' (daughter failed to configure), the
+    # daughter key and the daughter PISO DS
+    policy = retry_policy.active()
+    monitor = current_monitor.active()
+    daughter=larpix.key.Key(parent.io_group, parent.io_channel, daughter_id)
+    link = retry_policy.link(parent, daughter)
+    if monitor is not None: monitor.before(parent)
+
+    io.set_reg(0x18, 2**(parent.io_channel-1), io_group=ioGroup)
+    setup_parent_piso_us(c, parent, daughter, verbose, tx_diff, tx_slice)
+
+    ok, diff = reconcile_configuration(c, parent, verbose)
+    if not ok:
+        event_log.warning('parent_piso_us_failed', parent=parent, daughter=daughter)
+        policy.failure(parent)
+        disable_parent_piso_us(c, parent, daughter, verbose)
+        checkpoint_journal.record_hop(c, parent, daughter, None, False)
+        io.set_reg(0x18, 0, io_group=ioGroup)
+        if monitor is not None:
+            check_hop_current(io, ioGroup, monitor, parent, daughter, \
+                              monitor.after(daughter, False))
+        return 'parent', daughter, None
+
+    daughter = configure_chip_id(c, parent.io_group, parent.io_channel, \
+                                 daughter_id)
+    # tentative depth, so the hop's own traffic is traced at its depth
+    packet_trace.record_hop(parent, daughter)
+    setup_daughter_posi(c, parent, daughter, verbose, r_term, i_rx)
+    piso = setup_daughter_piso(c, parent, daughter, verbose, tx_diff, tx_slice)
+    disable_csa_trigger(c, daughter, ref_current_trim=ref_current_trim)
+    setup_parent_posi(c, parent, daughter, verbose, r_term, i_rx)
+
+    ok, diff = reconcile_configuration(c, daughter, verbose)
+    if logger==True and read==True: c.run(2, ' logger DAQ running')
+    anomaly = None
+    if monitor is not None: anomaly = monitor.after(daughter, ok)
+    if anomaly is not None and monitor.abort:
+        ok = False
+        policy.kill(daughter, 'current anomaly')
+    link_history.record(parent, daughter, ok)
+
+    if ok:
+        policy.success(parent, daughter, link)
+        if state is not None: state.add(daughter, parent)
+    if not ok:
+        event_log.warning('daughter_failed', parent=parent, daughter=daughter)
+        policy.failure(daughter)
+        policy.failure(link, link=True)
+        reset_daughter_uarts(c, daughter, verbose)
+        disable_parent_piso_us(c, parent, daughter, verbose)
+        disable_parent_posi(c, parent, daughter, verbose)
+        c.remove_chip(daughter)
+    checkpoint_journal.record_hop(c, parent, daughter, piso, ok)
+    io.set_reg(0x18, 0, io_group=ioGroup)
+    if monitor is not None:
+        check_hop_current(io, ioGroup, monitor, parent, daughter, anomaly)
+    return ('ok' if ok else 'daughter'), daughter, piso
+
+
+
+def check_hop_current(io, ioGroup, monitor, parent, daughter, anomaly):
+    # log a current anomaly of a finished hop; with abort, a tile above its
+    # current limits is powered down and the bring-up stopped
+    if anomaly is None: return
+    event_log.warning('current_anomaly', parent=parent, daughter=daughter, \
+                      idda=anomaly['current'][0], iddd=anomaly['current'][1], \
+                      reasons=anomaly['reasons'])
+    if monitor.abort and monitor.over_limit(anomaly):
+        # protect the hardware: power the tile down and stop the bring-up
+        tile_program.power_off((monitor.tile(daughter),)).run(io, ioGroup)
+        raise RuntimeError('Tile current above limit after hop {} -> {}: {}'\
+                           .format(parent, daughter, anomaly['reasons']))
+
+
+
+@packet_trace.traced
+def resume_network(c, io, ioGroup, filename, verbose, state=None, timeout=1):
+    # replay a checkpoint journal onto the still-powered tile: every chip
+    # committed in the journal is loaded with its last journaled
+    # configuration, verified in one batch and only differing registers
+    # rewritten; chips that still fail are dropped with their descendants.
+    # Returns the resumed root keys
+    restored = checkpoint_journal.restore(c, checkpoint_journal.load(filename))
+    if len(restored)==0: return []
+    io_channels = set([chip_key.io_channel for chip_key, parent in restored])
+    io.set_reg(0x18, sum([2**(ioc-1) for ioc in io_channels]), io_group=ioGroup)
+    ok, diff = reconcile_configuration(c, [chip_key for chip_key, parent \
+                                           in restored], verbose, \
+                                       timeout=timeout)
+    io.set_reg(0x18, 0, io_group=ioGroup)
+    dropped = set(diff.keys())
+    root_keys = []
+    for chip_key, parent in restored:
+        if chip_key in dropped or parent in dropped:
+            event_log.warning('resume_dropped', chip=chip_key)
+            dropped.add(chip_key)
+            c.remove_chip(chip_key)
+            continue
+        if state is not None: state.add(chip_key, parent)
+        packet_trace.record_hop(parent, chip_key)
+        if parent is None: root_keys.append(chip_key)
+    event_log.info('resumed', journal=filename, chips=len(restored)-len(dropped), \
+                   dropped=len(dropped))
+    return root_keys
+
+
+
+@packet_trace.traced
 def setup_initial_network(c, io, ioGroup, root_keys, \
                           verbose, logger, read, \
                           tx_diff=0, tx_slice=15, \
                           ref_current_trim=16, \
-                          r_term=2, i_rx=8):
-    root_ioc=[rk.io_channel for rk in root_keys]
+                          r_term=2, i_rx=8, state=None):
+    if state is None: state = network_state.from_controller(c)
+    policy = retry_policy.active()
     waitlist=set()
     cnt_configured, cnt_nonconfigured=0,0
     firstIteration=True
     for root in root_keys:
 
         if firstIteration==False:
-            print('\n CONFIGURED: ',cnt_configured,
-                  '\t NON-CONFIGURED: ',cnt_nonconfigured)
+            event_log.info('io_channel_done', configured=cnt_configured, \
+                           nonconfigured=cnt_nonconfigured)
 
         io.set_reg(0x18, 2**(root.io_channel-1), io_group=ioGroup)
         ok, diff = reconcile_configuration(c, root, verbose)
         if ok:
             cnt_configured+=1
-            print('\n',root,'\tconfigured: ',cnt_configured,
-                  '\t non-configured',cnt_nonconfigured)
+            event_log.info('root_verified', chip=root, configured=cnt_configured, \
+                           nonconfigured=cnt_nonconfigured)
         if not ok:
             waitlist = append_upstream_chip_ids(root.io_channel, \
                                                 root.chip_id, waitlist)
             cnt_unconfigured = len(waitlist)
-            print('Parent ',root,' failed to configure')
-            print(root,'\tconfigured: ',cnt_configured,
-                  '\t non-configured',cnt_nonconfigured)
+            event_log.warning('root_failed', chip=root, configured=cnt_configured, \
+                              nonconfigured=cnt_nonconfigured)
             continue
         io.set_reg(0x18, 0, io_group=ioGroup)
         
         bail=False
         last_chip_id = root.chip_id
-        print(last_chip_id,' last chip id before while')
+        if verbose: event_log.debug('walk_start', chip_id=last_chip_id)
         while last_chip_id<=root.chip_id+9:
             if bail==True: break
             for parent_piso_us in [3,1,2]:
-                if verbose: print('\n')
                 if bail==True: break
                 daughter_id = find_daughter_id(parent_piso_us, last_chip_id, \
                                                root.io_channel)
 
-                cks=[]
-                for ck in c.chips:
-                    if ck.io_channel in root_ioc: cks.append(ck.chip_id)
-                if daughter_id in cks: continue
+                if state.lookup(root.io_group, root.io_channel, \
+                                daughter_id) is not None: continue
                 
                 parent=larpix.key.Key(root.io_group, root.io_channel, \
                                       last_chip_id)
 
                 daughter=larpix.key.Key(root.io_group, root.io_channel, \
                                         daughter_id)
+                link = retry_policy.link(parent, daughter)
 
-                io.set_reg(0x18, 2**(root.io_channel-1), io_group=ioGroup)
-                setup_parent_piso_us(c, parent, daughter, verbose, \
-                                     tx_diff, tx_slice)
+                if not policy.allow(parent):
+                    bail=True
+                    continue
+                if not policy.allow(daughter, link):
+                    if parent_piso_us==2: bail=True
+                    continue
 
-                ok, diff = reconcile_configuration(c, parent, verbose)
-                if not ok:
-                    print('\t\t==> Parent PISO US ',parent,\
-                          ' failed to configure')
-                    disable_parent_piso_us(c, parent, daughter, verbose)
+                status, daughter, piso = configure_hop(c, io, ioGroup, parent, \
+                                                       daughter_id, verbose, \
+                                                       logger, read, \
+                                                       tx_diff=tx_diff, \
+                                                       tx_slice=tx_slice, \
+                                                       ref_current_trim=ref_current_trim, \
+                                                       r_term=r_term, i_rx=i_rx, \
+                                                       state=state)
+                if status=='parent':
                     waitlist = append_upstream_chip_ids(root.io_channel, \
                                                         daughter_id, \
                                                         waitlist)
                     cnt_nonconfigured = len(waitlist)
-                    print(daughter,'\tconfigured: ',cnt_configured,
-                          '\t non-configured',cnt_nonconfigured)
+                    event_log.info('hop', chip=daughter, status=status, \
+                                   configured=cnt_configured, \
+                                   nonconfigured=cnt_nonconfigured)
                     bail=True
                     continue
 
-                daughter = configure_chip_id(c, root.io_group, \
-                                             root.io_channel, daughter_id)
-                setup_daughter_posi(c, parent, daughter, verbose, \
-                                    r_term, i_rx)
-                piso = setup_daughter_piso(c, parent, daughter, verbose, \
-                                           tx_diff, tx_slice)
-                disable_csa_trigger(c, daughter, \
-                                    ref_current_trim=ref_current_trim)
-                setup_parent_posi(c, parent, daughter, verbose, \
-                                  r_term, i_rx)
-
-                ok, diff = reconcile_configuration(c, daughter, verbose)
-                if logger==True and read==True: c.run(2, ' logger DAQ running')
-                
-                if ok:
+                if status=='ok':
                     cnt_configured+=1
-                    print(daughter,'\tconfigured: ',cnt_configured,
-                          '\t non-configured',cnt_nonconfigured)
-                if not ok:
-                    print('\t\t==> Daughter',daughter,' failed to configure')
-                    reset_daughter_uarts(c, daughter, verbose)
-                    disable_parent_piso_us(c, parent, daughter, verbose)
-                    disable_parent_posi(c, parent, daughter, verbose)
-
-                    c.remove_chip(daughter) 
-                    
+                    event_log.info('hop', chip=daughter, status=status, \
+                                   configured=cnt_configured, \
+                                   nonconfigured=cnt_nonconfigured)
+                if status=='daughter':
                     if parent_piso_us==2:
                         waitlist = append_upstream_chip_ids(root.io_channel, \
                                                             daughter_id, \
@@ -649,120 +912,141 @@ def setup_initial_network(c, io, ioGroup, root_keys, \
                         bail=True
                     if parent_piso_us!=2: waitlist.add(daughter_id)
                     cnt_nonconfigured = len(waitlist)
-                    print(daughter,'\tconfigured: ',cnt_configured,
-                          '\t non-configured',cnt_nonconfigured)
-                                        
-                io.set_reg(0x18, 0, io_group=ioGroup)
+                    event_log.info('hop', chip=daughter, status=status, \
+                                   configured=cnt_configured, \
+                                   nonconfigured=cnt_nonconfigured)
                 
             last_chip_id = daughter_id
             
         firstIteration=False
-    print(len(c.chips),' CONFIGURED chips in network')
+    event_log.info('network_configured', chips=len(c.chips))
     return 
 
 
 
-def find_waitlist(c):
-    network = {}
-    waitlist = []
-    for chip_key in c.chips: network[chip_key.chip_id]=chip_key
-    for chip_id in range(11,111):
-        if chip_id not in network.keys(): waitlist.append(chip_id)
-    return waitlist, network
-
-
+@packet_trace.traced
+def setup_planned_network(c, io, ioGroup, plan, \
+                          verbose, logger, read, \
+                          tx_diff=0, tx_slice=15, \
+                          ref_current_trim=16, \
+                          r_term=2, i_rx=8, state=None):
+    # configure hops in hydra_planner order; hops whose parent did not come
+    # up are skipped and left to iterate_waitlist
+    if state is None: state = network_state.from_controller(c)
+    policy = retry_policy.active()
+    cnt_configured, cnt_skipped = 0, 0
+    for io_group, io_channel, parent_id, daughter_id in plan:
+        parent = state.lookup(io_group, io_channel, parent_id)
+        if parent is None or parent.io_channel!=io_channel:
+            cnt_skipped+=1
+            continue
+        if state.lookup(io_group, io_channel, daughter_id) is not None: continue
+        daughter = larpix.key.Key(io_group, io_channel, daughter_id)
+        if not policy.allow(parent, daughter, retry_policy.link(parent, daughter)):
+            cnt_skipped+=1
+            continue
+        status, daughter, piso = configure_hop(c, io, ioGroup, parent, \
+                                               daughter_id, verbose, \
+                                               logger, read, \
+                                               tx_diff=tx_diff, \
+                                               tx_slice=tx_slice, \
+                                               ref_current_trim=ref_current_trim, \
+                                               r_term=r_term, i_rx=i_rx, \
+                                               state=state)
+        if status=='ok':
+            cnt_configured+=1
+            event_log.info('hop', chip=daughter, status=status, \
+                           configured=cnt_configured, skipped=cnt_skipped)
+        else: cnt_skipped+=1
+    event_log.info('network_configured', chips=len(c.chips))
+    return
 
-def find_potential_parents(chip_id, network, verbose):
-    parents=[]
-    for i in [10,-10,1,-1]:
-        if chip_id%10==0 and (chip_id+i)%10==1: continue
-        if (chip_id+i)%10==0 and chip_id%10==1: continue
-        if chip_id+i in network.keys(): parents.append(network[chip_id+i])
-    return parents
 
 
-    
+@packet_trace.traced
 def iterate_waitlist(c, io, ioGroup, activeUser, \
                      verbose, logger, read, \
                      tx_diff=0, tx_slice=15, \
                      ref_current_trim=16, \
-                     r_term=2, i_rx=8):
-    print('\n\n--------- Iterating waitlist ----------\n')
-    flag=True; outstanding=[]
+                     r_term=2, i_rx=8, state=None, rules=None):
+    # with rules (waitlist_rules.WaitlistRules) the activeUser prompts are
+    # replaced by the rules file / control socket and never block
+    event_log.info('waitlist_start')
+    if state is None: state = network_state.from_controller(c)
+    policy = retry_policy.active()
+    if rules is not None: rules.restart_clock()
+    flag=True; outstanding=[]; n_pass=0
     while flag==True:
-        waitlist, network = find_waitlist(c)
-        n_waitlist = len(waitlist)
-        if n_waitlist==0: flag=False
-        outstanding=[]
-
-        for chip_id in waitlist:
-            potential_parents=find_potential_parents(chip_id, network, verbose)
-
+        n_pass+=1
+        if rules is not None and not rules.proceed(n_pass):
+            event_log.info('waitlist_rules_stop', next_pass=n_pass)
+            break
+        # retry only chips that gained a configured neighbour since the last
+        # pass, and only against those new potential parents
+        pending = state.take_pending()
+        n_waitlist = len(state.waitlist())
+        if len(pending)==0: flag=False
+
+        for (io_group, tile, chip_id), potential_parents in sorted(pending.items()):
+            if flag==False: break # rules expired mid-pass
+            # parents with a good link history first
+            potential_parents = link_history.order_parents(potential_parents, \
+                                                           chip_id)
             for parent in potential_parents:
                 daughter=larpix.key.Key(parent.io_group, parent.io_channel, \
                                         chip_id)
+                link = retry_policy.link(parent, daughter)
 #                if daughter.chip_id==39: continue
-
-                if activeUser==True:
+                if not policy.allow(parent, daughter, link): continue
+
+                if rules is not None:
+                    if not rules.allow(parent, daughter): continue
+                    # time budget / stop checked before every hop
+                    if rules.expired():
+                        event_log.info('waitlist_rules_expired', \
+                                       waitlist_pass=n_pass)
+                        flag=False
+                        break
+                elif activeUser==True:
                     proceed=None
                     if activeUser==True:
+                        event_log.flush()
                         print('\nParent ',parent,'\t Daughter ',daughter)
                         text='Ready to proceed (True) or skip (False)?\n'
                         proceed = input(text)
                     if proceed=='False' or proceed=='F' or proceed=='0': \
                        continue
                 
-                io.set_reg(0x18, 2**(parent.io_channel-1), io_group=ioGroup)
-                
-                setup_parent_piso_us(c, parent, daughter, verbose, \
-                                            tx_diff, tx_slice)
-
-                ok, diff = reconcile_configuration(c, parent, verbose)
-                if not ok:
-                    print('\t\t==> Parent PISO US ',parent,\
-                          ' failed to configure')
-                    disable_parent_piso_us(c, parent, daughter, verbose)
-                    io.set_reg(0x18, 0, io_group=ioGroup)
-                    continue                
-
-                daughter = configure_chip_id(c, parent.io_group,\
-                                             parent.io_channel, chip_id)
-                setup_daughter_posi(c, parent, daughter, verbose, \
-                                    r_term, i_rx)
-                piso = setup_daughter_piso(c, parent, daughter, verbose, \
-                                           tx_diff, tx_slice)
-                disable_csa_trigger(c, daughter, \
-                                    ref_current_trim=ref_current_trim)
-                setup_parent_posi(c, parent, daughter, verbose, \
-                                  r_term, i_rx)
-                ok, diff = reconcile_configuration(c, daughter, verbose)
-                if logger==True and read==True: c.run(2, ' logger DAQ running')
-                
-                if ok:
-                    waitlist.remove(chip_id)
-                    print('WAITLIST RESOLVED\t',daughter)
+                status, daughter, piso = configure_hop(c, io, ioGroup, parent, \
+                                                       chip_id, verbose, \
+                                                       logger, read, \
+                                                       tx_diff=tx_diff, \
+                                                       tx_slice=tx_slice, \
+                                                       ref_current_trim=ref_current_trim, \
+                                                       r_term=r_term, i_rx=i_rx, \
+                                                       state=state)
+                if status=='ok':
+                    event_log.info('waitlist_resolved', chip=daughter, parent=parent)
                     break # break out of potential parents loop
-                if not ok:
-                    print('\t\t==> Daughter',daughter,' failed to configure')
-                    reset_daughter_uarts(c, daughter, verbose)
-                    disable_parent_piso_us(c, parent, daughter, verbose)
-                    disable_parent_posi(c, parent, daughter, verbose)
-                    outstanding.append((daughter, piso))
-                    c.remove_chip(daughter)
-                io.set_reg(0x18, 0, io_group=ioGroup)
-                
-        if n_waitlist==len(waitlist):
-            print('\n',len(waitlist),' NON-CONFIGURED chips\n',waitlist,'\n')
+                if status=='daughter': outstanding.append((daughter, piso))
+
+        waitlist = [chip_id for io_group, tile, chip_id in state.waitlist()]
+        if n_waitlist==len(waitlist) or flag==False:
+            event_log.info('waitlist_done', nonconfigured=len(waitlist), \
+                           chip_ids=waitlist)
             flag=False
         else:
-            print('\n\n********RE-TESTING ',len(waitlist),' CHIPs\n',waitlist)
-            if activeUser==True:
+            event_log.info('waitlist_retest', nonconfigured=len(waitlist), \
+                           chip_ids=waitlist)
+            if rules is None and activeUser==True:
                 proceed=None
                 if activeUser==True:
+                    event_log.flush()
                     text='Continue iterating waitlist or exit early (False)?\n'
                     proceed = input(text)
                 if proceed=='False' or proceed=='F' or proceed=='0': \
                    flag=False
+    outstanding = [pair for pair in outstanding if pair[0] not in state]
     return outstanding
 
 
@@ -863,13 +1147,16 @@ def write_network_to_file(c, name, outstanding, \
             d["missing"][key.io_group][key.io_channel][key.chip_id]=[]
         d["missing"][key.io_group][key.io_channel][key.chip_id].append( pair[1] )
 
+    d["retry"]=retry_policy.active().report()
+
     with open(name+'.json','w') as out:
         json.dump(d, out, indent=4)
 
 
 
+@packet_trace.traced
 def measure_csa_ibias(c, ioGroup, enableSerial):
-    c.io = larpix.io.PACMAN_IO(relaxed=True)
+    connect_tile(c=c)
     c.io.set_reg(0x25014, 2, io_group=ioGroup)
     c.io.set_reg(0x25015, 0x10, io_group=ioGroup)
 
@@ -925,8 +1212,102 @@ def measure_csa_ibias(c, ioGroup, enableSerial):
             json.dump(d, outfile, indent=4)
 
 
+def sample_csa_ibias(c, chip, ser, enableSerial, meter_delay=0.1):
+    # toggle each current monitor bank on then off, reading the meter after each
+    readings=[]
+    for i in range(4):
+        for bank in [[0,0,0,1],[0,0,0,0]]:
+            setattr(c[chip].config,f'current_monitor_bank{i}',bank)
+            for reg in c[chip].config.register_map[f'current_monitor_bank{i}']:
+                c.write_configuration(chip, reg)
+            if enableSerial:
+                ser.write(bytes(':READ?\r\n', 'utf-8'))
+                time.sleep(meter_delay)
+                response = ser.readline()
+                readings.append(response[14:28].decode("utf-8"))
+    return readings
+
+
+
+def csa_ibias_drift(readings, previous):
+    # largest relative change between two samples, None if not comparable
+    try:
+        now = [float(r) for r in readings]
+        before = [float(r) for r in previous]
+    except (TypeError, ValueError): return None
+    if len(now)==0 or len(now)!=len(before): return None
+    return max([abs(a-b)/max(abs(b), 1e-12) for a, b in zip(now, before)])
+
+
+
+@packet_trace.traced
+def monitor_csa_ibias(c, ioGroup, enableSerial, chips, elapsedTime, \
+                      min_interval=0.5, max_interval=30, \
+                      drift_threshold=0.01, stable_window=300):
+    # round-robin CSA current monitoring, keyed by chip and elapsed seconds:
+    # sample every min_interval while readings move by more than
+    # drift_threshold, back off (doubling up to max_interval) while stable,
+    # stop once all chips are stable for stable_window seconds. Backoff
+    # starts once every chip has two readings to compare. Nothing to do if
+    # none of the requested chips is in the network or there is no meter
+    if len(chips)==0:
+        event_log.warning('monitor_no_chips')
+        return {}
+    if not enableSerial:
+        event_log.warning('monitor_no_meter')
+        return {}
+    connect_tile(c=c)
+    c.io.set_reg(0x25014, 2, io_group=ioGroup)
+    c.io.set_reg(0x25015, 0x10, io_group=ioGroup)
+
+    d={}
+    ser = serial.Serial('/dev/ttyUSB0', 57600)
+
+    interval = min_interval
+    previous, last_transient = {}, {}
+    start = time.time()
+    elapsed_time = 0
+    while elapsed_time<elapsedTime:
+        transient, compared = False, True
+        for chip in chips:
+            t = '{:.3f}'.format(time.time()-start)
+            readings = sample_csa_ibias(c, chip, ser, enableSerial)
+            if str(chip) not in d: d[str(chip)]={}
+            d[str(chip)][t] = readings
+            drift = csa_ibias_drift(readings, previous.get(chip))
+            previous[chip] = readings
+            if drift is None: compared = False
+            if drift is None or drift>drift_threshold:
+                last_transient[chip] = time.time()
+                if drift is not None: transient = True
+        elapsed_time = time.time() - start
+
+        if transient or not compared: interval = min_interval
+        else: interval = min(2*interval, max_interval)
+        stable = [time.time()-last_transient[chip] for chip in chips]
+        print(round(elapsed_time,1),' s\t next sample in ',interval,\
+              ' s\t stable for ',round(min(stable),1),' s')
+        if min(stable)>=stable_window:
+            print('Drift below ',drift_threshold,' for ',stable_window,\
+                  ' s. Stopping early.')
+            break
+        if elapsed_time+interval>=elapsedTime: break
+        time.sleep(interval)
+        elapsed_time = time.time() - start
+
+    c.io.set_reg(0x25014, 0x10, io_group=ioGroup)
+    c.io.set_reg(0x25015, 0x10, io_group=ioGroup)
+
+    now = time.strftime("%Y_%m_%d_%H_%M_%S_%Z")
+    with open('currents_'+now+'.json','w') as outfile:
+        json.dump(d, outfile, indent=4)
+    return d
+
+
+
+@packet_trace.traced
 def measure_csa_ibias_chipid(c, ioGroup, enableSerial, chip, elapsedTime):
-    c.io = larpix.io.PACMAN_IO(relaxed=True)
+    connect_tile(c=c)
     c.io.set_reg(0x25014, 2, io_group=ioGroup)
     c.io.set_reg(0x25015, 0x10, io_group=ioGroup)
 
@@ -939,29 +1320,8 @@ def measure_csa_ibias_chipid(c, ioGroup, enableSerial, chip, elapsedTime):
         time.sleep(5)
         print(elapsed_time)
         now = time.strftime("%Y_%m_%d_%H_%M_%S_%Z")
-        for i in range(4):
-
-            registers_to_write=[]
-            setattr(c[chip].config,f'current_monitor_bank{i}',[0,0,0,1])
-            registers_to_write.append(c[chip].config.register_map[f'current_monitor_bank{i}'])
-            for reg in registers_to_write: c.write_configuration(chip, reg)
-            if enableSerial:
-                ser.write(bytes(':READ?\r\n', 'utf-8'))
-                time.sleep(0.1)
-                response = ser.readline()
-                if now not in d: d[now]=[]
-                d[now].append(response[14:28].decode("utf-8"))            
-            
-            registers_to_write=[]
-            setattr(c[chip].config,f'current_monitor_bank{i}',[0,0,0,0])
-            registers_to_write.append(c[chip].config.register_map[f'current_monitor_bank{i}'])
-            for reg in registers_to_write: c.write_configuration(chip, reg)
-            if enableSerial:
-                ser.write(bytes(':READ?\r\n', 'utf-8'))
-                time.sleep(0.1)
-                response = ser.readline()
-                if now not in d: d[now]=[]
-                d[now].append(response[14:28].decode("utf-8"))
+        readings = sample_csa_ibias(c, chip, ser, enableSerial)
+        if enableSerial: d[now] = readings
 
         elapsed_time = time.time() - start
             
@@ -984,85 +1344,221 @@ def main(logger=_default_logger, pacmanTile=_default_pacmanTile, \
          ref_current_trim=_default_ref_current_trim, \
          enable_ana_mon=_default_enable_ana_mon, \
          read=_default_read, broadcastRead=_default_broadcastRead, \
-         enableSerial=_default_enableSerial):
-
-    c, io = enable_tile(pacmanTile, resetLength, ioGroup)
-    if enable_ana_mon==True: io.set_reg(0x25014,2,io_group=ioGroup)
-    else: io.set_reg(0x25014,0x10,io_group=ioGroup)
-    io.set_reg(0x25015,0x10,io_group=ioGroup)
-
-    if logger==True:
-        c.logger = larpix.logger.HDF5Logger()
-        print('filename: ', c.logger.filename)
-        c.logger.enable()
-
-    io_channels=list(range(1,5,1))
-    if pacmanTile==2: io_channels=list(range(5,9,1))
-    if pacmanTile==0: io_channels=list(range(1,9,1))
-    io_channel_root_chip_id_map={}
-    temp=[21,41,71,91]
-    if pacmanTile!=0:
-        for i in range(len(io_channels)):
-            io_channel_root_chip_id_map[io_channels[i]]=temp[i]
-    if pacmanTile==0:
-        ctr=0
-        for i in io_channels[:4]:
-            io_channel_root_chip_id_map[i]=temp[ctr]
-            ctr+=1
-        ctr=0
-        for i in io_channels[4:]:
-            io_channel_root_chip_id_map[i]=temp[ctr]
-            ctr+=1
-
-    network_ext_node(c, ioGroup, io_channels, io_channel_root_chip_id_map)
-
-
-    root_keys = setup_root_chips(c, io, ioGroup, io_channel_root_chip_id_map, \
-                                 verbose, logger, read, \
-                                 tx_diff=tx_diff, tx_slice=tx_slice, \
-                                 ref_current_trim=ref_current_trim)
+         enableSerial=_default_enableSerial, trace=_default_trace, \
+         monitorChips=_default_monitorChips, monitorTime=_default_monitorTime, \
+         minInterval=_default_minInterval, maxInterval=_default_maxInterval, \
+         driftThreshold=_default_driftThreshold, \
+         stableWindow=_default_stableWindow, \
+         retryAttempts=_default_retryAttempts, \
+         retryBackoff=_default_retryBackoff, \
+         chipFailures=_default_chipFailures, \
+         linkFailures=_default_linkFailures, \
+         waitlistRules=_default_waitlistRules, \
+         controlSocket=_default_controlSocket, plan=_default_plan, \
+         readoutTime=_default_readoutTime, \
+         readoutWorkers=_default_readoutWorkers, \
+         countersFile=_default_countersFile, \
+         countersSocket=_default_countersSocket, \
+         countersInterval=_default_countersInterval, \
+         history=_default_history, tileSerial=_default_tileSerial, \
+         readBuffer=_default_readBuffer, readRetention=_default_readRetention, \
+         disableSettle=_default_disableSettle, \
+         settleThreshold=_default_settleThreshold, \
+         verifyPower=_default_verifyPower, journal=_default_journal, \
+         resume=_default_resume, eventLog=_default_eventLog, \
+         analyze=_default_analyze, currentMonitor=_default_currentMonitor, \
+         currentSigma=_default_currentSigma, currentFloor=_default_currentFloor, \
+         iddaLimit=_default_iddaLimit, idddLimit=_default_idddLimit, \
+         rootWiring=_default_rootWiring, \
+         io=None, timings=None, state=None, outstanding=None):
+    # io reuses an open PACMAN_IO; timings, if a dict, is filled with the
+    # elapsed time [s] at the end of each bring-up phase; state, if a
+    # NetworkState, is filled with the built network and outstanding, if a
+    # list, with the unresolved (daughter key, PISO) pairs. resume replays a
+    # checkpoint journal onto the tile, which must still be powered, and
+    # continues the build from there, appending to the same journal
+    start = time.time()
+    if timings is None: timings = {}
+
+    # verbose detail goes to the console only when there is no event file
+    event_log.open_log(eventLog, event_log.DEBUG if verbose and eventLog==None \
+                       else event_log.INFO)
+    server = None
+    try:
+        if trace!=None: packet_trace.open_trace(trace)
+        if readBuffer!=None: read_buffer.configure(readBuffer, readRetention)
+        if countersFile!=None or countersSocket!=None:
+            live_counters.start(countersInterval, countersFile, countersSocket)
+        policy = retry_policy.configure(attempts=retryAttempts, \
+                                        backoff=retryBackoff, \
+                                        chip_failures=chipFailures, \
+                                        link_failures=linkFailures)
+        if resume!=None:
+            c, io = connect_tile(io)
+            if journal==None: journal = resume
+        else:
+            c, io = enable_tile(pacmanTile, resetLength, ioGroup, io=io, \
+                                verify=verifyPower)
+        timings['enable'] = time.time()-start
+        if enable_ana_mon==True: io.set_reg(0x25014,2,io_group=ioGroup)
+        else: io.set_reg(0x25014,0x10,io_group=ioGroup)
+        io.set_reg(0x25015,0x10,io_group=ioGroup)
+        if currentMonitor!=None:
+            # per-hop IDDA/IDDD fingerprinting: 'flag' logs anomalous hops,
+            # 'abort' undoes them and powers the tile down above the limits
+            current_monitor.configure(lambda tile: read_power(io, ioGroup, tile)[1::2], \
+                                      n_sigma=currentSigma, floor_ma=currentFloor, \
+                                      limit_ma=(iddaLimit, idddLimit), \
+                                      abort=currentMonitor=='abort')
+
+        if logger==True:
+            c.logger = larpix.logger.HDF5Logger()
+            print('filename: ', c.logger.filename)
+            c.logger.enable()
+
+        io_channels=list(range(1,5,1))
+        if pacmanTile==2: io_channels=list(range(5,9,1))
+        if pacmanTile==0: io_channels=list(range(1,9,1))
+        io_channel_root_chip_id_map={}
+        temp=[21,41,71,91]
+        if pacmanTile!=0:
+            for i in range(len(io_channels)):
+                io_channel_root_chip_id_map[io_channels[i]]=temp[i]
+        if pacmanTile==0:
+            ctr=0
+            for i in io_channels[:4]:
+                io_channel_root_chip_id_map[i]=temp[ctr]
+                ctr+=1
+            ctr=0
+            for i in io_channels[4:]:
+                io_channel_root_chip_id_map[i]=temp[ctr]
+                ctr+=1
+
+        network_ext_node(c, ioGroup, io_channels, io_channel_root_chip_id_map)
+        default_roots = dict(io_channel_root_chip_id_map)
+        if history!=None:
+            serials = link_history.tile_serials(ioGroup, io_channels, tileSerial)
+            n = link_history.open_history(history, serials).prime(policy)
+            print('LINK HISTORY:\t',n,' known-dead links skipped')
+        if state is None: state = network_state.NetworkState()
+        state.add_tile(ioGroup, io_channels)
+
+        root_keys = []
+        if resume!=None:
+            root_keys = resume_network(c, io, ioGroup, resume, verbose, state=state)
+            for root in root_keys: del io_channel_root_chip_id_map[root.io_channel]
+        if journal!=None:
+            checkpoint_journal.open_journal(journal, ioGroup, pacmanTile, io_channels)
+        candidates = link_history.order_roots(ioGroup, \
+                                              root_candidates(io_channel_root_chip_id_map, \
+                                                              load_root_wiring(rootWiring)))
+        root_keys += setup_root_chips(c, io, ioGroup, candidates, \
+                                      verbose, logger, read, \
+                                      tx_diff=tx_diff, tx_slice=tx_slice, \
+                                      ref_current_trim=ref_current_trim, \
+                                      state=state)
+        root_keys.sort(key=lambda k: k.io_channel)
+        for root in root_keys:
+            if root.chip_id==default_roots[root.io_channel]: continue
+            network_ext_node(c, ioGroup, [root.io_channel], \
+                             {root.io_channel:root.chip_id})
     
-    print('ROOT KEYS:\t',root_keys)
+        event_log.info('root_keys', chips=root_keys)
+        timings['roots'] = time.time()-start
     
-    if pacmanTile==1 or pacmanTile==2:
-        setup_initial_network(c, io, ioGroup, root_keys, \
-                              verbose, logger, read, \
-                              tx_diff=tx_diff, tx_slice=tx_slice, \
-                              ref_current_trim=ref_current_trim)
-    if pacmanTile==0:
-        setup_initial_network(c, io, ioGroup, root_keys[:4], \
-                              verbose, logger, read, \
-                              tx_diff=tx_diff, tx_slice=tx_slice, \
-                              ref_current_trim=ref_current_trim)
-        setup_initial_network(c, io, ioGroup, root_keys[4:], \
-                              verbose, logger, read, \
-                              tx_diff=tx_diff, tx_slice=tx_slice, \
-                              ref_current_trim=ref_current_trim)
+        if plan!=None:
+            hops = hydra_planner.plan_network(plan, ioGroup, root_keys)
+            setup_planned_network(c, io, ioGroup, hops, \
+                                  verbose, logger, read, \
+                                  tx_diff=tx_diff, tx_slice=tx_slice, \
+                                  ref_current_trim=ref_current_trim, \
+                                  state=state)
+        elif pacmanTile==1 or pacmanTile==2:
+            setup_initial_network(c, io, ioGroup, root_keys, \
+                                  verbose, logger, read, \
+                                  tx_diff=tx_diff, tx_slice=tx_slice, \
+                                  ref_current_trim=ref_current_trim, \
+                                  state=state)
+        elif pacmanTile==0:
+            setup_initial_network(c, io, ioGroup, root_keys[:4], \
+                                  verbose, logger, read, \
+                                  tx_diff=tx_diff, tx_slice=tx_slice, \
+                                  ref_current_trim=ref_current_trim, \
+                                  state=state)
+            setup_initial_network(c, io, ioGroup, root_keys[4:], \
+                                  verbose, logger, read, \
+                                  tx_diff=tx_diff, tx_slice=tx_slice, \
+                                  ref_current_trim=ref_current_trim, \
+                                  state=state)
+        timings['network'] = time.time()-start
         
-    nonconfigured = iterate_waitlist(c, io, ioGroup, activeUser, \
-                                     verbose, logger, read,\
-                                     tx_diff=tx_diff, tx_slice=tx_slice, \
-                                     ref_current_trim=ref_current_trim)
-    print('\n\n',nonconfigured)
-
-    if logger==True and enableSerial==True:
-        measure_csa_ibias(c, ioGroup, enableSerial)
+        rules = None
+        if waitlistRules!=None:
+            rules = waitlist_rules.WaitlistRules.from_file(waitlistRules)
+        if controlSocket!=None:
+            if rules is None: rules = waitlist_rules.WaitlistRules()
+            server = waitlist_rules.serve(rules, controlSocket)
+        nonconfigured = iterate_waitlist(c, io, ioGroup, activeUser, \
+                                         verbose, logger, read,\
+                                         tx_diff=tx_diff, tx_slice=tx_slice, \
+                                         ref_current_trim=ref_current_trim, \
+                                         state=state, rules=rules)
+        if server is not None: waitlist_rules.shutdown(server)
+        server = None
+        timings['waitlist'] = time.time()-start
+        if outstanding is not None: outstanding.extend(nonconfigured)
+        event_log.flush()
+        print('\n\n',nonconfigured)
+        if live_counters.active()!=None: live_counters.active().expect(c.chips)
+        if len(policy.dead)>0: print('RETRY POLICY DEAD:\t',sorted(policy.dead))
+        if current_monitor.active()!=None:
+            print('CURRENT ANOMALIES:\t',[a['chip'] for a \
+                                          in current_monitor.active().anomalies])
+            current_monitor.stop()
+
+        if logger==True and enableSerial==True:
+            measure_csa_ibias(c, ioGroup, enableSerial)
+
+        if monitorChips!=None:
+            chip_ids = [int(i) for i in monitorChips.split(',')]
+            chips = [ck for ck in c.chips if ck.chip_id in chip_ids]
+            monitor_csa_ibias(c, ioGroup, enableSerial, chips, monitorTime, \
+                              min_interval=minInterval, max_interval=maxInterval, \
+                              drift_threshold=driftThreshold, \
+                              stable_window=stableWindow)
+
+        if readoutTime!=None:
+            readout.run(c.io, time.strftime('readout-%Y_%m_%d_%H_%M_%S_%Z.h5'), \
+                        readoutTime, workers=readoutWorkers)
     
-    if logger==True and broadcastRead==True:
-        io.set_reg(0x18,0b11110000,io_group=ioGroup)
-        for chip_key in c.chips:
-            c.read_configuration(chip_key,0)
-        io.set_reg(0x18,0b0,io_group=ioGroup)
+        if logger==True and broadcastRead==True:
+            io.set_reg(0x18,0b11110000,io_group=ioGroup)
+            for chip_key in c.chips:
+                c.read_configuration(chip_key,0)
+            io.set_reg(0x18,0b0,io_group=ioGroup)
     
-    if logger==True: c.logger.flush(); c.logger.disable()
+        if logger==True: c.logger.flush(); c.logger.disable()
+        if logger==True and analyze==True: analyze_hdf5.analyze(c.logger.filename)
  
-    if networkName!=None:
-        write_network_to_file(c, networkName, nonconfigured, \
-                              ioGroup, pacmanTile)
-
-    if disablePower==True: disable_tile(io, pacmanTile, ioGroup)
-
-    return c
+        if networkName!=None:
+            write_network_to_file(c, networkName, nonconfigured, \
+                                  ioGroup, pacmanTile)
+        link_history.close_history(len(c.chips), len(state.waitlist()))
+
+        if disablePower==True:
+            disable_tile(io, pacmanTile, ioGroup, settle=disableSettle, \
+                         threshold=settleThreshold, verify=verifyPower)
+        timings['total'] = time.time()-start
+        return c
+    finally:
+        # close what the bring-up opened, also when it stops early (e.g. a
+        # tile powered down above its current limits)
+        if server is not None: waitlist_rules.shutdown(server)
+        current_monitor.stop()
+        checkpoint_journal.close_journal()
+        packet_trace.close_trace()
+        live_counters.stop()
+        event_log.close_log()
 
 
 
@@ -1101,6 +1597,109 @@ if __name__=='__main__':
                         help='''Broadcast read to all chips on IO channel ''')
     parser.add_argument('--enableSerial', default=_default_enableSerial, \
                         type=bool, help='''Enable serial port''')
+    parser.add_argument('--trace', default=_default_trace, type=str, \
+                        help='''Record PACMAN register operations and packets \
+                        to this binary trace file (see packet_trace.py)''')
+    parser.add_argument('--monitorChips', default=_default_monitorChips, \
+                        type=str, help='''Comma separated chip IDs to monitor \
+                        CSA current round-robin after network build''')
+    parser.add_argument('--monitorTime', default=_default_monitorTime, \
+                        type=float, help='''Maximum CSA current monitoring \
+                        time [s]''')
+    parser.add_argument('--minInterval', default=_default_minInterval, \
+                        type=float, help='''Sampling interval during \
+                        transients [s]''')
+    parser.add_argument('--maxInterval', default=_default_maxInterval, \
+                        type=float, help='''Sampling interval when stable [s]''')
+    parser.add_argument('--driftThreshold', default=_default_driftThreshold, \
+                        type=float, help='''Relative drift between samples \
+                        considered stable''')
+    parser.add_argument('--stableWindow', default=_default_stableWindow, \
+                        type=float, help='''Stop monitoring once stable for \
+                        this long [s]''')
+    parser.add_argument('--retryAttempts', default=_default_retryAttempts, \
+                        type=int, help='''Register write/verify rounds per \
+                        reconcile (default: per-call)''')
+    parser.add_argument('--retryBackoff', default=_default_retryBackoff, \
+                        type=float, help='''Sleep before a repeated write/verify \
+                        round, doubling each round [s]''')
+    parser.add_argument('--chipFailures', default=_default_chipFailures, \
+                        type=int, help='''Failed hops before a chip is marked \
+                        dead and skipped''')
+    parser.add_argument('--linkFailures', default=_default_linkFailures, \
+                        type=int, help='''Failed attempts before a \
+                        parent-daughter link is marked dead and skipped''')
+    parser.add_argument('--waitlistRules', default=_default_waitlistRules, \
+                        type=str, help='''JSON rules file for the waitlist \
+                        phase (replaces activeUser prompts)''')
+    parser.add_argument('--controlSocket', default=_default_controlSocket, \
+                        type=str, help='''Unix socket path to change waitlist \
+                        rules on a running bring-up (see waitlist_rules.py)''')
+    parser.add_argument('--plan', default=_default_plan, type=str, \
+                        help='''Network JSON of a previous run; build a \
+                        depth-minimised, balanced hydra tree from its links''')
+    parser.add_argument('--readoutTime', default=_default_readoutTime, \
+                        type=float, help='''After network build, take data \
+                        for this long with the threaded readout [s]''')
+    parser.add_argument('--readoutWorkers', default=_default_readoutWorkers, \
+                        type=int, help='''Decoding threads for readout''')
+    parser.add_argument('--countersFile', default=_default_countersFile, \
+                        type=str, help='''Write live per-chip packet counter \
+                        snapshots to this JSON file (see live_counters.py)''')
+    parser.add_argument('--countersSocket', default=_default_countersSocket, \
+                        type=str, help='''Serve live per-chip packet counter \
+                        snapshots on this unix socket''')
+    parser.add_argument('--countersInterval', default=_default_countersInterval, \
+                        type=float, help='''Live counter snapshot cadence [s]''')
+    parser.add_argument('--history', default=_default_history, type=str, \
+                        help='''SQLite link-health history; known-dead links \
+                        are skipped and known-good parents tried first''')
+    parser.add_argument('--tileSerial', default=_default_tileSerial, \
+                        type=str, help='''Tile serial(s) for the link history, \
+                        comma separated in io_channel order''')
+    parser.add_argument('--readBuffer', default=_default_readBuffer, type=int, \
+                        help='''Keep controller reads in a compact ring of \
+                        this many packets instead of an unbounded list''')
+    parser.add_argument('--readRetention', default=_default_readRetention, \
+                        type=int, help='''Reads kept in the read buffer ring \
+                        (at least 1)''')
+    parser.add_argument('--disableSettle', default=_default_disableSettle, \
+                        type=float, help='''Wait after disabling tile power [s]''')
+    parser.add_argument('--settleThreshold', default=_default_settleThreshold, \
+                        type=float, help='''Stop waiting once VDDA and VDDD read \
+                        below this [mV]''')
+    parser.add_argument('--verifyPower', default=_default_verifyPower, \
+                        type=bool, help='''Read back the PACMAN registers \
+                        written by the tile power programs''')
+    parser.add_argument('--journal', default=_default_journal, type=str, \
+                        help='''Append every committed hop to this checkpoint \
+                        journal''')
+    parser.add_argument('--resume', default=_default_resume, type=str, \
+                        help='''Replay this checkpoint journal onto the \
+                        still-powered tile and continue the bring-up''')
+    parser.add_argument('--eventLog', default=_default_eventLog, type=str, \
+                        help='''Write configuration events, verbose detail \
+                        included, to this JSON-lines file''')
+    parser.add_argument('--analyze', default=_default_analyze, type=bool, \
+                        help='''Summarize the logger file with analyze_hdf5.py \
+                        at the end of the run''')
+    parser.add_argument('--currentMonitor', default=_default_currentMonitor, \
+                        type=str, choices=['flag', 'abort'], \
+                        help='''Sample IDDA/IDDD around every hop and flag or \
+                        abort hops with anomalous current steps''')
+    parser.add_argument('--currentSigma', default=_default_currentSigma, \
+                        type=float, help='''Anomalous step: standard deviations \
+                        from the mean step of earlier hops''')
+    parser.add_argument('--currentFloor', default=_default_currentFloor, \
+                        type=float, help='''Smallest step deviation flagged [mA]''')
+    parser.add_argument('--iddaLimit', default=_default_iddaLimit, type=float, \
+                        help='''Tile IDDA limit [mA]''')
+    parser.add_argument('--idddLimit', default=_default_idddLimit, type=float, \
+                        help='''Tile IDDD limit [mA]''')
+    parser.add_argument('--rootWiring', default=_default_rootWiring, type=str, \
+                        help='''JSON {io_channel: [chip_id, ...]} of the edge \
+                        chips each io_channel physically reaches; probes them \
+                        all and roots each io_channel at the first responder''')
                         
     args = parser.parse_args()
     c = main(**vars(args))
@@ -0,0 +1,291 @@
+import argparse
+import functools
+import struct
+import time
+
+# fixed 32-byte little-endian records, appended as the run proceeds:
+# kind, function id, io_group, io_channel, chip_id, hydra depth, packet type,
+# pad, address, value, monotonic time [ns], duration [ns]. RX records carry
+# the PACMAN receipt timestamp [PACMAN clock ticks, 0 if unknown] in place
+# of the duration: the controller only drains received packets after its
+# read timeout, so their host time says nothing about when they arrived.
+# CALL records time one call of a traced function (start and duration).
+_record = struct.Struct('<BBBBBBBxIIQQ')
+# function name records share the record size so the file stays seekable
+_name_record = struct.Struct('<BB30s')
+
+KIND_SET_REG=0
+KIND_GET_REG=1
+KIND_TX=2
+KIND_RX=3
+KIND_CALL=4
+KIND_NAME=255
+
+CONFIG_READ_PACKET=3
+
+_recorder=None
+
+
+
+class TraceRecorder:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.functions = {'':0}
+        self.stack = [0]
+        self.depth = {}
+
+    def function_id(self, name):
+        if name not in self.functions:
+            self.functions[name] = len(self.functions)
+            self.file.write(_name_record.pack(KIND_NAME, self.functions[name], \
+                                              name.encode()[:30]))
+        return self.functions[name]
+
+    def record(self, kind, io_group=0, io_channel=0, chip_id=0, \
+               packet_type=0, address=0, value=0, t_ns=None, duration_ns=0):
+        if t_ns is None: t_ns = time.monotonic_ns()
+        depth = self.depth.get((io_group, io_channel, chip_id), 0)
+        self.file.write(_record.pack(kind, self.stack[-1], io_group & 0xff, \
+                                     io_channel & 0xff, chip_id & 0xff, \
+                                     min(depth, 0xff), packet_type & 0xff, \
+                                     address & 0xffffffff, \
+                                     value & 0xffffffff, t_ns, duration_ns))
+
+    def record_packets(self, kind, packets):
+        t_ns = time.monotonic_ns()
+        for p in packets:
+            if not hasattr(p, 'chip_id'): continue
+            self.record(kind, _field(p, 'io_group'), _field(p, 'io_channel'), \
+                        _field(p, 'chip_id'), _field(p, 'packet_type'), \
+                        _field(p, 'register_address'), \
+                        _field(p, 'register_data'), t_ns=t_ns, \
+                        duration_ns=_field(p, 'receipt_timestamp') \
+                                    if kind==KIND_RX else 0)
+
+    def close(self):
+        self.file.flush()
+        self.file.close()
+
+
+
+def _field(packet, attr):
+    value = getattr(packet, attr, 0)
+    if value is None: return 0
+    return int(value)
+
+
+
+def open_trace(filename):
+    global _recorder
+    if _recorder is not None: _recorder.close()
+    _recorder = TraceRecorder(filename)
+    return _recorder
+
+
+
+def close_trace():
+    global _recorder
+    if _recorder is not None: _recorder.close()
+    _recorder = None
+
+
+
+def _wrap_reg(recorder, func, kind):
+    @functools.wraps(func)
+    def wrapper(reg, *args, **kwargs):
+        start = time.monotonic_ns()
+        value = func(reg, *args, **kwargs)
+        end = time.monotonic_ns()
+        io_group = kwargs.get('io_group')
+        if io_group is None: io_group = 0
+        if kind==KIND_SET_REG: written = args[0] if args else kwargs.get('val', 0)
+        else: written = value if isinstance(value, int) else 0
+        recorder.record(kind, io_group=io_group, address=reg, value=written, \
+                        t_ns=start, duration_ns=end-start)
+        return value
+    return wrapper
+
+
+
+def attach(c):
+    # no-op unless a trace was opened; safe to call again after c.io changes
+    if _recorder is None: return c
+    recorder = _recorder
+    if c.io is not None and not getattr(c.io, '_packet_trace', False):
+        c.io.set_reg = _wrap_reg(recorder, c.io.set_reg, KIND_SET_REG)
+        c.io.get_reg = _wrap_reg(recorder, c.io.get_reg, KIND_GET_REG)
+        c.io._packet_trace = True
+    if not getattr(c, '_packet_trace', False):
+        send, read = c.send, c.read
+        def traced_send(packets):
+            recorder.record_packets(KIND_TX, packets)
+            return send(packets)
+        def traced_read():
+            packets, bytestream = read()
+            recorder.record_packets(KIND_RX, packets)
+            return packets, bytestream
+        c.send, c.read = traced_send, traced_read
+        c._packet_trace = True
+    return c
+
+
+
+def record_registers(kind, io_group, pairs, start_ns, end_ns):
+    # register (address, value) pairs issued as one batched transaction
+    if _recorder is None: return
+    for reg, val in pairs:
+        _recorder.record(kind, io_group=io_group, address=reg, value=val, \
+                         t_ns=start_ns, duration_ns=end_ns-start_ns)
+
+
+
+def record_hop(parent, daughter):
+    # hydra depth of daughter is one more than its parent, roots are depth 1
+    # (recorded before the hop is verified, so failed hops keep their depth)
+    if _recorder is None: return
+    depth = 0
+    if parent is not None:
+        depth = _recorder.depth.get((parent.io_group, parent.io_channel, \
+                                     parent.chip_id), 0)
+    _recorder.depth[(daughter.io_group, daughter.io_channel, \
+                     daughter.chip_id)] = depth+1
+
+
+
+def traced(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        recorder = _recorder
+        if recorder is None: return func(*args, **kwargs)
+        recorder.stack.append(recorder.function_id(func.__name__))
+        start = time.monotonic_ns()
+        try: return func(*args, **kwargs)
+        finally:
+            if recorder is _recorder:
+                recorder.record(KIND_CALL, t_ns=start, \
+                                duration_ns=time.monotonic_ns()-start)
+            recorder.stack.pop()
+    return wrapper
+
+
+
+def load_trace(filename):
+    import numpy as np
+    dtype = np.dtype([('kind','u1'), ('func','u1'), ('io_group','u1'), \
+                      ('io_channel','u1'), ('chip_id','u1'), ('depth','u1'), \
+                      ('packet_type','u1'), ('pad','u1'), ('address','<u4'), \
+                      ('value','<u4'), ('t_ns','<u8'), ('duration_ns','<u8')])
+    records = np.memmap(filename, dtype=dtype, mode='r')
+    raw = records.view(np.dtype(('V', _record.size)))
+    names = {0:'(untraced)'}
+    for i in np.flatnonzero(records['kind']==KIND_NAME):
+        _, func_id, name = _name_record.unpack(raw[i].tobytes())
+        names[func_id] = name.rstrip(b'\x00').decode()
+    return records, names
+
+
+
+def round_trips(records, clock_hz=10e6, window_s=10.):
+    # Config read replies matched to the latest earlier request for the
+    # same chip and register, and their round trip [ns]: host send time of
+    # the request to PACMAN receipt time of the reply. The two clocks are
+    # tied together through the drain time of each reply, which undoes
+    # receipt timestamp wraps, and anchored on the fastest reply sent in
+    # the same window_s (their offset is otherwise unknown; per window
+    # follows clock drift), so round trips are above that fastest reply.
+    # Replies without a PACMAN receipt timestamp are left out. Returns the
+    # request records and round trips
+    import numpy as np
+    index = np.flatnonzero((records['packet_type']==CONFIG_READ_PACKET) & \
+                           ((records['kind']==KIND_TX) | \
+                            ((records['kind']==KIND_RX) & \
+                             (records['duration_ns']>0))))
+    rows = records[index]
+    key = (rows['io_group'].astype(np.uint64)<<np.uint64(48)) | \
+          (rows['io_channel'].astype(np.uint64)<<np.uint64(40)) | \
+          (rows['chip_id'].astype(np.uint64)<<np.uint64(32)) | \
+          rows['address'].astype(np.uint64)
+    order = np.lexsort((index, key))
+    rows, key = rows[order], key[order]
+    is_tx = rows['kind']==KIND_TX
+    last_tx = np.maximum.accumulate(np.where(is_tx, np.arange(len(rows)), -1))
+    reply = ~is_tx & (last_tx>=0)
+    reply[reply] = key[last_tx[reply]]==key[reply]
+    if not reply.any(): return rows[:0], np.zeros(0)
+    rx, tx = rows[reply], rows[last_tx[reply]]
+    drain = rx['t_ns'].astype(np.float64)*clock_hz*1e-9
+    lag = np.mod(drain-rx['duration_ns'], 2.**32)
+    lag = lag[0]+np.mod(lag-lag[0]+2.**31, 2.**32)-2.**31
+    ticks = drain-lag-tx['t_ns'].astype(np.float64)*clock_hz*1e-9
+    window, inverse = np.unique(tx['t_ns']//int(window_s*1e9), return_inverse=True)
+    fastest = np.full(len(window), np.inf)
+    np.minimum.at(fastest, inverse, ticks)
+    return tx, (ticks-fastest[inverse])*1e9/clock_hz
+
+
+
+def _summarize(labels, values, scale=1e-6):
+    import numpy as np
+    summary = {}
+    for label in np.unique(labels):
+        v = values[labels==label]*scale
+        summary[label] = (len(v), np.percentile(v, 50), np.percentile(v, 90), \
+                          np.percentile(v, 99), v.max())
+    return summary
+
+
+
+def _print_summary(title, summary, names=None):
+    print('\n',title)
+    print('\t{:<28}{:>8}{:>10}{:>10}{:>10}{:>10}'.format('', 'count', \
+          'p50[ms]', 'p90[ms]', 'p99[ms]', 'max[ms]'))
+    for label, s in summary.items():
+        if names is not None: label = names.get(int(label), str(label))
+        print('\t{:<28}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(\
+              str(label), *s))
+
+
+
+def analyze(filename, clock_hz=10e6):
+    import numpy as np
+    records, names = load_trace(filename)
+    is_read = records['packet_type']==CONFIG_READ_PACKET
+    n_tx = np.count_nonzero(is_read & (records['kind']==KIND_TX))
+    n_rx = np.count_nonzero(is_read & (records['kind']==KIND_RX))
+    tx, rtt = round_trips(records, clock_hz)
+    print(filename,': ',len(records),' records, ',n_tx,' config read requests, ', \
+          n_rx,' replies')
+    if len(rtt):
+        print('round trips: request send (host clock) to reply receipt (PACMAN '\
+              'clock), above the fastest reply of each 10 s')
+        _print_summary('config read round trip by io_channel', \
+                       _summarize(tx['io_channel'], rtt))
+        _print_summary('config read round trip by hydra depth', \
+                       _summarize(tx['depth'], rtt))
+        _print_summary('config read round trip by requesting function', \
+                       _summarize(tx['func'], rtt), names)
+    elif n_rx>0: print('no PACMAN receipt timestamps, round trips not available')
+    calls = records[records['kind']==KIND_CALL]
+    if len(calls):
+        _print_summary('traced calls by function', \
+                       _summarize(calls['func'], \
+                                  calls['duration_ns'].astype(np.int64)), names)
+    regs = records[(records['kind']==KIND_SET_REG) | \
+                   (records['kind']==KIND_GET_REG)]
+    if len(regs):
+        _print_summary('PACMAN register operations by function', \
+                       _summarize(regs['func'], \
+                                  regs['duration_ns'].astype(np.int64)), names)
+    return
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename', type=str, \
+                        help='''Trace file written with networking.py --trace''')
+    parser.add_argument('--clockHz', default=10e6, type=float, \
+                        help='''PACMAN receipt timestamp clock [Hz]''')
+    args = parser.parse_args()
+    analyze(args.filename, clock_hz=args.clockHz)
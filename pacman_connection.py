@@ -0,0 +1,195 @@
+import argparse
+import functools
+import threading
+import time
+
+import zmq
+
+import larpix
+import larpix.io
+from larpix.format import pacman_msg_format
+
+_ping = pacman_msg_format.format_msg('REQ', [('PING',)])
+
+_connections={}
+
+
+
+class PacmanConnection:
+    # One long-lived PACMAN_IO per io configuration file (io/pacman.json
+    # by default), shared by every phase of a run. The io holds a command
+    # (REQ) and data (SUB) socket pair per io_group; get() pings each
+    # io_group at most every check_interval seconds, with a check_timeout
+    # instead of PACMAN_IO's blocking recv, and rebuilds only the sockets
+    # of an io_group that does not answer. Command replies wait at most
+    # request_timeout, and a send/set_reg/get_reg that fails is retried
+    # once after a forced check, so a PACMAN dropping mid-phase is
+    # reconnected or raises ConnectionError instead of hanging. The
+    # PACMAN_IO object itself is never replaced, so anything holding it or
+    # wrapping its methods (packet_trace) keeps working across reconnects;
+    # a running readout polls the data sockets under the connection lock
+    # (io._connection_lock), so they are never swapped under it.
+    def __init__(self, config_filepath=None, hwm=20000, check_interval=10., \
+                 check_timeout=1., request_timeout=5., io=None):
+        self.config_filepath = config_filepath
+        self.io = larpix.io.PACMAN_IO(config_filepath=config_filepath, hwm=hwm, \
+                                      relaxed=True) if io is None else io
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.request_timeout = request_timeout
+        self.last_check = {}
+        self.reconnects = dict([(io_group, 0) for io_group in self.io_groups()])
+        self.lock = threading.RLock()
+        if hasattr(self.io, 'senders'): self.guard_io()
+
+    def guard_io(self):
+        io = self.io
+        io._connection_lock = self.lock
+        for sender in io.senders.values():
+            sender.setsockopt(zmq.RCVTIMEO, int(self.request_timeout*1e3))
+        for name in ['send', 'set_reg', 'get_reg']:
+            if hasattr(io, name): setattr(io, name, self.guarded(getattr(io, name)))
+
+    def guarded(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs): return self.call(func, *args, **kwargs)
+        return wrapper
+
+    def call(self, func, *args, **kwargs):
+        # func(*args, **kwargs), retried once after a forced health check if
+        # a PACMAN command socket fails or times out
+        try: return func(*args, **kwargs)
+        except zmq.ZMQError as e: error = e
+        print('PACMAN request failed (',error,'), checking connection')
+        healthy = self.check(force=True)
+        if not all(healthy.values()):
+            raise ConnectionError('PACMAN io_group(s) {} not responding'.format(\
+                [io_group for io_group, ok in healthy.items() if not ok])) from error
+        return func(*args, **kwargs)
+
+    def io_groups(self):
+        return sorted(getattr(self.io, '_io_group_table', {}))
+
+    def ping(self, io_group):
+        # IO classes without PACMAN sockets are always healthy
+        if not hasattr(self.io, 'senders'): return True
+        sender = self.io.senders[self.io._io_group_table[io_group]]
+        try:
+            sender.send(_ping)
+            if not sender.poll(int(self.check_timeout*1e3)): return False
+            header, words = pacman_msg_format.parse_msg(sender.recv())
+        except zmq.ZMQError: return False
+        return len(words)>0 and words[0][0]=='PONG'
+
+    def reconnect(self, io_group):
+        # replace the socket pair of one io_group in place, with the
+        # options PACMAN_IO sets (REQ_RELAXED, no linger) and the
+        # request_timeout; holds the connection lock so a readout thread is
+        # not polling the sockets while they are swapped
+        io = self.io
+        address = io._io_group_table[io_group]
+        with self.lock:
+            listening = getattr(io, 'is_listening', False)
+            io.poller.unregister(io.receivers[address])
+            io.senders[address].close(linger=0)
+            io.receivers[address].close(linger=0)
+            sender = io.context.socket(zmq.REQ)
+            sender.setsockopt(zmq.REQ_RELAXED, True)
+            sender.setsockopt(zmq.LINGER, 0)
+            sender.setsockopt(zmq.RCVTIMEO, int(self.request_timeout*1e3))
+            receiver = io.context.socket(zmq.SUB)
+            receiver.set_hwm(io.hwm)
+            receiver.setsockopt(zmq.LINGER, 0)
+            if listening: receiver.setsockopt(zmq.SUBSCRIBE, b'')
+            sender.connect('tcp://'+address+':'+io.cmdserver_port)
+            receiver.connect('tcp://'+address+':'+io.dataserver_port)
+            io.senders[address] = sender
+            io.receivers[address] = receiver
+            io.poller.register(receiver, zmq.POLLIN)
+        self.reconnects[io_group] += 1
+        print('PACMAN io_group ',io_group,' (',address,') reconnected')
+
+    def check(self, force=False):
+        # {io_group: healthy} after reconnecting any io_group that failed
+        healthy = {}
+        with self.lock:
+            now = time.monotonic()
+            for io_group in self.io_groups():
+                if not force and now-self.last_check.get(io_group, -1e9) \
+                   <self.check_interval:
+                    healthy[io_group] = True
+                    continue
+                healthy[io_group] = self.ping(io_group)
+                if not healthy[io_group]:
+                    self.reconnect(io_group)
+                    healthy[io_group] = self.ping(io_group)
+                if healthy[io_group]: self.last_check[io_group] = now
+                else: print('PACMAN io_group ',io_group,' NOT responding')
+        return healthy
+
+    def get(self):
+        self.check()
+        return self.io
+
+    def close(self):
+        if hasattr(self.io, 'cleanup'): self.io.cleanup()
+
+
+
+def connect(config_filepath=None, **kwargs):
+    # the shared connection for config_filepath, opened on first use
+    if config_filepath not in _connections:
+        _connections[config_filepath] = PacmanConnection(config_filepath, **kwargs)
+    return _connections[config_filepath]
+
+
+
+def get_io(config_filepath=None):
+    # health-checked shared PACMAN_IO, to be used instead of a new PACMAN_IO
+    return connect(config_filepath).get()
+
+
+
+def _connection(io):
+    for connection in _connections.values():
+        if connection.io is io: return connection
+    return None
+
+
+
+def check(io):
+    # health-check io if it is a shared connection; other IO objects pass
+    connection = _connection(io)
+    if connection is None: return {}
+    return connection.check()
+
+
+
+def call(io, func, *args, **kwargs):
+    # func(*args, **kwargs) for a transaction on io's sockets made outside
+    # PACMAN_IO, retried like PACMAN_IO's own if io is a shared connection
+    connection = _connection(io)
+    if connection is None: return func(*args, **kwargs)
+    return connection.call(func, *args, **kwargs)
+
+
+
+def close_all():
+    for connection in _connections.values(): connection.close()
+    _connections.clear()
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=None, type=str, \
+                        help='''PACMAN io configuration (default: io/pacman.json)''')
+    parser.add_argument('--timeout', default=1., type=float, \
+                        help='''Ping timeout [s]''')
+    args = parser.parse_args()
+    connection = connect(args.config, check_timeout=args.timeout)
+    for io_group, ok in connection.check(force=True).items():
+        print('io_group ',io_group,'\t',connection.io._io_group_table[io_group], \
+              '\t','OK' if ok else 'NOT responding', \
+              '\t reconnects: ',connection.reconnects[io_group])
+    close_all()
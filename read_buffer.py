@@ -0,0 +1,167 @@
+import collections
+
+import numpy as np
+
+from larpix import Packet_v2, TimestampPacket, SyncPacket, TriggerPacket
+from larpix.packet.packet_collection import PacketCollection
+
+import readout
+
+# kind of each stored word
+KIND_PACKET=0
+KIND_TIMESTAMP=4
+KIND_SYNC=6
+KIND_TRIGGER=7
+_dtype=np.dtype([('word','<u8'), ('receipt_timestamp','<u4'), \
+                 ('io_group','u1'), ('io_channel','u1'), ('kind','u1')])
+
+
+
+def _encode(packet):
+    # (word, receipt_timestamp, io_group, io_channel, kind) or None for
+    # packet types that are not kept
+    io_group = getattr(packet, 'io_group', None) or 0
+    if isinstance(packet, Packet_v2):
+        return (int.from_bytes(packet.bytes(), 'little'), \
+                getattr(packet, 'receipt_timestamp', None) or 0, io_group, \
+                packet.io_channel or 0, KIND_PACKET)
+    if isinstance(packet, TimestampPacket):
+        return (packet.timestamp or 0, 0, io_group, 0, KIND_TIMESTAMP)
+    if isinstance(packet, SyncPacket):
+        return ((packet.timestamp or 0) | (ord(packet.sync_type or b'\x00')<<32) \
+                | ((packet.clk_source or 0)<<40), 0, io_group, 0, KIND_SYNC)
+    if isinstance(packet, TriggerPacket):
+        return ((packet.timestamp or 0) | (ord(packet.trigger_type or b'\x00')<<32), \
+                0, io_group, 0, KIND_TRIGGER)
+    return None
+
+
+
+def _decode(row):
+    word, kind = int(row['word']), row['kind']
+    if kind==KIND_PACKET:
+        packet = Packet_v2(word.to_bytes(8, 'little'))
+        packet.io_group = int(row['io_group'])
+        packet.io_channel = int(row['io_channel'])
+        packet.receipt_timestamp = int(row['receipt_timestamp'])
+    elif kind==KIND_TIMESTAMP:
+        packet = TimestampPacket(timestamp=word)
+    elif kind==KIND_SYNC:
+        packet = SyncPacket(sync_type=bytes([(word>>32)&0xff]), \
+                            clk_source=(word>>40)&0x1, timestamp=word&0xffffffff)
+    else:
+        packet = TriggerPacket(trigger_type=bytes([(word>>32)&0xff]), \
+                               timestamp=word&0xffffffff)
+    packet.io_group = int(row['io_group'])
+    return packet
+
+
+
+class ReadRing:
+    # Drop-in replacement for Controller.reads. Packets of every stored
+    # read are packed into a preallocated ring of capacity 15-byte rows
+    # (raw packet word, receipt timestamp, io_group, io_channel, kind) and
+    # only the newest max_reads reads are kept, so memory stays flat however
+    # many verifies a bring-up does. Bytestreams are not kept. Indexing
+    # gives a PacketCollection decoded on access (the newest read is handed
+    # back as stored, so c.reads[-1] costs nothing); array(i) gives the
+    # read as LArPix+HDF5 packet rows and words(i) the raw ring rows.
+    def __init__(self, capacity=2**18, max_reads=256):
+        self.capacity = capacity
+        self.ring = np.zeros(capacity, dtype=_dtype)
+        self.total = 0       # rows ever written
+        self.index = collections.deque() # (read_id, start row, n, message)
+        self.max_reads = max_reads
+        self.last = None     # newest PacketCollection as appended
+        self.evicted = 0     # reads dropped for retention
+
+    def append(self, collection):
+        rows = [r for r in map(_encode, collection.packets) if r is not None]
+        rows = rows[-self.capacity:]
+        start = self.total
+        if len(rows)>0:
+            data = np.array(rows, dtype=_dtype)
+            i = np.arange(start, start+len(data))%self.capacity
+            self.ring[i] = data
+        self.total += len(rows)
+        self.index.append((collection.read_id, start, len(rows), collection.message))
+        while len(self.index)>self.max_reads or \
+              self.index[0][1]<self.total-self.capacity:
+            self.index.popleft()
+            self.evicted += 1
+        self.last = collection
+        collection.bytestream = b''
+
+    def __len__(self):
+        return len(self.index)
+
+    def _position(self, i):
+        if i<0: i += len(self.index)
+        if i<0 or i>=len(self.index): raise IndexError('read index out of range')
+        return i
+
+    def words(self, i):
+        read_id, start, n, message = self.index[self._position(i)]
+        return self.ring[np.arange(start, start+n)%self.capacity]
+
+    def array(self, i):
+        rows = self.words(i)
+        out = np.zeros(len(rows), dtype=readout._dtype)
+        out['io_group'] = rows['io_group']
+        packets = np.nonzero(rows['kind']==KIND_PACKET)[0]
+        out['io_channel'][packets] = rows['io_channel'][packets]
+        out['receipt_timestamp'][packets] = rows['receipt_timestamp'][packets]
+        readout.fill_packets(out, packets, rows['word'][packets])
+        other = rows['kind']!=KIND_PACKET
+        out['packet_type'][other] = rows['kind'][other]
+        out['timestamp'][other] = rows['word'][other] & np.uint64(0xffffffff)
+        out['trigger_type'][other] = (rows['word'][other]>>np.uint64(32)) & np.uint64(0xff)
+        out['dataword'][other] = (rows['word'][other]>>np.uint64(40)) & np.uint64(0x1)
+        return out
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = self._position(i)
+        read_id, start, n, message = self.index[i]
+        if i==len(self.index)-1 and self.last is not None: return self.last
+        collection = PacketCollection([_decode(row) for row in self.words(i)], \
+                                      bytestream=b'', message=message, \
+                                      read_id=read_id)
+        return collection
+
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+
+    def clear(self):
+        self.index.clear()
+        self.last = None
+
+    def nbytes(self):
+        return self.ring.nbytes
+
+
+
+_settings=None
+
+
+
+def configure(capacity=2**18, max_reads=256):
+    # ReadRing needs room for at least one read: c.reads[-1] is read back
+    # after every verify
+    global _settings
+    if capacity<1 or max_reads<1:
+        raise ValueError('read buffer needs capacity and max_reads of at '\
+                         'least 1, got {} and {}'.format(capacity, max_reads))
+    _settings = dict(capacity=capacity, max_reads=max_reads)
+    return _settings
+
+
+
+def attach(c):
+    # no-op unless configured; existing reads are moved into the ring
+    if _settings is None or isinstance(c.reads, ReadRing): return c
+    ring = ReadRing(**_settings)
+    for collection in c.reads: ring.append(collection)
+    c.reads = ring
+    return c
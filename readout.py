@@ -0,0 +1,297 @@
+import argparse
+import contextlib
+import queue
+import threading
+import time
+
+import h5py
+import numpy as np
+import zmq
+
+import larpix
+from larpix.format import hdf5format
+
+import live_counters
+import pacman_connection
+
+# LArPix+HDF5 version written; the packets dtype matches HDF5Logger output
+# so files can be read back with larpix.format.hdf5format.from_file
+_version='2.3'
+_dtype=np.dtype(hdf5format.dtypes[_version]['packets'])
+_header_len=8
+_word_len=16
+_msg_type_data=ord('D')
+_word_type_data=ord('D')
+_word_type_trig=ord('T')
+_word_type_sync=ord('S')
+
+
+
+def _bits(p, shift, n):
+    return ((p>>np.uint64(shift)) & np.uint64((1<<n)-1)).astype(np.uint8)
+
+
+
+def fill_packets(out, rows, p):
+    # bit fields of the 64-bit LArPix v2 packet words p into out[rows];
+    # like HDF5Logger, every field is filled whatever the packet type
+    out['packet_type'][rows] = _bits(p, 0, 2)
+    out['chip_id'][rows] = _bits(p, 2, 8)
+    out['channel_id'][rows] = _bits(p, 10, 6)
+    out['timestamp'][rows] = (p>>np.uint64(16)) & np.uint64(0x7fffffff)
+    out['first_packet'][rows] = _bits(p, 47, 1)
+    out['dataword'][rows] = _bits(p, 48, 8)
+    out['trigger_type'][rows] = _bits(p, 56, 2)
+    out['local_fifo'][rows] = _bits(p, 58, 2)
+    out['shared_fifo'][rows] = _bits(p, 60, 2)
+    out['downstream_marker'][rows] = _bits(p, 62, 1)
+    out['parity'][rows] = _bits(p, 63, 1)
+    out['register_address'][rows] = _bits(p, 10, 8)
+    out['register_data'][rows] = _bits(p, 18, 8)
+    ones = np.unpackbits(np.ascontiguousarray(p, dtype='<u8').view(np.uint8)\
+                         .reshape(-1, 8), axis=1).sum(axis=1)
+    out['valid_parity'][rows] = ones%2
+    out['direction'][rows] = 1
+
+
+
+def decode(messages, io_groups):
+    # Vectorised equivalent of pacman_msg_format.parse for a batch of
+    # PACMAN data messages: one timestamp row (packet_type 4) per message
+    # header followed by one row per DATA/TRIG/SYNC word, in arrival order.
+    messages = [(m, g) for m, g in zip(messages, io_groups) \
+                if len(m)>=_header_len and m[0]==_msg_type_data]
+    if len(messages)==0: return np.zeros(0, dtype=_dtype)
+    n_words = np.array([(len(m)-_header_len)//_word_len for m, g in messages])
+    headers = np.frombuffer(b''.join([m[:_header_len] for m, g in messages]), \
+                            dtype=np.uint8).reshape(-1, _header_len)
+    words = np.frombuffer(b''.join([m[_header_len:_header_len+_word_len*n] \
+                                    for (m, g), n in zip(messages, n_words)]), \
+                          dtype=np.uint8).reshape(-1, _word_len)
+
+    start = np.cumsum(n_words+1)-(n_words+1)
+    msg_index = np.repeat(np.arange(len(messages)), n_words)
+    word_rank = np.arange(len(words))-np.repeat(np.cumsum(n_words)-n_words, n_words)
+    rows = start[msg_index]+1+word_rank
+    io_group = np.array([g for m, g in messages], dtype=np.uint8)
+
+    out = np.zeros(len(messages)+len(words), dtype=_dtype)
+    out['io_group'][start] = io_group
+    out['packet_type'][start] = 4
+    out['timestamp'][start] = headers[:,1:5].copy().view('<u4')[:,0]
+    if len(words)==0: return out
+
+    word_type = words[:,0]
+    out['io_group'][rows] = io_group[msg_index]
+
+    data = word_type==_word_type_data
+    r = rows[data]
+    p = words[data,8:16].copy().view('<u8')[:,0]
+    out['io_channel'][r] = words[data,1]
+    out['receipt_timestamp'][r] = words[data,2:6].copy().view('<u4')[:,0]
+    fill_packets(out, r, p)
+
+    trig = word_type==_word_type_trig
+    out['packet_type'][rows[trig]] = 7
+    out['trigger_type'][rows[trig]] = words[trig,1]
+    out['timestamp'][rows[trig]] = words[trig,4:8].copy().view('<u4')[:,0]
+
+    sync = word_type==_word_type_sync
+    out['packet_type'][rows[sync]] = 6
+    out['trigger_type'][rows[sync]] = words[sync,1]
+    out['dataword'][rows[sync]] = words[sync,2] & 0x01
+    out['timestamp'][rows[sync]] = words[sync,4:8].copy().view('<u4')[:,0]
+
+    # words of unknown type are dropped, as in pacman_msg_format.parse
+    keep = np.ones(len(out), dtype=bool)
+    keep[rows[~(data | trig | sync)]] = False
+    if not keep.all(): out = out[keep]
+    return out
+
+
+
+class Readout:
+    # Long-run data taking straight from the PACMAN data sockets.
+    # One reader thread drains raw messages in batches, a pool of worker
+    # threads decodes batches into structured arrays and one writer thread
+    # appends them to HDF5 in chunks of at least chunk_rows rows, in
+    # arrival order. The raw and decoded queues are bounded: when the
+    # writer falls behind the workers block, and when the raw queue stays
+    # full for block_timeout the reader drops the batch and counts it, so
+    # memory stays bounded and losses are reported rather than hidden.
+    def __init__(self, io, filename, workers=4, batch_size=256, \
+                 queue_size=64, chunk_rows=2**18, flush_interval=2., \
+                 block_timeout=0.5):
+        self.io = io
+        self.filename = filename
+        self.workers = workers
+        self.batch_size = batch_size
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.raw = queue.Queue(maxsize=queue_size)
+        self.decoded = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.stats = dict(messages=0, bytes=0, batches=0, \
+                          dropped_messages=0, dropped_batches=0, \
+                          decode_errors=0, rows=0, chunks=0, \
+                          max_raw_queue=0, max_decoded_queue=0)
+        self.threads = []
+
+    def _count(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items(): self.stats[k] += v
+
+    def _peak(self, k, v):
+        with self.lock:
+            if v>self.stats[k]: self.stats[k] = v
+
+    def _read(self):
+        # the data sockets are polled under the shared connection's lock,
+        # which pacman_connection holds while it swaps sockets
+        seq = 0
+        groups = self.io._io_group_table.inv
+        lock = getattr(self.io, '_connection_lock', None) or contextlib.nullcontext()
+        while not self.stopping.is_set():
+            batch, io_groups, n_bytes = [], [], 0
+            with lock:
+                events = dict(self.io.poller.poll(100))
+                while len(events)>0 and len(batch)<self.batch_size:
+                    for socket in events:
+                        try: message = socket.recv(zmq.NOBLOCK)
+                        except zmq.Again: continue
+                        batch.append(message)
+                        io_groups.append(groups[self.io.receivers.inv[socket]])
+                        n_bytes += len(message)
+                    events = dict(self.io.poller.poll(0))
+            if len(batch)==0: continue
+            self._count(messages=len(batch), bytes=n_bytes)
+            try:
+                self.raw.put((seq, batch, io_groups), timeout=self.block_timeout)
+            except queue.Full:
+                self._count(dropped_messages=len(batch), dropped_batches=1)
+                continue
+            self._count(batches=1)
+            self._peak('max_raw_queue', self.raw.qsize())
+            seq += 1
+        for i in range(self.workers): self.raw.put(None)
+
+    def _decode(self):
+        while True:
+            item = self.raw.get()
+            if item is None: break
+            seq, batch, io_groups = item
+            try:
+                rows = decode(batch, io_groups)
+            except (ValueError, IndexError):
+                self._count(decode_errors=1, dropped_messages=len(batch))
+                rows = np.zeros(0, dtype=_dtype)
+            counters = live_counters.active()
+            if counters is not None: counters.update_array(rows)
+            self.decoded.put((seq, rows))
+            self._peak('max_decoded_queue', self.decoded.qsize())
+        self.decoded.put(None)
+
+    def _write(self):
+        with h5py.File(self.filename, 'a') as f:
+            if '_header' not in f:
+                header = f.create_group('_header')
+                header.attrs['version'] = _version
+                header.attrs['created'] = time.time()
+                f.create_dataset('messages', shape=(0,), maxshape=(None,), \
+                                 dtype=hdf5format.dtypes[_version]['messages'])
+            if 'packets' not in f:
+                f.create_dataset('packets', shape=(0,), maxshape=(None,), \
+                                 chunks=(min(self.chunk_rows, 2**16),), \
+                                 dtype=_dtype)
+            dset = f['packets']
+            pending, buffer, n_buffer = {}, [], 0
+            next_seq, done, last = 0, 0, time.time()
+            while done<self.workers:
+                try: item = self.decoded.get(timeout=self.flush_interval)
+                except queue.Empty: item = ()
+                if item is None: done += 1
+                elif len(item)>0: pending[item[0]] = item[1]
+                while next_seq in pending:
+                    rows = pending.pop(next_seq)
+                    buffer.append(rows)
+                    n_buffer += len(rows)
+                    next_seq += 1
+                if n_buffer>=self.chunk_rows or \
+                   (n_buffer>0 and time.time()-last>self.flush_interval):
+                    self._append(dset, buffer, n_buffer)
+                    buffer, n_buffer, last = [], 0, time.time()
+            for seq in sorted(pending):
+                buffer.append(pending[seq]); n_buffer += len(pending[seq])
+            if n_buffer>0: self._append(dset, buffer, n_buffer)
+            f['_header'].attrs['modified'] = time.time()
+
+    def _append(self, dset, buffer, n_buffer):
+        start = dset.shape[0]
+        dset.resize((start+n_buffer,))
+        dset[start:] = np.concatenate(buffer)
+        dset.file.flush()
+        self._count(rows=n_buffer, chunks=1)
+
+    def start(self):
+        if not self.io.is_listening: self.io.start_listening()
+        self.threads = [threading.Thread(target=self._write, daemon=True)]
+        self.threads += [threading.Thread(target=self._decode, daemon=True) \
+                         for i in range(self.workers)]
+        self.threads += [threading.Thread(target=self._read, daemon=True)]
+        for thread in self.threads: thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        for thread in reversed(self.threads): thread.join()
+        if self.io.is_listening: self.io.stop_listening()
+        return self.report()
+
+    def report(self):
+        with self.lock: return dict(self.stats)
+
+
+
+def run(io, filename, duration, report_interval=10., **kwargs):
+    readout = Readout(io, filename, **kwargs).start()
+    start = time.time()
+    print('READOUT to ',filename,' for ',duration,' s')
+    try:
+        while time.time()-start<duration:
+            time.sleep(min(report_interval, max(duration-(time.time()-start), 0)))
+            s = readout.report()
+            print('READOUT {:.0f} s\t messages: {}\t rows: {}\t dropped: {}\t queue: {}'\
+                  .format(time.time()-start, s['messages'], s['rows'], \
+                          s['dropped_messages'], readout.raw.qsize()))
+    except KeyboardInterrupt:
+        print('READOUT interrupted')
+    s = readout.stop()
+    print('READOUT done\t',s)
+    return s
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', default=60., type=float, \
+                        help='''Readout time [s]''')
+    parser.add_argument('--filename', default=None, type=str, \
+                        help='''Output HDF5 file (default: timestamped)''')
+    parser.add_argument('--workers', default=4, type=int, \
+                        help='''Decoding worker threads''')
+    parser.add_argument('--batchSize', default=256, type=int, \
+                        help='''PACMAN messages per decode batch''')
+    parser.add_argument('--queueSize', default=64, type=int, \
+                        help='''Batches buffered before messages are dropped''')
+    parser.add_argument('--chunkRows', default=2**18, type=int, \
+                        help='''Rows per HDF5 write''')
+    args = parser.parse_args()
+    filename = args.filename
+    if filename is None: filename = time.strftime('readout-%Y_%m_%d_%H_%M_%S_%Z.h5')
+    c = larpix.Controller()
+    c.io = pacman_connection.get_io()
+    run(c.io, filename, args.duration, workers=args.workers, \
+        batch_size=args.batchSize, queue_size=args.queueSize, \
+        chunk_rows=args.chunkRows)
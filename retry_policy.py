@@ -0,0 +1,100 @@
+import time
+
+import network_state
+
+
+
+class RetryPolicy:
+    # Central retry policy for register reconciliation and network hops.
+    # attempts overrides the write/verify rounds of reconcile_registers
+    # (None keeps each caller's own n), backoff is the sleep before the
+    # second round and grows by backoff_factor per round. A target (chip
+    # key or 'parent->daughter' link) is marked dead once it fails
+    # chip_failures / link_failures times; None disables the breaker.
+    # Chips are tracked per tile so a dead chip stays dead whichever
+    # io_channel it is tried on.
+    def __init__(self, attempts=None, backoff=0., backoff_factor=2., \
+                 chip_failures=None, link_failures=None):
+        self.n_attempts = attempts
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.chip_failures = chip_failures
+        self.link_failures = link_failures
+        self.failures = {}
+        self.dead = set()
+        self.decisions = []
+
+    def attempts(self, n):
+        if self.n_attempts is None: return n
+        return self.n_attempts
+
+    def wait(self, attempt):
+        if self.backoff<=0: return
+        time.sleep(self.backoff*self.backoff_factor**attempt)
+
+    def _decide(self, target, decision, detail=''):
+        self.decisions.append((round(time.time(), 3), target, decision, detail))
+
+    def allow(self, *targets):
+        for target in targets:
+            if name(target) in self.dead:
+                self._decide(name(target), 'skip', 'circuit open')
+                return False
+        return True
+
+    def success(self, *targets):
+        for target in targets: self.failures.pop(name(target), None)
+
+    def failure(self, target, link=False):
+        target = name(target)
+        self.failures[target] = self.failures.get(target, 0)+1
+        limit = self.link_failures if link else self.chip_failures
+        if limit is not None and self.failures[target]>=limit \
+           and target not in self.dead:
+            self.dead.add(target)
+            self._decide(target, 'open', \
+                         '{} consecutive failures'.format(self.failures[target]))
+        return
+
+    def kill(self, target, detail=''):
+        # mark a target dead up front, e.g. from an earlier run's history
+        target = name(target)
+        if target in self.dead: return
+        self.dead.add(target)
+        self._decide(target, 'open', detail)
+
+    def report(self):
+        return {'attempts':self.n_attempts, 'backoff':self.backoff, \
+                'chip_failures':self.chip_failures, \
+                'link_failures':self.link_failures, \
+                'dead':sorted(self.dead), 'failures':dict(self.failures), \
+                'decisions':[list(d) for d in self.decisions]}
+
+
+
+def name(target):
+    if not hasattr(target, 'chip_id'): return str(target)
+    return '{}-tile{}-{}'.format(target.io_group, \
+                                 network_state.tile_index(target.io_channel), \
+                                 target.chip_id)
+
+
+
+def link(parent, daughter):
+    return '{}->{}'.format(name(parent), daughter.chip_id)
+
+
+
+_policy=RetryPolicy()
+
+
+
+def active():
+    return _policy
+
+
+
+def configure(**kwargs):
+    global _policy
+    _policy = RetryPolicy(**kwargs)
+    return _policy
@@ -0,0 +1,184 @@
+import random
+import time
+
+import larpix
+import larpix.io
+import larpix.bitarrayhelper as bah
+from larpix import Packet_v2
+
+import network_state
+import tile_program
+
+# Simulated LArPix-v2b tiles behind one PACMAN, for exercising the bring-up
+# and the tile daemon without hardware. Every tile is a 10x10 grid of chips
+# at positions 11..110 (the chip ids networking.py assigns); each io_channel
+# is wired to one edge chip (POSI 1 / PISO DS 0 facing the PACMAN), so a
+# dead root loses its tree to the waitlist; networking.py's --rootWiring
+# map should list that one chip per io_channel.
+# Commands travel along enabled PISO US -> POSI links, replies back along
+# enabled PISO DS -> POSI links and reach the PACMAN only while its UART
+# POSI (0x18) bit for the io_channel is set. Chips hold raw register bytes
+# so reads are cheap; a tile is reset when its power is switched off.
+
+# PISO uart -> grid step to the receiving chip, POSI uart -> grid step to
+# the sending chip (see networking.configure_asic_network_links)
+PISO={0:-1, 1:10, 2:1, 3:-10}
+POSI={0:-10, 1:-1, 2:10, 3:1}
+_default_wiring={1:21, 2:41, 3:71, 4:91}
+
+_config=larpix.Chip('1-1-1', version='2b').config
+_defaults=bytes([bah.touint(data, endian='little') for data in _config.all_data()])
+CHIP_ID=_config.register_map['chip_id'][0]
+ENABLE_POSI=_config.register_map['enable_posi'][0]
+ENABLE_PISO_US=_config.register_map['enable_piso_upstream'][0]
+ENABLE_PISO_DS=_config.register_map['enable_piso_downstream'][0]
+_link_registers=set([CHIP_ID, ENABLE_POSI, ENABLE_PISO_US, ENABLE_PISO_DS])
+
+# PACMAN receipt timestamp clock [Hz] and the simulated reply delays per
+# hop and per reply queued ahead on the same io_channel [clock ticks]
+CLOCK_HZ=10e6
+HOP_TICKS=260
+PACKET_TICKS=26
+
+# ADC read registers of networking.read_power and the simulated supplies:
+# VDDA/VDDD [mV], tile IDDA/IDDD with no chip configured and per chip [mA]
+ADC_READ=0x00024001
+VDDA_MV=1800
+VDDD_MV=1200
+IDDA_MA=(40., 2.2)
+IDDD_MA=(20., 0.9)
+
+
+
+class SimChip:
+    def __init__(self, pos):
+        self.pos = pos
+        self.regs = bytearray(_defaults)
+
+    def chip_id(self):
+        return self.regs[CHIP_ID]
+
+    def enabled(self, register, uart):
+        return (self.regs[register]>>uart)&1==1
+
+
+
+class SimIO(larpix.io.IO):
+    # wiring: {io_channel within tile (1-4): edge chip position}; dead: chip
+    # positions that never answer; flaky: probability of a lost reply
+    def __init__(self, wiring=None, dead=(), flaky=0., noise_ma=0.3, seed=None):
+        super().__init__()
+        self.wiring = dict(_default_wiring if wiring is None else wiring)
+        self.dead = set(dead)
+        self.flaky = flaky
+        self.noise_ma = noise_ma
+        self.random = random.Random(seed)
+        self.regs = {}
+        self.queue = []
+        self.chips = {}
+        self.routes = {}
+        for tile in range(2): self.reset(tile)
+
+    def reset(self, tile=None):
+        # power-on state of the chips of one tile index (all if None)
+        for t in ([0, 1] if tile is None else [tile]):
+            for pos in network_state._chip_ids: self.chips[(t, pos)] = SimChip(pos)
+        self.routes = {}
+
+    def powered(self, tile):
+        pacman_tile = tile_program.TILES.get(tile+1)
+        if pacman_tile is None or not self.regs.get(tile_program.GLOBAL_POWER, 0):
+            return False
+        return self.regs.get(tile_program.TILE_POWER, 0)&pacman_tile['enable']!=0 \
+            and self.regs.get(pacman_tile['vdda'], 0)>0 \
+            and self.regs.get(pacman_tile['vddd'], 0)>0
+
+    def set_reg(self, reg, val, io_group=None):
+        was = [self.powered(tile) for tile in range(2)]
+        self.regs[reg] = val
+        for tile in range(2):
+            if was[tile] and not self.powered(tile): self.reset(tile)
+        self.routes = {}
+
+    def get_reg(self, reg, io_group=None):
+        if ADC_READ<=reg<ADC_READ+len(tile_program.TILES)*32:
+            return self.adc(reg-ADC_READ)
+        return self.regs.get(reg, 0)
+
+    def adc(self, offset):
+        # raw ADC word as decoded by networking.read_power
+        tile, channel = offset//32, offset%32
+        if not self.powered(tile): return 0
+        if channel in (1, 17):
+            return ((VDDA_MV if channel==1 else VDDD_MV)//4<<3)<<16
+        if channel not in (0, 16): return 0
+        base, per_chip = IDDA_MA if channel==0 else IDDD_MA
+        n = len([chip for (t, pos), chip in self.chips.items() \
+                 if t==tile and chip.chip_id()!=_defaults[CHIP_ID]])
+        ma = base+per_chip*n+self.random.gauss(0, self.noise_ma)
+        return int(max(ma, 0)/0.5)<<16
+
+    def reset_larpix(self, length=256, io_group=None):
+        self.reset()
+
+    def reachable(self, io_channel):
+        # {chip position: (chip, replies reach the PACMAN, hops from the
+        # PACMAN)} for io_channel
+        if io_channel in self.routes: return self.routes[io_channel]
+        tile = network_state.tile_index(io_channel)
+        root = self.chips.get((tile, self.wiring.get((io_channel-1)%4+1)))
+        out = {}
+        self.routes[io_channel] = out
+        if root is None or root.pos in self.dead or not self.powered(tile): return out
+        if not root.enabled(ENABLE_POSI, 1): return out
+        listening = (self.regs.get(0x18, 0)>>(io_channel-1))&1==1
+        stack = [(root, listening and root.enabled(ENABLE_PISO_DS, 0), 1)]
+        while stack:
+            chip, reply, depth = stack.pop()
+            if chip.pos in out: continue
+            out[chip.pos] = (chip, reply, depth)
+            for uart, step in PISO.items():
+                if not chip.enabled(ENABLE_PISO_US, uart): continue
+                daughter = self.chips.get((tile, chip.pos+step))
+                if daughter is None or daughter.pos in self.dead \
+                   or daughter.pos in out: continue
+                posi = [u for u, s in POSI.items() if s==-step][0]
+                if not daughter.enabled(ENABLE_POSI, posi): continue
+                piso = [u for u, s in PISO.items() if s==-step][0]
+                back = [u for u, s in POSI.items() if s==step][0]
+                stack.append((daughter, reply and daughter.enabled(ENABLE_PISO_DS, piso) \
+                              and chip.enabled(ENABLE_POSI, back), depth+1))
+        return out
+
+    def send(self, packets):
+        now = int(time.monotonic()*CLOCK_HZ)
+        queued = {}
+        for p in packets:
+            if not isinstance(p, Packet_v2): continue
+            for chip, reply, depth in list(self.reachable(p.io_channel).values()):
+                if chip.chip_id()!=p.chip_id: continue
+                if p.packet_type==Packet_v2.CONFIG_WRITE_PACKET:
+                    chip.regs[p.register_address] = p.register_data
+                    if p.register_address in _link_registers: self.routes = {}
+                elif p.packet_type==Packet_v2.CONFIG_READ_PACKET and reply \
+                     and self.is_listening:
+                    if self.random.random()<self.flaky: continue
+                    q = Packet_v2()
+                    q.packet_type = Packet_v2.CONFIG_READ_PACKET
+                    q.chip_id = p.chip_id
+                    q.register_address = p.register_address
+                    q.register_data = chip.regs[p.register_address]
+                    q.io_group, q.io_channel = p.io_group, p.io_channel
+                    n = queued.get(p.io_channel, 0)
+                    queued[p.io_channel] = n+1
+                    q.receipt_timestamp = (now+depth*HOP_TICKS+n*PACKET_TICKS) \
+                                          % 2**32
+                    q.assign_parity()
+                    self.queue.append(q)
+
+    def empty_queue(self):
+        packets, self.queue = self.queue, []
+        return packets, b''
+
+    def cleanup(self):
+        self.queue = []
@@ -0,0 +1,163 @@
+import argparse
+import json
+import sqlite3
+import time
+import traceback
+
+import numpy as np
+
+import link_history
+import networking
+import pacman_connection
+
+_phases=['enable', 'roots', 'network', 'waitlist', 'total']
+
+
+
+def io_channels(pacmanTile):
+    if pacmanTile==1: return list(range(1,5,1))
+    if pacmanTile==2: return list(range(5,9,1))
+    return list(range(1,9,1))
+
+
+
+def failed_links(db, run):
+    rows = db.execute('SELECT parent, daughter FROM hops WHERE run=? AND ok=0', (run,))
+    return ['{}->{}'.format('root' if p==link_history.ROOT else p, d) for p, d in rows]
+
+
+
+def run_cycle(cycle, io, history, serials, **kwargs):
+    # one enable -> network build -> disable cycle on the shared io; every
+    # hop goes to the link history as its own run, without priming
+    run = link_history.open_history(history, serials).run
+    timings = {}
+    result = {'cycle':cycle, 'run':run, 'error':None}
+    start = time.time()
+    try:
+        c = networking.main(io=io, timings=timings, disablePower=True, **kwargs)
+        result['n_configured'] = len(c.chips)
+    except Exception:
+        result['error'] = traceback.format_exc()
+        result['n_configured'] = 0
+        link_history.close_history(0, None)
+        networking.disable_tile(io, kwargs['pacmanTile'], kwargs['ioGroup'], \
+                                settle=kwargs['disableSettle'], \
+                                threshold=kwargs['settleThreshold'])
+    timings['cycle'] = time.time()-start
+    result['timings'] = dict([(k, round(v, 3)) for k, v in timings.items()])
+    db = sqlite3.connect(history)
+    result['failed_links'] = failed_links(db, run)
+    db.close()
+    return result
+
+
+
+def link_failure_probability(history, runs):
+    db = sqlite3.connect(history)
+    query = 'SELECT serial, parent, daughter, SUM(1-ok), COUNT(*) FROM hops '\
+            'WHERE run IN ({}) GROUP BY serial, parent, daughter '\
+            'HAVING SUM(1-ok)>0'.format(','.join(['?']*len(runs)))
+    rows = db.execute(query, runs).fetchall()
+    db.close()
+    return sorted([(serial, p, d, n_fail/float(n)) for serial, p, d, n_fail, n in rows], \
+                  key=lambda r: -r[3])
+
+
+
+def summarize(results, history, cycles_per_tile, shift_hours):
+    print('\n\n--------- Stress test summary ----------\n')
+    ok = [r for r in results if r['error'] is None]
+    print('cycles: ',len(results),'\t errors: ',len(results)-len(ok))
+    d = {'cycles':len(results), 'errors':len(results)-len(ok)}
+    for phase in _phases+['cycle']:
+        t = np.array([r['timings'][phase] for r in ok if phase in r['timings']])
+        if len(t)==0: continue
+        d[phase] = dict(median=float(np.median(t)), p90=float(np.percentile(t, 90)), \
+                        max=float(t.max()))
+        print('{:>9s} [s]\t median: {:.2f}\t p90: {:.2f}\t max: {:.2f}'\
+              .format(phase, d[phase]['median'], d[phase]['p90'], d[phase]['max']))
+    n = np.array([r['n_configured'] for r in results])
+    if len(n)>0:
+        print('configured chips\t min: ',n.min(),'\t median: ',np.median(n), \
+              '\t max: ',n.max())
+    links = link_failure_probability(history, [r['run'] for r in results])
+    d['links'] = [list(l) for l in links]
+    for serial, p, dd, prob in links:
+        print('LINK ',serial,'\t',('root' if p==link_history.ROOT else p),'->',dd, \
+              '\t failure probability: {:.3f}'.format(prob))
+    if 'cycle' in d:
+        per_hour = 3600./np.mean([r['timings']['cycle'] for r in results])
+        d['cycles_per_hour'] = per_hour
+        d['tiles_per_shift'] = per_hour*shift_hours/cycles_per_tile
+        print('throughput\t {:.1f} cycles/hour\t {:.2f} tiles per {} h shift '\
+              'at {} cycles per tile'.format(per_hour, d['tiles_per_shift'], \
+                                             shift_hours, cycles_per_tile))
+    return d
+
+
+
+def main(cycles=10, name=None, history=None, tileSerial=None, \
+         pacmanTile=networking._default_pacmanTile, \
+         ioGroup=networking._default_ioGroup, \
+         resetLength=networking._default_resetLength, \
+         disableSettle=networking._default_disableSettle, \
+         settleThreshold=networking._default_settleThreshold, \
+         cyclesPerTile=None, shiftHours=8, **kwargs):
+    if name is None: name = time.strftime('stress-%Y_%m_%d_%H_%M_%S_%Z')
+    if history is None: history = name+'.db'
+    if cyclesPerTile is None: cyclesPerTile = cycles
+    serials = link_history.tile_serials(ioGroup, io_channels(pacmanTile), tileSerial)
+    io = pacman_connection.get_io()
+    results = []
+    with open(name+'.jsonl', 'a') as f:
+        for cycle in range(cycles):
+            print('\n\n========= STRESS CYCLE ',cycle+1,' of ',cycles,' =========\n')
+            result = run_cycle(cycle, io, history, serials, logger=False, \
+                               pacmanTile=pacmanTile, ioGroup=ioGroup, \
+                               resetLength=resetLength, \
+                               disableSettle=disableSettle, \
+                               settleThreshold=settleThreshold, **kwargs)
+            results.append(result)
+            f.write(json.dumps(result)+'\n'); f.flush()
+            print('STRESS CYCLE ',cycle+1,'\t configured: ',result['n_configured'], \
+                  '\t time: ',result['timings']['cycle'],' s', \
+                  '\t failed links: ',len(result['failed_links']))
+    d = summarize(results, history, cyclesPerTile, shiftHours)
+    with open(name+'.json', 'w') as f: json.dump(d, f, indent=4)
+    return results
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cycles', default=10, type=int, \
+                        help='''Enable -> network build -> disable cycles''')
+    parser.add_argument('--name', default=None, type=str, \
+                        help='''Output prefix for per-cycle .jsonl, summary \
+                        .json and history .db''')
+    parser.add_argument('--history', default=None, type=str, \
+                        help='''Link history database (default: <name>.db)''')
+    parser.add_argument('--tileSerial', default=None, type=str, \
+                        help='''Tile serial(s) for the link history''')
+    parser.add_argument('--pacmanTile', default=networking._default_pacmanTile, \
+                        type=int, help='''PACMAN tile output to power''')
+    parser.add_argument('--ioGroup', default=networking._default_ioGroup, \
+                        type=int, help='''PACMAN IO group''')
+    parser.add_argument('--resetLength', default=networking._default_resetLength, \
+                        type=int, help='''Reset duration (MCLK cycles)''')
+    parser.add_argument('--disableSettle', default=networking._default_disableSettle, \
+                        type=float, help='''Maximum wait after disabling tile \
+                        power [s]''')
+    parser.add_argument('--settleThreshold', default=50., type=float, \
+                        help='''Stop waiting once VDDA and VDDD read below \
+                        this [mV]''')
+    parser.add_argument('--cyclesPerTile', default=None, type=int, \
+                        help='''Cycles that qualify one tile, for the \
+                        throughput estimate (default: --cycles)''')
+    parser.add_argument('--shiftHours', default=8, type=float, \
+                        help='''Shift length for the throughput estimate [h]''')
+    parser.add_argument('--plan', default=networking._default_plan, type=str, \
+                        help='''Network JSON to plan the hydra tree from''')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,373 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+
+import serial
+
+import event_log
+import network_state
+import networking
+import pacman_connection
+import retry_policy
+import sim_io
+import tile_program
+import waitlist_rules
+
+# job socket: one JSON request per line, {"job": name, "args": {...}}, one
+# JSON reply per line, {"ok": true, "job": name, "result": ..., "seconds": s}
+# or {"ok": false, "error": message}. Jobs run one at a time against the
+# warm tile; status is answered while another job runs.
+JOBS=['status', 'power', 'measure_ibias', 'reconfigure', 'repair', 'export', \
+      'shutdown']
+
+
+
+class TileDaemon:
+    # Keeps a powered, configured tile between jobs: the controller, the
+    # NetworkState of the built network and the PACMAN connection (or a
+    # sim_io.SimIO) live as long as the process. start() runs the usual
+    # networking.main bring-up once, without powering off; every job after
+    # that health-checks the connection and works on the existing network
+    # instead of repeating the bring-up.
+    def __init__(self, pacmanTile=networking._default_pacmanTile, \
+                 ioGroup=networking._default_ioGroup, io=None, verbose=False, \
+                 enableSerial=False, eventLog=None, retry=None, **kwargs):
+        self.pacmanTile = pacmanTile
+        self.ioGroup = ioGroup
+        self.io = io
+        self.verbose = verbose
+        self.enableSerial = enableSerial
+        self.eventLog = eventLog
+        self.retry = dict(retry or {})
+        self.kwargs = kwargs
+        self.c = None
+        self.state = network_state.NetworkState()
+        self.outstanding = []
+        self.serial = None
+        self.lock = threading.Lock()
+        self.busy = None
+        self.jobs = {}
+        self.started = None
+        self.stopping = False
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.io is None: self.io = pacman_connection.get_io()
+        timings = {}
+        self.c = networking.main(pacmanTile=self.pacmanTile, ioGroup=self.ioGroup, \
+                                 io=self.io, verbose=self.verbose, \
+                                 eventLog=self.eventLog, disablePower=False, \
+                                 timings=timings, state=self.state, \
+                                 outstanding=self.outstanding, \
+                                 retryAttempts=self.retry.get('attempts'), \
+                                 retryBackoff=self.retry.get('backoff', 0.), \
+                                 chipFailures=self.retry.get('chip_failures'), \
+                                 linkFailures=self.retry.get('link_failures'), \
+                                 **self.kwargs)
+        # main closes the event log with its summary; jobs log to a new one
+        event_log.open_log(self.eventLog)
+        self.started = time.time()
+        event_log.info('daemon_ready', chips=len(self.c.chips), \
+                       seconds=round(timings['total'], 3))
+        return self.c
+
+    def run(self, job, args=None):
+        if job not in JOBS: raise ValueError('unknown job {}'.format(job))
+        if job=='status': return self.status()
+        with self.lock:
+            self.busy = job
+            try:
+                if job!='shutdown': networking.connect_tile(c=self.c)
+                return getattr(self, job)(**(args or {}))
+            finally:
+                self.busy = None
+                self.jobs[job] = self.jobs.get(job, 0)+1
+
+    def network_chips(self):
+        return sorted(self.c.chips, key=lambda k: (k.io_channel, k.chip_id))
+
+    def verify(self, chip_key_register_pairs, timeout=0.1):
+        # one batched write/verify round trip for chips on any io_channel
+        io_channels = set([chip_key.io_channel for chip_key, registers \
+                           in chip_key_register_pairs])
+        self.io.set_reg(0x18, sum([2**(ioc-1) for ioc in io_channels]), \
+                        io_group=self.ioGroup)
+        ok, diff = networking.reconcile_registers(self.c, chip_key_register_pairs, \
+                                                  self.verbose, timeout=timeout, \
+                                                  connection_delay=0.01, n=2, \
+                                                  n_verify=2)
+        self.io.set_reg(0x18, 0, io_group=self.ioGroup)
+        return diff
+
+    def status(self):
+        per_io_channel = {}
+        for chip_key in list(self.c.chips):
+            per_io_channel[chip_key.io_channel] = \
+                per_io_channel.get(chip_key.io_channel, 0)+1
+        return dict(chips=len(self.c.chips), io_channels=per_io_channel, \
+                    missing=sum([len(m) for m in list(self.state.missing.values())]), \
+                    outstanding=len(self.outstanding), busy=self.busy, \
+                    jobs=dict(self.jobs), \
+                    uptime=round(time.time()-self.started, 1))
+
+    def power(self):
+        # {PACMAN tile: VDDA [mV], IDDA [mA], VDDD [mV], IDDD [mA]}
+        return dict([(tile, dict(zip(['vdda', 'idda', 'vddd', 'iddd'], \
+                                     networking.read_power(self.io, self.ioGroup, \
+                                                           tile)))) \
+                     for tile in tile_program.tiles(self.pacmanTile)])
+
+    def measure_ibias(self, chips=None, meter_delay=0.1):
+        # CSA current monitor bank readings of the given chip ids (all
+        # configured chips by default); the meter stays open between jobs
+        if self.enableSerial and self.serial is None:
+            self.serial = serial.Serial('/dev/ttyUSB0', 57600)
+        self.io.set_reg(0x25014, 2, io_group=self.ioGroup)
+        self.io.set_reg(0x25015, 0x10, io_group=self.ioGroup)
+        d = {}
+        for chip_key in self.network_chips():
+            if chips is not None and chip_key.chip_id not in chips: continue
+            d[str(chip_key)] = networking.sample_csa_ibias(self.c, chip_key, \
+                                                           self.serial, \
+                                                           self.enableSerial, \
+                                                           meter_delay=meter_delay)
+        self.io.set_reg(0x25014, 0x10, io_group=self.ioGroup)
+        self.io.set_reg(0x25015, 0x10, io_group=self.ioGroup)
+        return d
+
+    def reconfigure(self, chips=None, config=None, timeout=0.1):
+        # set config ({register name: value}) on the given chip ids (all by
+        # default) and write what differs from the chips; without config,
+        # reverify every register and rewrite the ones that drifted
+        chip_keys = [chip_key for chip_key in self.network_chips() \
+                     if chips is None or chip_key.chip_id in chips]
+        if len(chip_keys)==0: return dict(chips=0, failed=[])
+        pairs = []
+        for chip_key in chip_keys:
+            registers = range(self.c[chip_key].config.num_registers)
+            if config is not None:
+                registers = []
+                for name, value in config.items():
+                    if name not in self.c[chip_key].config.register_names:
+                        raise ValueError('unknown register {}'.format(name))
+                    setattr(self.c[chip_key].config, name, value)
+                    registers += list(self.c[chip_key].config.register_map[name])
+            pairs.append((chip_key, registers))
+        diff = self.verify(pairs, timeout=timeout)
+        for chip_key in diff:
+            event_log.warning('reconfigure_failed', chip=chip_key, \
+                              registers=sorted(diff[chip_key]))
+        return dict(chips=len(chip_keys), failed=sorted([str(k) for k in diff]))
+
+    def repair(self, max_passes=None, time_budget=None, skip_chips=(), \
+               timeout=0.1):
+        # verify the whole network, drop chips that fail with everything
+        # configured through them, re-root io_channels left without chips
+        # and rebuild through the waitlist with a fresh retry policy
+        pairs = [(chip_key, range(self.c[chip_key].config.num_registers)) \
+                 for chip_key in self.network_chips()]
+        diff = self.verify(pairs, timeout=timeout) if len(pairs)>0 else {}
+        dropped = []
+        for chip_key in sorted(diff, key=self.state.depth):
+            if chip_key not in self.state: continue
+            # a parent still transmitting to a reset chip (chip id 1) would
+            # hand it the next chip id written on its io_channel
+            parent = self.state.parent.get(chip_key)
+            if parent is not None:
+                networking.disable_parent_piso_us(self.c, parent, chip_key, \
+                                                  self.verbose)
+                networking.disable_parent_posi(self.c, parent, chip_key, \
+                                               self.verbose)
+            for k in self.state.subtree(chip_key):
+                event_log.warning('repair_dropped', chip=k)
+                self.state.remove(k)
+                if k in self.c.chips: self.c.remove_chip(k)
+                dropped.append(k)
+        retry_policy.configure(**self.retry)
+        n_before = len(self.c.chips)
+
+        empty = [ioc for (io_group, ioc), keys in self.state.by_io_channel.items() \
+                 if io_group==self.ioGroup and len(keys)==0]
+        candidates = networking.root_candidates(dict([\
+            (ioc, networking._default_roots[(ioc-1)%4+1]) for ioc in empty]), \
+            networking.load_root_wiring(self.kwargs.get('rootWiring')))
+        root_keys = networking.setup_root_chips(self.c, self.io, self.ioGroup, \
+                                                candidates, self.verbose, \
+                                                False, False, state=self.state, \
+                                                **self.hop_settings())
+        for root in root_keys:
+            networking.network_ext_node(self.c, self.ioGroup, [root.io_channel], \
+                                        {root.io_channel:root.chip_id})
+
+        self.state.requeue()
+        rules = waitlist_rules.WaitlistRules(skip_chips=skip_chips, \
+                                             max_passes=max_passes, \
+                                             time_budget=time_budget)
+        self.outstanding = networking.iterate_waitlist(self.c, self.io, \
+                                                       self.ioGroup, False, \
+                                                       self.verbose, False, \
+                                                       False, state=self.state, \
+                                                       rules=rules, \
+                                                       **self.hop_settings())
+        return dict(dropped=[str(k) for k in dropped], \
+                    roots=[str(k) for k in root_keys], \
+                    added=len(self.c.chips)-n_before, chips=len(self.c.chips), \
+                    missing=[list(m) for m in self.state.waitlist()])
+
+    def hop_settings(self):
+        # transmitter and reference settings of the bring-up
+        return dict(tx_diff=self.kwargs.get('tx_diff', networking._default_tx_diff), \
+                    tx_slice=self.kwargs.get('tx_slice', networking._default_tx_slice), \
+                    ref_current_trim=self.kwargs.get('ref_current_trim', \
+                                                     networking._default_ref_current_trim))
+
+    def export(self, name):
+        networking.write_network_to_file(self.c, name, self.outstanding, \
+                                         self.ioGroup, self.pacmanTile)
+        return dict(filename=name+'.json', chips=len(self.c.chips))
+
+    def shutdown(self, disablePower=False):
+        if disablePower:
+            networking.disable_tile(self.io, self.pacmanTile, self.ioGroup)
+        self.stopping = True
+        return dict(disablePower=disablePower)
+
+    def close(self):
+        if self.serial is not None: self.serial.close()
+        event_log.close_log()
+        pacman_connection.close_all()
+
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        daemon = self.server.daemon
+        for line in self.rfile:
+            start = time.time()
+            try:
+                request = json.loads(line)
+                job = request.get('job', 'status')
+                result = daemon.run(job, request.get('args'))
+                reply = {'ok':True, 'job':job, 'result':result}
+            except (ValueError, KeyError, TypeError) as e:
+                event_log.warning('job_rejected', request=line.strip(), error=str(e))
+                reply = {'ok':False, 'error':str(e)}
+            except Exception as e:
+                # keep serving: a failed job leaves the tile as it was
+                event_log.error('job_failed', request=line.strip(), \
+                                error=traceback.format_exc())
+                reply = {'ok':False, 'error':repr(e)}
+            reply['seconds'] = round(time.time()-start, 6)
+            if reply['ok']: event_log.info('job', job=job, seconds=reply['seconds'])
+            self.wfile.write((json.dumps(reply, default=str)+'\n').encode())
+            if daemon.stopping: daemon.stopped.set()
+
+
+
+def serve(daemon, path):
+    # job socket served from a daemon thread; returns once a shutdown job
+    # has been answered
+    if os.path.exists(path): os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, _JobHandler)
+    server.daemon_threads = True
+    server.daemon = daemon
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print('tile daemon serving on ',path)
+    try: daemon.stopped.wait()
+    except KeyboardInterrupt: pass
+    waitlist_rules.shutdown(server)
+
+
+
+def request(path, job, args=None, timeout=None):
+    # send one job to a running daemon; repair may take minutes, so no
+    # timeout by default
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    s.connect(path)
+    msg = {'job':job}
+    if args is not None: msg['args'] = args
+    s.sendall((json.dumps(msg)+'\n').encode())
+    reply = s.makefile('r').readline()
+    s.close()
+    return json.loads(reply)
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('socket', type=str, \
+                        help='''Job socket of the daemon''')
+    parser.add_argument('--job', default=None, type=str, choices=JOBS, \
+                        help='''Send this job to a running daemon instead of \
+                        starting one''')
+    parser.add_argument('--args', default=None, type=str, \
+                        help='''JSON job arguments, e.g. '{"chips":[11,12]}' ''')
+    parser.add_argument('--pacmanTile', default=networking._default_pacmanTile, \
+                        type=int, help='''PACMAN tile output to power''')
+    parser.add_argument('--ioGroup', default=networking._default_ioGroup, \
+                        type=int, help='''PACMAN IO group''')
+    parser.add_argument('--resetLength', default=networking._default_resetLength, \
+                        type=int, help='''Reset duration (MCLK cycles)''')
+    parser.add_argument('--verbose', default=False, type=bool, \
+                        help='''Print register differences''')
+    parser.add_argument('--enableSerial', default=False, type=bool, \
+                        help='''Read the CSA current meter on /dev/ttyUSB0''')
+    parser.add_argument('--eventLog', default=None, type=str, \
+                        help='''Bring-up and job events to this JSON-lines \
+                        file''')
+    parser.add_argument('--plan', default=networking._default_plan, type=str, \
+                        help='''Network JSON to plan the hydra tree from''')
+    parser.add_argument('--resume', default=None, type=str, \
+                        help='''Take over a still-powered tile from this \
+                        checkpoint journal instead of a fresh bring-up''')
+    parser.add_argument('--journal', default=None, type=str, \
+                        help='''Checkpoint journal of the bring-up''')
+    parser.add_argument('--readBuffer', default=2**16, type=int, \
+                        help='''Read ring capacity [packets], bounding \
+                        controller memory over the daemon's life''')
+    parser.add_argument('--retryAttempts', default=None, type=int, \
+                        help='''Register write/verify rounds per reconcile''')
+    parser.add_argument('--chipFailures', default=None, type=int, \
+                        help='''Failed hops before a chip is skipped''')
+    parser.add_argument('--linkFailures', default=None, type=int, \
+                        help='''Failed attempts before a link is skipped''')
+    parser.add_argument('--rootWiring', default=None, type=str, \
+                        help='''JSON {io_channel: [chip_id, ...]} of the edge \
+                        chips each io_channel physically reaches''')
+    parser.add_argument('--sim', default=False, type=bool, \
+                        help='''Run against a simulated tile (sim_io.py)''')
+    parser.add_argument('--simDead', default='', type=str, \
+                        help='''Comma separated chip ids dead in the simulation''')
+    parser.add_argument('--simFlaky', default=0., type=float, \
+                        help='''Probability of a lost reply in the simulation''')
+    args = parser.parse_args()
+    if args.job is not None:
+        print(json.dumps(request(args.socket, args.job, \
+                                 json.loads(args.args) if args.args else None), \
+                         indent=1))
+    else:
+        io = None
+        if args.sim:
+            io = sim_io.SimIO(dead=[int(i) for i in args.simDead.split(',') if i], \
+                              flaky=args.simFlaky)
+        daemon = TileDaemon(pacmanTile=args.pacmanTile, ioGroup=args.ioGroup, \
+                            io=io, verbose=args.verbose, \
+                            enableSerial=args.enableSerial, \
+                            eventLog=args.eventLog, \
+                            retry=dict(attempts=args.retryAttempts, \
+                                       chip_failures=args.chipFailures, \
+                                       link_failures=args.linkFailures), \
+                            logger=False, resetLength=args.resetLength, \
+                            plan=args.plan, resume=args.resume, \
+                            journal=args.journal, readBuffer=args.readBuffer, \
+                            rootWiring=args.rootWiring)
+        daemon.start()
+        try: serve(daemon, args.socket)
+        finally: daemon.close()
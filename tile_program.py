@@ -0,0 +1,131 @@
+import functools
+import time
+
+from larpix.format import pacman_msg_format
+
+import pacman_connection
+import packet_trace
+
+# PACMAN tile outputs: POSI/PISO polarity inversion registers (specific to
+# the LArPix-v2b preproduction tile), VDDA/VDDD DAC registers and the bit
+# of the tile in the power enable register. Adding a tile is adding a row.
+TILES = {
+    1: dict(inversion=[0x0301c, 0x0401c, 0x0501c, 0x0601c], \
+            vdda=0x00024130, vddd=0x00024131, enable=0b01),
+    2: dict(inversion=[0x0701c, 0x0801c, 0x0901c, 0x0a01c], \
+            vdda=0x00024132, vddd=0x00024133, enable=0b10),
+    }
+
+UART_POSI=0x18
+MCLK=0x101c
+GLOBAL_POWER=0x14
+TILE_POWER=0x10
+TILE_POWER_ON=0b1000000000
+TILE_POWER_OFF=0b1100000000
+
+VDDA_DAC=44500
+VDDD_DAC=28500 #41000
+
+
+
+def tiles(pacmanTile):
+    # PACMAN tile outputs driven for a pacmanTile argument, 0 meaning all
+    if pacmanTile==0: return tuple(sorted(TILES))
+    return (pacmanTile,)
+
+
+
+class RegisterProgram:
+    # A fixed series of PACMAN register writes compiled once into a single
+    # REQ message, so the whole series costs one round trip. run() checks
+    # every reply word and, with verify, reads all written registers back
+    # in a second message and returns {reg: (expected, read)} mismatches.
+    # IO classes without PACMAN sockets fall back to one set_reg per write.
+    def __init__(self, name, writes):
+        self.name = name
+        self.writes = list(writes)
+        self.expected = dict(self.writes)
+        self.request = pacman_msg_format.format_msg('REQ', \
+            [('WRITE', reg, val) for reg, val in self.writes])
+        self.readback = pacman_msg_format.format_msg('REQ', \
+            [('READ', reg, 0) for reg in self.expected])
+
+    def __add__(self, other):
+        return RegisterProgram(self.name+'+'+other.name, self.writes+other.writes)
+
+    def __len__(self):
+        return len(self.writes)
+
+    def _transact(self, io, io_group, msg):
+        addr = io._io_group_table[io_group]
+        io.senders[addr].send(msg)
+        io._sender_replies[addr].append(io.senders[addr].recv())
+        header, words = pacman_msg_format.parse_msg(io._sender_replies[addr][-1])
+        if any([word[0]=='ERR' for word in words]):
+            raise RuntimeError('Error received from server')
+        return words
+
+    def run(self, io, io_group, verify=False):
+        start = time.monotonic_ns()
+        if not hasattr(io, 'senders'):
+            # set_reg of an io attached to packet_trace records itself
+            for reg, val in self.writes: io.set_reg(reg, val, io_group=io_group)
+            read = dict([(reg, io.get_reg(reg, io_group=io_group)) \
+                         for reg in self.expected]) if verify else {}
+            traced = getattr(io, '_packet_trace', False)
+        else:
+            pacman_connection.call(io, self._transact, io, io_group, self.request)
+            read = {}
+            if verify:
+                read = dict([(word[1], word[2]) for word in \
+                             pacman_connection.call(io, self._transact, io, \
+                                                    io_group, self.readback)])
+            traced = False
+        if not traced:
+            packet_trace.record_registers(packet_trace.KIND_SET_REG, io_group, \
+                                          self.writes, start, time.monotonic_ns())
+        diff = dict([(reg, (val, read.get(reg))) for reg, val \
+                     in self.expected.items() if verify and read.get(reg)!=val])
+        if len(diff)>0:
+            print(self.name,' register read-back mismatch: ', \
+                  dict([(hex(reg), v) for reg, v in diff.items()]))
+        return diff
+
+
+
+@functools.lru_cache(maxsize=None)
+def uart_setup(tile_ids):
+    # invert POSI/PISO polarity and disable PACMAN UART POSI
+    writes = [(reg, 0b11) for t in tile_ids for reg in TILES[t]['inversion']]
+    writes.append((UART_POSI, 0b0))
+    return RegisterProgram('uart_setup', writes)
+
+
+
+@functools.lru_cache(maxsize=None)
+def power_on(tile_ids, vdda_dac=VDDA_DAC, vddd_dac=VDDD_DAC, mclk=4):
+    # MCLK to 10 MHz (and clock phase shift), global LArPix power, DACs and
+    # tile power enable
+    writes = [(MCLK, mclk), (GLOBAL_POWER, 1)]
+    for t in tile_ids:
+        writes += [(TILES[t]['vdda'], vdda_dac), (TILES[t]['vddd'], vddd_dac)]
+    enable = TILE_POWER_ON
+    for t in tile_ids: enable |= TILES[t]['enable']
+    writes.append((TILE_POWER, enable))
+    return RegisterProgram('power_on', writes)
+
+
+
+@functools.lru_cache(maxsize=None)
+def enable(tile_ids, vdda_dac=VDDA_DAC, vddd_dac=VDDD_DAC, mclk=4):
+    return uart_setup(tile_ids)+power_on(tile_ids, vdda_dac, vddd_dac, mclk)
+
+
+
+@functools.lru_cache(maxsize=None)
+def power_off(tile_ids):
+    # VDDD set to 0 explicitly needed on rev4, then tile and global power off
+    writes = []
+    for t in tile_ids: writes += [(TILES[t]['vdda'], 0), (TILES[t]['vddd'], 0)]
+    writes += [(TILE_POWER, TILE_POWER_OFF), (GLOBAL_POWER, 0)]
+    return RegisterProgram('power_off', writes)
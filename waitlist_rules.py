@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+import event_log
+
+# rules file / control socket fields:
+#   skip_chips:  chip ids never tried as daughters or parents
+#   skip_links:  [parent chip id, daughter chip id] pairs never tried
+#   max_passes:  cap on waitlist passes (null for no cap)
+#   time_budget: seconds allowed for the waitlist phase, checked before
+#                every hop (null for no limit)
+#   stop:        end the waitlist phase at the next hop
+_fields=['skip_chips', 'skip_links', 'max_passes', 'time_budget', 'stop']
+
+
+
+def _is_int(x):
+    return isinstance(x, int) and not isinstance(x, bool)
+
+
+
+def validate(d):
+    # checked copy of a rules dict; raises ValueError before anything is
+    # applied, so a bad edit never leaves the rules half updated
+    if not isinstance(d, dict): raise ValueError('waitlist rules must be a JSON object')
+    unknown = [k for k in d if k not in _fields]
+    if len(unknown)>0: raise ValueError('unknown waitlist rules {}'.format(unknown))
+    out = {}
+    if 'skip_chips' in d:
+        if not isinstance(d['skip_chips'], (list, tuple, set)) or \
+           not all([_is_int(i) for i in d['skip_chips']]):
+            raise ValueError('skip_chips must be a list of chip ids')
+        out['skip_chips'] = set(d['skip_chips'])
+    if 'skip_links' in d:
+        if not isinstance(d['skip_links'], (list, tuple, set)) or \
+           not all([isinstance(p, (list, tuple)) and len(p)==2 \
+                    and all([_is_int(i) for i in p]) for p in d['skip_links']]):
+            raise ValueError('skip_links must be a list of [parent, daughter] chip ids')
+        out['skip_links'] = set([tuple(p) for p in d['skip_links']])
+    if 'max_passes' in d:
+        if d['max_passes'] is not None and \
+           (not _is_int(d['max_passes']) or d['max_passes']<0):
+            raise ValueError('max_passes must be a non-negative integer or null')
+        out['max_passes'] = d['max_passes']
+    if 'time_budget' in d:
+        if d['time_budget'] is not None and \
+           (not (_is_int(d['time_budget']) or isinstance(d['time_budget'], float)) \
+            or d['time_budget']<0):
+            raise ValueError('time_budget must be a non-negative number or null')
+        out['time_budget'] = d['time_budget']
+    if 'stop' in d:
+        if not isinstance(d['stop'], bool): raise ValueError('stop must be true or false')
+        out['stop'] = d['stop']
+    return out
+
+
+
+class WaitlistRules:
+    def __init__(self, skip_chips=(), skip_links=(), max_passes=None, \
+                 time_budget=None, stop=False, filename=None):
+        self.lock = threading.Lock()
+        self.filename = filename
+        self.mtime = None
+        self.error = None  # last rules file problem, logged once
+        self.start = time.time()
+        self.update(dict(skip_chips=skip_chips, skip_links=skip_links, \
+                         max_passes=max_passes, time_budget=time_budget, \
+                         stop=stop))
+
+    @classmethod
+    def from_file(cls, filename):
+        # a broken rules file at startup is an error; later edits are not
+        rules = cls(filename=filename)
+        rules.mtime = os.path.getmtime(filename)
+        with open(filename, 'r') as f: rules.update(json.load(f))
+        return rules
+
+    def update(self, d):
+        d = validate(d)
+        with self.lock:
+            for k, v in d.items(): setattr(self, k, v)
+        return self.status()
+
+    def refresh(self):
+        # pick up edits to the rules file made while the bring-up is running;
+        # an unreadable or invalid file keeps the previous rules
+        if self.filename is None: return
+        try:
+            mtime = os.path.getmtime(self.filename)
+            if mtime==self.mtime: return
+            with open(self.filename, 'r') as f: d = json.load(f)
+            self.update(d)
+        except json.JSONDecodeError as e:
+            # possibly partially written: retry on next refresh
+            self.warn(e)
+            return
+        except (OSError, ValueError) as e:
+            self.warn(e)
+            if not isinstance(e, OSError): self.mtime = mtime
+            return
+        self.mtime = mtime
+        self.error = None
+
+    def warn(self, error):
+        if str(error)==self.error: return
+        self.error = str(error)
+        event_log.warning('waitlist_rules_invalid', file=self.filename, \
+                          error=self.error)
+
+    def status(self):
+        with self.lock:
+            return {'skip_chips':sorted(self.skip_chips), \
+                    'skip_links':sorted([list(p) for p in self.skip_links]), \
+                    'max_passes':self.max_passes, \
+                    'time_budget':self.time_budget, 'stop':self.stop, \
+                    'elapsed':round(time.time()-self.start, 1)}
+
+    def restart_clock(self):
+        self.start = time.time()
+
+    def expired(self):
+        self.refresh()
+        with self.lock:
+            if self.stop: return True
+            if self.time_budget is None: return False
+            return time.time()-self.start>self.time_budget
+
+    def allow(self, parent, daughter):
+        with self.lock:
+            if parent.chip_id in self.skip_chips: return False
+            if daughter.chip_id in self.skip_chips: return False
+            return (parent.chip_id, daughter.chip_id) not in self.skip_links
+
+    def proceed(self, n_pass):
+        # True if another waitlist pass (1-indexed n_pass) may start
+        if self.expired(): return False
+        with self.lock:
+            return self.max_passes is None or n_pass<=self.max_passes
+
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError('request must be a JSON object')
+                cmd = request.get('cmd', 'get')
+                if cmd=='set': reply = self.server.rules.update(request['rules'])
+                elif cmd=='stop': reply = self.server.rules.update({'stop':True})
+                elif cmd=='get': reply = self.server.rules.status()
+                else: raise ValueError('unknown command {}'.format(cmd))
+                reply = {'ok':True, 'rules':reply}
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {'ok':False, 'error':str(e)}
+            self.wfile.write((json.dumps(reply)+'\n').encode())
+
+
+
+def serve(rules, path):
+    # local control socket for operators, served from a daemon thread
+    if os.path.exists(path): os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, _ControlHandler)
+    server.daemon_threads = True
+    server.rules = rules
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+
+def shutdown(server):
+    server.shutdown()
+    server.server_close()
+    if os.path.exists(server.server_address): os.remove(server.server_address)
+
+
+
+def request(path, cmd, rules=None, timeout=5):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    s.connect(path)
+    msg = {'cmd':cmd}
+    if rules is not None: msg['rules'] = rules
+    s.sendall((json.dumps(msg)+'\n').encode())
+    reply = s.makefile('r').readline()
+    s.close()
+    return json.loads(reply)
+
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('socket', type=str, \
+                        help='''Control socket of a running networking.py''')
+    parser.add_argument('--set', default=None, type=str, \
+                        help='''JSON rules to apply, e.g. '{"skip_chips":[33]}' ''')
+    parser.add_argument('--stop', action='store_true', \
+                        help='''End the waitlist phase at the next hop''')
+    args = parser.parse_args()
+    if args.stop: print(request(args.socket, 'stop'))
+    elif args.set is not None: print(request(args.socket, 'set', json.loads(args.set)))
+    else: print(request(args.socket, 'get'))